@@ -3,21 +3,239 @@
 Attributes:
     DEFAULT_API_VERSION (int): Default Alpaca API spec to use if none is specified when
     needed.
+    SIDEREAL_RATE (float): Sidereal seconds elapsed per SI second.
+    DRIVE_RATES (dict): Telescope TrackingRate values mapped to their drive rate in
+        arcseconds per SI second.
+    PRIORITY_SAFETY (int): Command priority that bypasses the per-device command queue
+        and holds back queued commands until it completes.
+    PRIORITY_HIGH (int): Command priority served before normal queued commands.
+    PRIORITY_NORMAL (int): Default command priority.
 
 """
 
-from datetime import datetime
-from typing import Optional, Union, List, Dict, Mapping, Any
+import atexit
+import base64
+import copy
+import gzip
+import json
+import heapq
+import itertools
+import logging
+import math
+import os
+import queue
+import random
+import re
+import socket
+import struct
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import weakref
+import zlib
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional, Union, List, Dict, Mapping, Any, Callable, NamedTuple
 import dateutil.parser
 import requests
 
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+_log = logging.getLogger(__name__)
+
 
 DEFAULT_API_VERSION = 1
+SIDEREAL_RATE = 1.00273790935
+DRIVE_RATES = {0: 15.041067, 1: 14.685, 2: 15.0, 3: 15.0369}
+PRIORITY_SAFETY = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+# Image reads are too large to keep as last known values.
+_UNKNOWN = frozenset(("imagearray", "imagearrayvariant"))
+
+
+class _Call:
+    """Outcome of a call shared by _SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.expires = float("inf")
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _SingleFlight:
+    """Let concurrent identical calls share one execution and its result."""
+
+    def __init__(self, limit: int = 1024):
+        self.limit = limit
+        self._calls: Dict[tuple, _Call] = {}
+        self._lock = threading.Lock()
+
+    def run(
+        self,
+        key: tuple,
+        function: Callable[[], Any],
+        freshness: float = 0.0,
+        timeout: Optional[float] = None,
+    ):
+        """Run function, or wait for an identical call in flight or fresh enough.
+
+        Args:
+            key (tuple): Identity of the call, starting with the base URL of the
+                device it goes to.
+            function (callable): Function performing the call.
+            freshness (float): Seconds a finished result may be reused.
+            timeout (float): Seconds to wait for an identical call in flight.
+
+        Raises:
+            requests.Timeout: If the identical call did not finish in time.
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None or time.monotonic() >= call.expires
+            if leader:
+                if len(self._calls) >= self.limit:
+                    self._prune()
+                call = self._calls[key] = _Call()
+        if not leader:
+            if not call.done.wait(timeout):
+                raise requests.Timeout("Timed out waiting for an identical request")
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = function()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if freshness > 0 and call.error is None:
+                    call.expires = time.monotonic() + freshness
+                elif self._calls.get(key) is call:
+                    del self._calls[key]
+                    call.expires = 0.0
+            call.done.set()
+
+    def invalidate(self, base_url: str):
+        """Make calls to a device in flight or fresh unavailable to later callers.
+
+        Args:
+            base_url (str): Base URL of the device.
+
+        """
+        with self._lock:
+            for key in [key for key in self._calls if key[0] == base_url]:
+                del self._calls[key]
+
+    def _prune(self):
+        """Drop finished calls whose result is no longer fresh."""
+        now = time.monotonic()
+        for key, call in list(self._calls.items()):
+            if call.expires <= now:
+                del self._calls[key]
+
+
+_single_flight = _SingleFlight()
+
+
+class _CommandQueue:
+    """Serialize the state-changing commands sent to one device by priority.
+
+    Commands wait for their turn in priority order, lowest value first, and then in
+    arrival order. Commands at PRIORITY_SAFETY or below never wait: they run at once,
+    even while another command is executing, and queued commands only resume after
+    they finish.
+    """
+
+    _queues: Dict[str, "_CommandQueue"] = {}
+    _queues_lock = threading.Lock()
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiting: List[tuple] = []
+        self._order = itertools.count()
+        self._busy = False
+        self._urgent = 0
+
+    @classmethod
+    def of(cls, base_url: str) -> "_CommandQueue":
+        """Return the queue shared by all Device objects with this base URL."""
+        with cls._queues_lock:
+            queue = cls._queues.get(base_url)
+            if queue is None:
+                queue = cls._queues[base_url] = cls()
+            return queue
+
+    @contextmanager
+    def slot(self, priority: int):
+        """Wait for the turn of a command with the given priority."""
+        urgent = priority <= PRIORITY_SAFETY
+        with self._cond:
+            if urgent:
+                self._urgent += 1
+            else:
+                entry = (priority, next(self._order))
+                heapq.heappush(self._waiting, entry)
+                while self._busy or self._urgent or self._waiting[0] != entry:
+                    self._cond.wait()
+                heapq.heappop(self._waiting)
+                self._busy = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                if urgent:
+                    self._urgent -= 1
+                else:
+                    self._busy = False
+                self._cond.notify_all()
+
+
+class KnownValue(NamedTuple):
+    """Last value read of a device property, see Device.known.
+
+    Attributes:
+        value: The value.
+        age (float): Seconds since the value was read from the server.
+        stale (bool): Whether the latest read failed to reach the server and
+            returned this value instead.
+
+    """
+
+    value: Any
+    age: float
+    stale: bool
 
 
 class Device:
     """Common methods across all ASCOM Alpaca devices.
 
+    State-changing PUT requests to a device are sent one at a time, in order of the
+    priority given by the priorities mapping, while GET requests and the PUT
+    requests in unqueued run in parallel.
+
     Attributes:
         address (str): Domain name or IP address of Alpaca server.
             Can also specify port number if needed.
@@ -28,9 +246,32 @@ class Device:
         protocall (str): Protocall used to communicate with Alpaca server.
         api_version (int): Alpaca API version.
         base_url (str): Basic URL to easily append with commands.
+        session (Session): Optional requests session used instead of the module level
+            functions, e.g. to keep a dedicated connection alive.
+        timeout (float): Optional timeout in seconds for each HTTP request.
+        coalesce (bool): Whether identical GET requests made while one is in flight
+            wait for and share its result instead of sending their own.
+        freshness (float): Seconds a coalesced GET result may be reused by later
+            identical requests, 0 to only share requests in flight.
+        staleness (float): If set, reads that cannot reach the server return the
+            last value read instead of raising, as long as it is at most this many
+            seconds old. PUT requests and image reads always raise.
+        priorities (dict): PUT attributes mapped to their command priority, other
+            commands use PRIORITY_NORMAL.
+        unqueued (frozenset): PUT attributes sent at once, bypassing the command
+            queue, e.g. guide pulses that must not wait for a running slew.
+        recorder (TrafficRecorder): Optional recorder of all requests, set on the
+            class to record every device.
+        tracer (TraceSink): Optional sink of sampled request timings, set on the
+            class to trace every device.
 
     """
 
+    priorities: Dict[str, int] = {}
+    unqueued: frozenset = frozenset()
+    recorder: Optional["TrafficRecorder"] = None
+    tracer: Optional["TraceSink"] = None
+
     def __init__(
         self,
         address: str,
@@ -43,7 +284,15 @@ class Device:
         self.address = address
         self.device_type = device_type
         self.device_number = device_number
+        self.protocall = protocall
         self.api_version = api_version
+        self.session: Optional[requests.Session] = None
+        self.timeout: Optional[float] = None
+        self.coalesce = True
+        self.freshness = 0.0
+        self.staleness: Optional[float] = None
+        self._static: Dict[tuple, Any] = {}
+        self._known: Dict[tuple, tuple] = {}
         self.base_url = "%s://%s/api/v%d/%s/%d" % (
             protocall,
             address,
@@ -113,6 +362,7 @@ class Device:
 
         """
         self._put("connected", Connected=Connected)
+        self._forget()
 
     @property
     def Description(self) -> str:
@@ -144,6 +394,101 @@ class Device:
         """Get list of action names supported by this driver."""
         return self._get("supportedactions")
 
+    def read_all(
+        self, properties: Optional[List[str]] = None, max_workers: int = 8
+    ) -> Dict[str, Any]:
+        """Read properties of the device concurrently.
+
+        Args:
+            properties (list): Property names, by default every property of the
+                device class except the image arrays.
+            max_workers (int): Maximum number of concurrent requests.
+
+        Returns:
+            Values by property name, the exception raised for failed reads.
+
+        """
+        if properties is None:
+            properties = [
+                name
+                for name in dir(type(self))
+                if isinstance(getattr(type(self), name), property)
+                and name not in ("ImageArray", "ImageArrayVariant")
+            ]
+
+        def read(name: str):
+            try:
+                return getattr(self, name)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max(1, min(max_workers, len(properties)))) as executor:
+            return dict(zip(properties, executor.map(read, properties)))
+
+    def with_session(self, connections: int = 1) -> "Device":
+        """Return a copy of this device that talks over its own HTTP session.
+
+        Args:
+            connections (int): Number of connections the session keeps alive.
+
+        Returns:
+            Device of the same type that shares nothing with this one except the
+            static value cache and the command queue. Last known values are not
+            returned by the copy, its staleness is None, so dedicated connections
+            such as those of watchdogs notice when the server is unreachable.
+
+        """
+        device = copy.copy(self)
+        device.session = _session(connections)
+        device.staleness = None
+        device._known = {}
+        return device
+
+    def on_change(
+        self,
+        property: str,
+        callback: Callable[[str, Any, Any], None],
+        interval: float = 1.0,
+        deadband: Optional[float] = None,
+        poller: Optional["PropertyPoller"] = None,
+        on_error: Optional[Callable[[str, Exception], None]] = None,
+    ) -> "Subscription":
+        """Call a function whenever a property of this device changes.
+
+        Args:
+            property (str): Property name, e.g. Slewing or ShutterStatus.
+            callback (callable): Called as callback(property, old, new) on the
+                dispatcher thread of the poller.
+            interval (float): Seconds between polls of the property.
+            deadband (float): For numeric properties, minimum change since the last
+                notification that triggers the callback.
+            poller (PropertyPoller): Poller to use, the shared default by default.
+            on_error (callable): Called as on_error(property, error) on the
+                dispatcher thread when reading the property starts failing.
+
+        Returns:
+            Subscription that can be cancelled.
+
+        """
+        poller = poller or PropertyPoller.default()
+        return poller.subscribe(self, property, callback, interval, deadband, on_error)
+
+    def known(self, property: str, **data) -> Optional[KnownValue]:
+        """Return the last value read of a property, None if it was never read.
+
+        Values are only kept while staleness is set, and never for images.
+
+        Args:
+            property (str): Property name, e.g. RightAscension.
+            **data: Parameters the property was read with.
+
+        """
+        entry = self._known.get((property.lower(),) + tuple(sorted(data.items())))
+        if entry is None:
+            return None
+        value, read, stale = entry
+        return KnownValue(value, time.monotonic() - read, stale)
+
     def _get(self, attribute: str, **data):
         """Send an HTTP GET request to an Alpaca server and check response for errors.
 
@@ -152,23 +497,128 @@ class Device:
             **data: Data to send with request.
 
         """
-        response = requests.get(
-            "%s/%s" % (self.base_url, attribute), data=data)
-        self.__check_error(response)
-        return response.json()["Value"]
+        if self.staleness is None or attribute in _UNKNOWN:
+            return self._fetch(attribute, data)
+        key = (attribute,) + tuple(sorted(data.items()))
+        try:
+            value = self._fetch(attribute, data)
+        except (requests.ConnectionError, requests.Timeout):
+            entry = self._known.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.staleness:
+                raise
+            _log.debug("Returning last known %s of %s", attribute, self.base_url)
+            self._known[key] = (entry[0], entry[1], True)
+            return entry[0]
+        self._known[key] = (value, time.monotonic(), False)
+        return value
+
+    def _fetch(self, attribute: str, data: Dict[str, Any]):
+        """Get a value from the server, coalescing identical requests."""
+        if not self.coalesce:
+            return self._request("GET", attribute, data).json()["Value"]
+        key = (self.base_url, attribute, id(self.session)) + tuple(sorted(data.items()))
+        return _single_flight.run(
+            key,
+            lambda: self._request("GET", attribute, data).json()["Value"],
+            self.freshness,
+            self.timeout,
+        )
+
+    def _get_static(self, attribute: str, **data):
+        """Get a value that does not change while connected and cache it.
+
+        The cache is cleared whenever Connected is set and an entry is dropped when
+        the same attribute is put.
+
+        Args:
+            attribute (str): Attribute to get from server.
+            **data: Data to send with request.
+
+        """
+        key = (attribute,) + tuple(sorted(data.items()))
+        try:
+            return self._static[key]
+        except KeyError:
+            value = self._static[key] = self._get(attribute, **data)
+            return value
+
+    def _forget(self):
+        """Clear the values cached for the current connection."""
+        self._static.clear()
+        self._known.clear()
 
     def _put(self, attribute: str, **data):
         """Send an HTTP PUT request to an Alpaca server and check response for errors.
 
+        PUT requests to the same device are serialized by priority, see priorities,
+        except those in unqueued.
+        Coalesced GET requests started before the PUT finished are not shared with
+        later readers, so they see its effect.
+
         Args:
             attribute (str): Attribute to put to server.
             **data: Data to send with request.
 
         """
-        response = requests.put(
-            "%s/%s" % (self.base_url, attribute), data=data)
-        self.__check_error(response)
-        return response.json()
+        self._static.pop((attribute,), None)
+        priority = self.priorities.get(attribute, PRIORITY_NORMAL)
+        try:
+            if attribute in self.unqueued:
+                return self._request("PUT", attribute, data).json()
+            with _CommandQueue.of(self.base_url).slot(priority):
+                return self._request("PUT", attribute, data).json()
+        finally:
+            _single_flight.invalidate(self.base_url)
+
+    def _request(self, method: str, attribute: str, data: Dict[str, Any], **kwargs):
+        """Send an HTTP request to an Alpaca server and check response for errors.
+
+        Args:
+            method (str): HTTP method, GET or PUT.
+            attribute (str): Attribute to get from or put to server.
+            data (dict): Data to send with request.
+            **kwargs: Further options of the request. Streamed responses are
+                neither checked nor recorded, that is left to the caller.
+
+        Returns:
+            Response from the Alpaca server.
+
+        """
+        http = self.session or requests
+        # Alpaca expects GET parameters in the query string and PUT ones as a form.
+        fields = {"params": data} if method == "GET" else {"data": data}
+        start = time.perf_counter()
+        try:
+            response = http.request(
+                method,
+                "%s/%s" % (self.base_url, attribute),
+                timeout=self.timeout,
+                **fields,
+                **kwargs
+            )
+        except requests.RequestException as e:
+            if self.recorder is not None:
+                self.recorder.record(self, method, attribute, data, None, start, e)
+            if self.tracer is not None:
+                elapsed = time.perf_counter() - start
+                self.tracer.trace(self, method, attribute, elapsed, 0, e)
+            raise
+        if kwargs.get("stream"):
+            return response
+        elapsed = time.perf_counter() - start
+        if self.recorder is not None:
+            self.recorder.record(self, method, attribute, data, response, start)
+        error = None
+        try:
+            self.__check_error(response)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if self.tracer is not None:
+                size = len(response.content)
+                self.tracer.trace(self, method, attribute, elapsed, size, error)
+        return response
 
     def __check_error(self, response: requests.Response):
         """Check response from Alpaca server for Errors.
@@ -185,6 +635,17 @@ class Device:
                 raise NumericError(j["ErrorNumber"], j["ErrorMessage"])
 
 
+def _session(connections: int) -> requests.Session:
+    """Return an HTTP session keeping up to the given number of connections alive."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=connections
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 class Switch(Device):
     """Switch specific methods."""
 
@@ -388,6 +849,12 @@ class SafetyMonitor(Device):
 class Dome(Device):
     """Dome specific methods."""
 
+    priorities = {
+        "abortslew": PRIORITY_SAFETY,
+        "closeshutter": PRIORITY_SAFETY,
+        "park": PRIORITY_SAFETY,
+    }
+
     def __init__(
         self,
         address: str,
@@ -642,7 +1109,16 @@ class Dome(Device):
 
 
 class Camera(Device):
-    """Camera specific methods."""
+    """Camera specific methods.
+
+    Attributes:
+        compression (bool): Whether download_image asks for compressed transfer.
+        last_download (DownloadReport): Transfer statistics of the last download.
+
+    """
+
+    priorities = {"abortexposure": PRIORITY_SAFETY, "stopexposure": PRIORITY_SAFETY}
+    unqueued = frozenset({"pulseguide"})
 
     def __init__(
         self,
@@ -653,6 +1129,8 @@ class Camera(Device):
     ):
         """Initialize Camera object."""
         super().__init__(address, "camera", device_number, protocall, api_version)
+        self.compression = True
+        self.last_download: Optional[DownloadReport] = None
 
     @property
     def BayerOffsetX(self) -> int:
@@ -1162,6 +1640,221 @@ class Camera(Device):
         """
         self._put("stopexposure")
 
+    def download_image(
+        self,
+        sink: Optional["ImageSink"] = None,
+        compression: Optional[bool] = None,
+        binary: bool = False,
+        chunk_size: int = 262144,
+        pool: Optional[Executor] = None,
+        throttle: Optional[Callable[[int], Any]] = None,
+    ):
+        """Download the last image, decoding it while it streams in.
+
+        The server is offered gzip and deflate, plus brotli and zstd when the
+        optional brotli and zstandard packages are installed. Compressed bodies are
+        decompressed chunk by chunk and passed straight to the image decoder. The
+        transfer statistics are stored in last_download. Requires NumPy.
+
+        Decoding a large JSON image holds the GIL for seconds, stalling the other
+        threads of the process. Given a ProcessPoolExecutor as pool, the body is
+        instead received whole and decoded in a worker process, which returns the
+        array through shared memory, so this thread only waits.
+
+        Args:
+            sink (ImageSink): Receiver of the decoded pixel values, by default an
+                ArraySink returning an array shaped like ImageArray.
+            compression (bool): Whether to ask for compression, compression
+                attribute by default.
+            binary (bool): Whether to ask for the ImageBytes binary format, decoded
+                the same way when the server supports it.
+            chunk_size (int): Bytes read from the network at a time.
+            pool (Executor): Process pool to decode in, None to decode in this
+                thread. A sink then receives the whole image at once.
+            throttle (callable): Called with the size of every chunk received, may
+                sleep to limit the bandwidth.
+
+        Returns:
+            Result of the sink, or the image shaped like ImageArray.
+
+        """
+        _require_numpy()
+        if compression is None:
+            compression = self.compression
+        if pool is None:
+            sink = sink or ArraySink()
+        headers = {"Accept-Encoding": _accept_encoding() if compression else "identity"}
+        if binary:
+            headers["Accept"] = "application/imagebytes, application/json"
+        start = time.perf_counter()
+        response = self._request("GET", "imagearray", {}, headers=headers, stream=True)
+        try:
+            if response.status_code in (400, 500):
+                if self.recorder is not None:
+                    self.recorder.record(self, "GET", "imagearray", {}, response, start)
+                raise ErrorMessage(response.text)
+            encoding = response.headers.get("Content-Encoding", "identity").lower()
+            imagebytes = response.headers.get("Content-Type", "").startswith(
+                "application/imagebytes"
+            )
+            chunks = _CountedChunks(
+                response.raw.stream(chunk_size, decode_content=False),
+                throttle,
+                self.recorder is not None,
+            )
+            try:
+                if pool is None:
+                    decoding = _decode_chunks(chunks, encoding, imagebytes, sink)
+                    result, shape, decoded, decompress_cpu, decode_cpu = decoding
+                    wire = chunks.bytes
+                else:
+                    body = b"".join(chunks)
+                    wire = len(body)
+                    future = pool.submit(_decode_shared, body, encoding, imagebytes)
+                    try:
+                        decoding = future.result()
+                        name, shape, dtype = decoding[:3]
+                        result = _shared_arrays.attach(name, shape, dtype)
+                    except BaseException:
+                        future.add_done_callback(_discard_shared)
+                        raise
+                    decoded, decompress_cpu, decode_cpu = decoding[3:]
+                    if sink is not None:
+                        sink.begin(shape, result.dtype)
+                        sink.write(result.reshape(-1))
+                        result = sink.end(shape)
+            finally:
+                if self.recorder is not None:
+                    body = b"".join(chunks.kept)
+                    self.recorder.record(
+                        self, "GET", "imagearray", {}, response, start, body=body
+                    )
+        finally:
+            response.close()
+        self.last_download = DownloadReport(
+            encoding,
+            wire,
+            decoded,
+            time.perf_counter() - start,
+            decompress_cpu,
+            decode_cpu,
+            shape,
+        )
+        if self.tracer is not None:
+            elapsed = self.last_download.elapsed
+            self.tracer.trace(self, "GET", "imagearray", elapsed, wire)
+        return result
+
+    def download_shared(
+        self, binary: bool = True, metadata: bool = True
+    ) -> "SharedFrameBuffer":
+        """Download the last image into shared memory for other processes.
+
+        Pass the descriptors returned by share on the result to the processes that
+        analyse the frame, they attach to it without copying. Requires NumPy.
+
+        Args:
+            binary (bool): Request the ImageBytes transfer format, which lets the
+                values be written into shared memory as they arrive.
+            metadata (bool): Store LastExposureStartTime, LastExposureDuration,
+                BinX, BinY, StartX and StartY with the frame.
+
+        Returns:
+            SharedFrameBuffer holding the image shaped like ImageArray.
+
+        """
+        values = {}
+        if metadata:
+            values = self.read_all(
+                [
+                    "LastExposureStartTime",
+                    "LastExposureDuration",
+                    "BinX",
+                    "BinY",
+                    "StartX",
+                    "StartY",
+                ]
+            )
+            values = {
+                name: value
+                for name, value in values.items()
+                if not isinstance(value, Exception)
+            }
+        return self.download_image(SharedFrameSink(values), binary=binary)
+
+    def image_statistics(
+        self,
+        histogram: Optional["Histogram"] = None,
+        keep: bool = False,
+        binary: bool = False,
+    ) -> "ImageStatistics":
+        """Download the image and compute its statistics as it streams in.
+
+        Pixels at or above the cached MaxADU count as saturated. Requires NumPy.
+
+        Args:
+            histogram (Histogram): Histogram to add the values to.
+            keep (bool): Also keep the image, returned as the image field.
+            binary (bool): Request the ImageBytes transfer format.
+
+        Returns:
+            ImageStatistics of the image.
+
+        """
+        sink = StatisticsSink(self._get_static("maxadu"), histogram, keep)
+        return self.download_image(sink, binary=binary)
+
+    def preview(
+        self,
+        factor: int = 4,
+        mode: str = "sum",
+        stretch: bool = True,
+        binary: bool = False,
+    ):
+        """Download a software binned preview of the image.
+
+        The image is binned while it streams in, so the full resolution array is
+        never built. Requires NumPy.
+
+        Args:
+            factor (int): Number of pixels binned along each axis.
+            mode (str): sum, mean, or stride to keep one pixel per bin.
+            stretch (bool): Stretch the preview to 8 bits.
+            binary (bool): Request the ImageBytes transfer format.
+
+        Returns:
+            Preview shaped like ImageArray.
+
+        """
+        return self.download_image(PreviewSink(factor, mode, stretch), binary=binary)
+
+    def demosaic(self, image=None, method: str = "bilinear"):
+        """Convert a raw colour image to RGB.
+
+        Uses the cached SensorType, BayerOffsetX and BayerOffsetY of the camera and
+        the current StartX and StartY, so subframes keep the right colour phase.
+        Requires NumPy.
+
+        Args:
+            image (ndarray): Image shaped like ImageArray, downloaded with
+                download_image if not given.
+            method (str): bilinear, or mhc for the gradient corrected Malvar-He-Cutler
+                interpolation.
+
+        Returns:
+            Float32 array of shape (NumY, NumX, 3).
+
+        """
+        if image is None:
+            image = self.download_image()
+        return demosaic(
+            image,
+            self._get_static("sensortype"),
+            self._get_static("bayeroffsetx") - self.StartX,
+            self._get_static("bayeroffsety") - self.StartY,
+            method,
+        )
+
 
 class FilterWheel(Device):
     """Filter wheel specific methods."""
@@ -1213,10 +1906,100 @@ class FilterWheel(Device):
         """
         self._put("position", Position=Position)
 
+    def change_filter(
+        self,
+        name: Union[str, int],
+        focuser: Optional["Focuser"] = None,
+        concurrent: bool = True,
+        timeout: Optional[float] = 60.0,
+        interval: float = 0.1,
+    ) -> "PlanReport":
+        """Select a filter and move the focuser by the difference of focus offsets.
+
+        Names and FocusOffsets are cached until the wheel is reconnected, so a
+        change costs only the moves and their completion polls. The focuser starts
+        moving together with the wheel unless concurrent is False, which is needed
+        when both share a controller that cannot move them at the same time.
+
+        Args:
+            name (str or int): Filter name, matched ignoring case, or position.
+            focuser (Focuser): Focuser to compensate, None to only change filter.
+            concurrent (bool): Move the focuser while the wheel turns.
+            timeout (float): Seconds to wait for each device to finish.
+            interval (float): Seconds between completion polls.
+
+        Returns:
+            PlanReport with the timing of the filter and focus moves.
+
+        Raises:
+            ValueError: If the filter name is unknown.
+            TimeoutError: If a device does not finish within timeout.
+
+        """
+        names = self._get_static("names")
+        if isinstance(name, str):
+            folded = [n.casefold() for n in names]
+            if name.casefold() not in folded:
+                raise ValueError("Unknown filter %r, not in %s" % (name, names))
+            Position = folded.index(name.casefold())
+        else:
+            Position = name
+        plan = OperationPlan(interval)
+        current = self.Position
+        if current == -1:
+            wait_until(lambda: self.Position != -1, timeout, interval)
+            current = self.Position
+        if current != Position:
+            plan.filter(self, Position, timeout=timeout)
+        offsets = self._get_static("focusoffsets") if focuser is not None else []
+        delta = offsets[Position] - offsets[current] if offsets else 0
+        if delta:
+            if focuser._get_static("absolute"):
+                target = focuser.Position + delta
+            else:
+                target = delta
+            depends = () if concurrent or not plan.operations else ("filter",)
+            plan.focus(focuser, target, depends=depends, timeout=timeout)
+        report = plan.run()
+        for result in report.results.values():
+            if result.error is not None:
+                raise result.error
+        return report
+
 
 class Telescope(Device):
     """Telescope specific methods."""
 
+    priorities = {
+        "abortslew": PRIORITY_SAFETY,
+        "park": PRIORITY_SAFETY,
+    }
+    unqueued = frozenset({"pulseguide"})
+    # Commands after which a PositionModel of the telescope re-syncs.
+    _moves = frozenset(
+        {
+            "abortslew",
+            "declinationrate",
+            "findhome",
+            "moveaxis",
+            "park",
+            "rightascensionrate",
+            "sideofpier",
+            "slewtoaltaz",
+            "slewtoaltazasync",
+            "slewtocoordinates",
+            "slewtocoordinatesasync",
+            "slewtotarget",
+            "slewtotargetasync",
+            "synctoaltaz",
+            "synctocoordinates",
+            "synctotarget",
+            "tracking",
+            "trackingrate",
+            "unpark",
+        }
+    )
+
     def __init__(
         self,
         address: str,
@@ -1226,6 +2009,9 @@ class Telescope(Device):
     ):
         """Initialize Telescope object."""
         super().__init__(address, "telescope", device_number, protocall, api_version)
+        self._pier_cache: Dict[tuple, tuple] = {}
+        # time.perf_counter() value after the last of _moves, shared with copies.
+        self._moved = [0.0]
 
     @property
     def AlignmentMode(self) -> int:
@@ -1990,10 +2776,110 @@ class Telescope(Device):
         """Unpark the mount."""
         self._put("unpark")
 
+    def destination_side_of_pier_many(
+        self, targets, quantum: float = 0.25, max_workers: int = 8
+    ) -> List[int]:
+        """Ask the mount for the destination side of pier of many targets at once.
+
+        Targets are quantized to cells of the given size and each distinct cell is
+        sent to the server once, concurrently with a bounded worker pool. Answers are
+        memoized per cell until the sidereal clock has moved by one cell, after which
+        the hour angle of the cell has changed and the mount is asked again, or until
+        Connected is set.
+
+        Args:
+            targets (iterable): (RightAscension, Declination) pairs in hours and
+                degrees.
+            quantum (float): Cell size in degrees on both axes.
+            max_workers (int): Maximum number of concurrent requests.
+
+        Returns:
+            Pointing state for each target, 0 = pierEast, 1 = pierWest,
+            -1 = pierUnknown.
+
+        """
+        targets = [(float(ra), float(dec)) for ra, dec in targets]
+        keys = [
+            (quantum, round(ra * 15 / quantum), round(dec / quantum))
+            for ra, dec in targets
+        ]
+        now = time.monotonic()
+        pending = {}
+        for key, target in zip(keys, targets):
+            cached = self._pier_cache.get(key)
+            if key not in pending and (cached is None or cached[1] <= now):
+                pending[key] = target
+        if pending:
+            for key, cached in list(self._pier_cache.items()):
+                if cached[1] <= now:
+                    del self._pier_cache[key]
+            ttl = quantum / 15.0 * 3600.0 / SIDEREAL_RATE
+            with ThreadPoolExecutor(min(max_workers, len(pending))) as executor:
+                answers = executor.map(
+                    lambda t: self.DestinationSideOfPier(*t), pending.values()
+                )
+                for key, answer in zip(pending, answers):
+                    self._pier_cache[key] = (answer, now + ttl)
+        return [self._pier_cache[key][0] for key in keys]
+
+    def axis_rates_many(self, axes=(0, 1, 2), max_workers: int = 3) -> Dict[int, Any]:
+        """Return the AxisRates of several axes, cached for the current connection.
+
+        Args:
+            axes (iterable): Axes to query, 0 = axisPrimary, 1 = axisSecondary,
+                2 = axisTertiary.
+            max_workers (int): Maximum number of concurrent requests.
+
+        Returns:
+            Mapping of axis to its rates.
+
+        """
+        return self._get_static_many("axisrates", axes, max_workers)
+
+    def can_move_axis_many(
+        self, axes=(0, 1, 2), max_workers: int = 3
+    ) -> Dict[int, bool]:
+        """Return CanMoveAxis for several axes, cached for the current connection.
+
+        Args:
+            axes (iterable): Axes to query, 0 = axisPrimary, 1 = axisSecondary,
+                2 = axisTertiary.
+            max_workers (int): Maximum number of concurrent requests.
+
+        Returns:
+            Mapping of axis to whether the telescope can move it.
+
+        """
+        return self._get_static_many("canmoveaxis", axes, max_workers)
+
+    def _get_static_many(self, attribute: str, axes, max_workers: int) -> Dict:
+        """Get a per-axis static attribute for several axes concurrently."""
+        axes = list(axes)
+        with ThreadPoolExecutor(max(1, min(max_workers, len(axes)))) as executor:
+            values = executor.map(
+                lambda axis: self._get_static(attribute, Axis=axis), axes
+            )
+            return dict(zip(axes, values))
+
+    def _forget(self):
+        """Clear the values cached for the current connection."""
+        super()._forget()
+        self._pier_cache.clear()
+
+    def _put(self, attribute: str, **data):
+        """Send a PUT request and note commands that move the mount."""
+        try:
+            return super()._put(attribute, **data)
+        finally:
+            if attribute in self._moves:
+                self._moved[0] = time.perf_counter()
+
 
 class Rotator(Device):
     """Rotator specific methods."""
 
+    priorities = {"halt": PRIORITY_SAFETY}
+
     def __init__(
         self,
         address: str,
@@ -2045,6 +2931,8 @@ class Rotator(Device):
 class Focuser(Device):
     """Focuser specific methods."""
 
+    priorities = {"halt": PRIORITY_SAFETY}
+
     def __init__(
         self,
         address: str,
@@ -2102,44 +2990,4601 @@ class Focuser(Device):
         self._put("move", Position=Position)
 
 
-class NumericError(Exception):
-    """Exception for when Alpaca throws an error with a numeric value.
+class ObservingConditions(Device):
+    """Observing conditions specific methods.
 
-    Args:
-        ErrorNumber (int): Non-zero integer.
-        ErrorMessage (str): Message describing the issue that was encountered.
+    Attributes:
+        SENSORS (tuple): Names of the sensor properties.
 
     """
 
-    def __init__(self, ErrorNumber: int, ErrorMessage: str):
-        """Initialize NumericError object."""
-        super().__init__(self)
-        self.message = "Error %d: %s" % (ErrorNumber, ErrorMessage)
+    SENSORS = (
+        "CloudCover",
+        "DewPoint",
+        "Humidity",
+        "Pressure",
+        "RainRate",
+        "SkyBrightness",
+        "SkyQuality",
+        "SkyTemperature",
+        "StarFWHM",
+        "Temperature",
+        "WindDirection",
+        "WindGust",
+        "WindSpeed",
+    )
 
-    def __str__(self):
-        """Message to display with error."""
-        return self.message
+    def __init__(
+        self,
+        address: str,
+        device_number: int,
+        protocall: str = "http",
+        api_version: int = DEFAULT_API_VERSION,
+    ):
+        """Initialize ObservingConditions object."""
+        super().__init__(
+            address, "observingconditions", device_number, protocall, api_version
+        )
+        self._readings: Dict[str, tuple] = {}
+        self._unsupported: set = set()
+        self._ageless: set = set()
+        self._snapshot_time: Optional[float] = None
 
+    @property
+    def AveragePeriod(self) -> float:
+        return self._get("averageperiod")
 
-class ErrorMessage(Exception):
-    """Exception for when Alpaca throws an error without a numeric value.
+    @AveragePeriod.setter
+    def AveragePeriod(self, AveragePeriod: float):
+        self._put("averageperiod", AveragePeriod=AveragePeriod)
 
-    Args:
-        Value (str): Message describing the issue that was encountered.
+    @property
+    def CloudCover(self) -> float:
+        return self._get("cloudcover")
 
-    """
+    @property
+    def DewPoint(self) -> float:
+        return self._get("dewpoint")
 
-    def __init__(self, Value: str):
-        """Initialize ErrorMessage object."""
-        super().__init__(self)
-        self.message = Value
+    @property
+    def Humidity(self) -> float:
+        return self._get("humidity")
 
-    def __str__(self):
-        """Message to display with error."""
-        return self.message
+    @property
+    def Pressure(self) -> float:
+        return self._get("pressure")
 
+    @property
+    def RainRate(self) -> float:
+        return self._get("rainrate")
 
-def CreateClient(name):
-    devname = list(typ(val)
-                   for typ, val in zip((str, str, int), name.split('/')))
-    return globals()[devname[0]](*devname[1:])
+    @property
+    def SkyBrightness(self) -> float:
+        return self._get("skybrightness")
+
+    @property
+    def SkyQuality(self) -> float:
+        return self._get("skyquality")
+
+    @property
+    def SkyTemperature(self) -> float:
+        return self._get("skytemperature")
+
+    @property
+    def StarFWHM(self) -> float:
+        return self._get("starfwhm")
+
+    @property
+    def Temperature(self) -> float:
+        return self._get("temperature")
+
+    @property
+    def WindDirection(self) -> float:
+        return self._get("winddirection")
+
+    @property
+    def WindGust(self) -> float:
+        return self._get("windgust")
+
+    @property
+    def WindSpeed(self) -> float:
+        return self._get("windspeed")
+
+    def Refresh(self):
+        self._put("refresh")
+
+    def SensorDescription(self, SensorName: str) -> str:
+        return self._get("sensordescription", SensorName=SensorName)
+
+    def TimeSinceLastUpdate(self, SensorName: str = "") -> float:
+        """Seconds since the sensor was last updated, any sensor for an empty name."""
+        return self._get("timesincelastupdate", SensorName=SensorName)
+
+    def snapshot(self, max_workers: int = 8) -> Dict[str, float]:
+        """Read all implemented sensors concurrently.
+
+        A single TimeSinceLastUpdate call tells whether any sensor updated since the
+        previous snapshot, if none did the cached readings are returned. Otherwise
+        each sensor is checked with its own TimeSinceLastUpdate and only the values
+        updated since they were last read are fetched again. Sensors that are not
+        implemented are skipped from then on.
+
+        Args:
+            max_workers (int): Maximum number of concurrent requests.
+
+        Returns:
+            Sensor values by property name.
+
+        """
+        start = time.monotonic()
+        if self._snapshot_time is not None:
+            age = self._age("")
+            if age is not None and time.monotonic() - age < self._snapshot_time:
+                return self._values()
+        sensors = [name for name in self.SENSORS if name not in self._unsupported]
+        with ThreadPoolExecutor(max(1, min(max_workers, len(sensors)))) as executor:
+            list(executor.map(self._refresh_reading, sensors))
+        self._snapshot_time = start
+        return self._values()
+
+    def _refresh_reading(self, sensor: str):
+        """Read a sensor unless its cached value is still current."""
+        if sensor in self._readings:
+            age = self._age(sensor)
+            if age is not None and time.monotonic() - age < self._readings[sensor][1]:
+                return
+        start = time.monotonic()
+        try:
+            value = getattr(self, sensor)
+        except NumericError as e:
+            if e.ErrorNumber != 0x400:
+                raise
+            self._unsupported.add(sensor)
+            return
+        self._readings[sensor] = (value, start)
+
+    def _age(self, sensor: str) -> Optional[float]:
+        """Return TimeSinceLastUpdate of a sensor, None if the driver lacks it."""
+        if sensor in self._ageless:
+            return None
+        try:
+            return self.TimeSinceLastUpdate(sensor)
+        except NumericError as e:
+            if e.ErrorNumber != 0x400:
+                raise
+            self._ageless.add(sensor)
+            return None
+
+    def _values(self) -> Dict[str, float]:
+        return {name: reading[0] for name, reading in self._readings.items()}
+
+
+class CoverCalibrator(Device):
+    """Cover calibrator specific methods."""
+
+    priorities = {"closecover": PRIORITY_SAFETY, "haltcover": PRIORITY_SAFETY}
+
+    def __init__(
+        self,
+        address: str,
+        device_number: int,
+        protocall: str = "http",
+        api_version: int = DEFAULT_API_VERSION,
+    ):
+        """Initialize CoverCalibrator object."""
+        super().__init__(
+            address, "covercalibrator", device_number, protocall, api_version
+        )
+
+    @property
+    def Brightness(self) -> int:
+        return self._get("brightness")
+
+    @property
+    def CalibratorState(self) -> int:
+        return self._get("calibratorstate")
+
+    @property
+    def CoverState(self) -> int:
+        return self._get("coverstate")
+
+    @property
+    def MaxBrightness(self) -> int:
+        return self._get("maxbrightness")
+
+    def CalibratorOff(self):
+        self._put("calibratoroff")
+
+    def CalibratorOn(self, Brightness: int):
+        self._put("calibratoron", Brightness=Brightness)
+
+    def CloseCover(self):
+        self._put("closecover")
+
+    def HaltCover(self):
+        self._put("haltcover")
+
+    def OpenCover(self):
+        self._put("opencover")
+
+
+def wait_until(
+    condition: Callable[[], bool],
+    timeout: Optional[float] = None,
+    interval: float = 0.1,
+) -> float:
+    """Poll a condition until it holds.
+
+    Args:
+        condition (callable): Function returning True once the wait is over.
+        timeout (float): Seconds to wait before giving up, None to wait forever.
+        interval (float): Seconds to sleep between polls.
+
+    Returns:
+        Seconds spent waiting.
+
+    Raises:
+        TimeoutError: If the condition does not hold within the timeout.
+
+    """
+    start = time.perf_counter()
+    while not condition():
+        elapsed = time.perf_counter() - start
+        if timeout is not None and elapsed >= timeout:
+            raise TimeoutError("Condition not met within %.3f s" % timeout)
+        time.sleep(interval)
+    return time.perf_counter() - start
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """Return the q-th percentile (0 to 100) of values using linear interpolation."""
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    k = (len(ordered) - 1) * q / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+class GuidePulse(NamedTuple):
+    """Timing record of a single guide pulse.
+
+    Attributes:
+        Direction (int): Guide direction, 0 = guideNorth, 1 = guideSouth,
+            2 = guideEast, 3 = guideWest.
+        Duration (int): Requested pulse duration (milliseconds).
+        sent (float): time.perf_counter() value when the command was sent.
+        round_trip (float): Seconds until the PulseGuide command returned.
+        completion (float): Seconds from sending until IsPulseGuiding was False,
+            NaN for pulses that were sent together with a longer one, because
+            IsPulseGuiding only tells when the last pulse has ended.
+
+    """
+
+    Direction: int
+    Duration: int
+    sent: float
+    round_trip: float
+    completion: float
+
+    @property
+    def overrun(self) -> float:
+        """Seconds the pulse finished later than its requested duration, or NaN."""
+        return self.completion - self.Duration / 1000.0
+
+
+class PulseGuider:
+    """Pulse guiding channel with latency and jitter statistics.
+
+    Guide pulses go out over a dedicated, pre-warmed HTTP session owned by the guider,
+    so they never wait for a new connection or for other traffic of the device, and
+    PulseGuide bypasses the command queue of the device, see Device.unqueued, so
+    pulses neither wait for running commands nor for each other. RA and Dec pulses
+    passed to the same guide call are sent concurrently. The round trip of
+    every PulseGuide command and the time until IsPulseGuiding reports completion of
+    the longest pulse of each guide call are kept in a rolling window for statistics.
+
+    Attributes:
+        device (Device): Copy of the Telescope or Camera that uses the guide session.
+        window (int): Number of recent pulses kept for statistics.
+        poll_interval (float): Seconds between IsPulseGuiding polls.
+        timeout (float): Seconds to wait for completion beyond the pulse duration.
+
+    """
+
+    def __init__(
+        self,
+        device: Device,
+        window: int = 200,
+        poll_interval: float = 0.01,
+        timeout: float = 5.0,
+    ):
+        """Initialize PulseGuider object and warm up its connections."""
+        self.device = device.with_session(2)
+        self.window = window
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._pulses: List[GuidePulse] = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(2, thread_name_prefix="pulseguide")
+        self.warm()
+
+    def warm(self):
+        """Open both guide connections with cheap IsPulseGuiding reads."""
+        list(self._executor.map(lambda _: self.device.IsPulseGuiding, range(2)))
+
+    def close(self):
+        """Shut down the guide session and its worker threads."""
+        self._executor.shutdown()
+        self.device.session.close()
+
+    def pulse(self, Direction: int, Duration: int) -> GuidePulse:
+        """Send one guide pulse and wait for it to complete.
+
+        Args:
+            Direction (int): Direction in which the guide-rate motion is to be made.
+            Duration (int): Duration of the guide-rate motion (milliseconds).
+
+        Returns:
+            Timing record of the pulse.
+
+        """
+        return self.guide((Direction, Duration))[0]
+
+    def guide(self, *pulses) -> List[GuidePulse]:
+        """Send guide pulses concurrently and wait until all of them complete.
+
+        Args:
+            *pulses: (Direction, Duration) tuples, typically one RA and one Dec pulse.
+
+        Returns:
+            Timing record of each pulse, in the order given, empty if no pulses are
+            given.
+
+        """
+        if not pulses:
+            return []
+        sent = list(self._executor.map(lambda p: self._send(*p), pulses))
+        first = min(s for s, _ in sent)
+        longest = max(d for _, d in pulses) / 1000.0
+        remaining = first + longest - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        wait_until(
+            lambda: not self.device.IsPulseGuiding,
+            self.timeout,
+            self.poll_interval,
+        )
+        done = time.perf_counter()
+        timed = max(range(len(pulses)), key=lambda i: pulses[i][1])
+        records = [
+            GuidePulse(
+                direction,
+                duration,
+                start,
+                round_trip,
+                done - start if i == timed else float("nan"),
+            )
+            for i, ((direction, duration), (start, round_trip)) in enumerate(
+                zip(pulses, sent)
+            )
+        ]
+        with self._lock:
+            self._pulses.extend(records)
+            del self._pulses[: -self.window]
+        return records
+
+    def _send(self, Direction: int, Duration: int):
+        """Send a PulseGuide command and return its send time and round trip."""
+        start = time.perf_counter()
+        self.device.PulseGuide(Direction, Duration)
+        return start, time.perf_counter() - start
+
+    @property
+    def pulses(self) -> List[GuidePulse]:
+        """Recent guide pulses, oldest first."""
+        with self._lock:
+            return list(self._pulses)
+
+    def stats(self) -> Dict[str, float]:
+        """Summarize the recent guide pulses.
+
+        Returns:
+            Dictionary with the pulse count, round trip latency mean, p50, p95 and
+            max, jitter (standard deviation of the round trip), and mean and p95 of
+            the completion overrun of the pulses whose completion was measured, all
+            in seconds.
+
+        """
+        pulses = self.pulses
+        round_trips = [p.round_trip for p in pulses]
+        overruns = [p.overrun for p in pulses if not math.isnan(p.completion)]
+        return {
+            "count": len(pulses),
+            "latency_mean": statistics.fmean(round_trips) if pulses else float("nan"),
+            "latency_p50": _percentile(round_trips, 50),
+            "latency_p95": _percentile(round_trips, 95),
+            "latency_max": max(round_trips, default=float("nan")),
+            "jitter": statistics.pstdev(round_trips) if pulses else float("nan"),
+            "overrun_mean": statistics.fmean(overruns) if overruns else float("nan"),
+            "overrun_p95": _percentile(overruns, 95),
+        }
+
+
+def _equatorial_to_horizontal(HourAngle: float, Declination: float, Latitude: float):
+    """Convert hour angle (hours) and declination (degrees) to altitude and azimuth.
+
+    Returns:
+        Tuple of altitude and azimuth in degrees, azimuth North-referenced and
+        positive East.
+
+    """
+    ha = math.radians(HourAngle * 15.0)
+    dec = math.radians(Declination)
+    lat = math.radians(Latitude)
+    sin_alt = math.sin(dec) * math.sin(lat)
+    sin_alt += math.cos(dec) * math.cos(lat) * math.cos(ha)
+    alt = math.asin(max(-1.0, min(1.0, sin_alt)))
+    az = math.atan2(
+        -math.cos(dec) * math.sin(ha),
+        math.sin(dec) * math.cos(lat) - math.cos(dec) * math.sin(lat) * math.cos(ha),
+    )
+    return math.degrees(alt), math.degrees(az) % 360.0
+
+
+def _separation(ra1: float, dec1: float, ra2: float, dec2: float) -> float:
+    """Return the angle in degrees between two equatorial positions (RA in hours)."""
+    d1, d2 = math.radians(dec1), math.radians(dec2)
+    dra = math.radians((ra1 - ra2) * 15.0)
+    cos_sep = math.sin(d1) * math.sin(d2) + math.cos(d1) * math.cos(d2) * math.cos(dra)
+    return math.degrees(math.acos(max(-1.0, min(1.0, cos_sep))))
+
+
+class TelescopePosition(NamedTuple):
+    """Telescope coordinates reported by a PositionModel.
+
+    Attributes:
+        RightAscension (float): Right ascension (hours).
+        Declination (float): Declination (degrees).
+        Altitude (float): Altitude (degrees).
+        Azimuth (float): Azimuth (degrees, North-referenced, positive East).
+        SiderealTime (float): Local apparent sidereal time (hours).
+        age (float): Seconds since the last authoritative read.
+        error (float): Estimated bound of the extrapolation error (degrees),
+            infinite until the drift of the model has been measured.
+
+    """
+
+    RightAscension: float
+    Declination: float
+    Altitude: float
+    Azimuth: float
+    SiderealTime: float
+    age: float
+    error: float
+
+
+class PositionModel:
+    """Extrapolate telescope coordinates between occasional authoritative reads.
+
+    Each sync reads the coordinates and sidereal time from the mount concurrently,
+    so they refer to nearly the same moment, and then the tracking state. In
+    between, positions are propagated locally from Tracking, TrackingRate,
+    RightAscensionRate and DeclinationRate with the cached site coordinates. The drift
+    between prediction and the next authoritative read is used to bound the
+    extrapolation error: the model re-syncs before the estimated error exceeds
+    drift_threshold, at least every max_age seconds, and every slew_interval seconds
+    while the mount is slewing. Slews, moves, syncs and tracking changes commanded
+    through the telescope or its copies force a re-sync. Until the drift has been
+    measured by a second read the error bound of extrapolated positions is
+    infinite.
+
+    Attributes:
+        telescope (Telescope): Telescope to model.
+        max_age (float): Maximum seconds between authoritative reads.
+        drift_threshold (float): Maximum tolerated extrapolation error (degrees).
+        slew_interval (float): Seconds between authoritative reads while slewing.
+        drift_rate (float): Observed extrapolation drift (degrees per second).
+
+    """
+
+    def __init__(
+        self,
+        telescope: "Telescope",
+        max_age: float = 10.0,
+        drift_threshold: float = 0.01,
+        slew_interval: float = 0.5,
+    ):
+        """Initialize PositionModel object."""
+        self.telescope = telescope
+        self.max_age = max_age
+        self.drift_threshold = drift_threshold
+        self.slew_interval = slew_interval
+        self.drift_rate = 0.0
+        self._measured = False
+        self._lock = threading.RLock()
+        self._synced: Optional[float] = None
+        self._state: Dict[str, Any] = {}
+
+    @property
+    def synced(self) -> Optional[float]:
+        """time.perf_counter() value of the last authoritative read, None if due."""
+        return self._synced
+
+    @property
+    def slewing(self) -> bool:
+        """Slewing as reported by the last authoritative read."""
+        return bool(self._state.get("Slewing"))
+
+    def invalidate(self):
+        """Force an authoritative read on the next position request."""
+        with self._lock:
+            self._synced = None
+
+    def sync(self) -> TelescopePosition:
+        """Read the telescope state from the mount and restart extrapolation."""
+        with self._lock:
+            before = time.perf_counter()
+            state = self._read(
+                ["RightAscension", "Declination", "Altitude", "Azimuth", "SiderealTime"]
+            )
+            now = (before + time.perf_counter()) / 2.0
+            state.update(
+                self._read(
+                    [
+                        "Slewing",
+                        "Tracking",
+                        "TrackingRate",
+                        "RightAscensionRate",
+                        "DeclinationRate",
+                    ]
+                )
+            )
+            state["SiteLatitude"] = self.telescope._get_static("sitelatitude")
+            if self._synced is not None and not (
+                state["Slewing"] or self._state["Slewing"]
+            ):
+                age = now - self._synced
+                predicted = self._extrapolate(now)
+                drift = _separation(
+                    predicted.RightAscension,
+                    predicted.Declination,
+                    state["RightAscension"],
+                    state["Declination"],
+                )
+                if age > 0:
+                    self.drift_rate = max(drift / age, self.drift_rate / 2.0)
+                    self._measured = True
+            state["HourAngle"] = state["SiderealTime"] - state["RightAscension"]
+            alt, az = _equatorial_to_horizontal(
+                state["HourAngle"], state["Declination"], state["SiteLatitude"]
+            )
+            state["AltitudeOffset"] = state["Altitude"] - alt
+            state["AzimuthOffset"] = (state["Azimuth"] - az + 180.0) % 360.0 - 180.0
+            self._state = state
+            self._synced = now
+            return self._extrapolate(now)
+
+    def _read(self, properties: List[str]) -> Dict[str, Any]:
+        """Read telescope properties concurrently, raising the first error."""
+        values = self.telescope.read_all(properties, len(properties))
+        for value in values.values():
+            if isinstance(value, Exception):
+                raise value
+        return values
+
+    def position(self) -> TelescopePosition:
+        """Return the current telescope position, re-syncing when needed."""
+        with self._lock:
+            now = time.perf_counter()
+            if (
+                self._synced is None
+                or self._synced < self.telescope._moved[0]
+                or now - self._synced >= self._max_age()
+            ):
+                return self.sync()
+            return self._extrapolate(now)
+
+    def _max_age(self) -> float:
+        """Return the age after which the next authoritative read is due."""
+        if self._state["Slewing"]:
+            return self.slew_interval
+        if self.drift_rate > 0:
+            return min(self.max_age, self.drift_threshold / self.drift_rate)
+        return self.max_age
+
+    def _extrapolate(self, now: float) -> TelescopePosition:
+        """Propagate the last synced state to the given time.perf_counter() value."""
+        s = self._state
+        age = now - self._synced
+        lst = (s["SiderealTime"] + age * SIDEREAL_RATE / 3600.0) % 24.0
+        if s["Tracking"]:
+            drive = DRIVE_RATES.get(s["TrackingRate"], DRIVE_RATES[0])
+            ra_rate = (DRIVE_RATES[0] - drive) / 15.0
+            ra_rate += s["RightAscensionRate"] * SIDEREAL_RATE
+            ra = (s["RightAscension"] + age * ra_rate / 3600.0) % 24.0
+            dec = s["Declination"] + age * s["DeclinationRate"] / 3600.0
+            alt, az = _equatorial_to_horizontal(lst - ra, dec, s["SiteLatitude"])
+            alt += s["AltitudeOffset"]
+            az = (az + s["AzimuthOffset"]) % 360.0
+        else:
+            ra = (lst - s["HourAngle"]) % 24.0
+            dec = s["Declination"]
+            alt, az = s["Altitude"], s["Azimuth"]
+        if self._measured or age <= 0:
+            error = self.drift_rate * age
+        else:
+            error = math.inf
+        return TelescopePosition(ra, dec, alt, az, lst, age, error)
+
+
+def _require_numpy():
+    """Raise ImportError if the optional NumPy dependency is missing."""
+    if np is None:
+        raise ImportError("This feature requires NumPy: pip install numpy")
+
+
+def _sidereal_time(when: datetime, Longitude: float) -> float:
+    """Return the local mean sidereal time in hours for a UTC datetime."""
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    days = when.timestamp() / 86400.0 + 2440587.5 - 2451545.0
+    return (18.697374558 + 24.06570982441908 * days + Longitude / 15.0) % 24.0
+
+
+class TargetTable(NamedTuple):
+    """Arrays of predicted target coordinates computed by a TargetPlanner.
+
+    Attributes:
+        HourAngle (ndarray): Hour angle (hours, -12 to +12).
+        Altitude (ndarray): Altitude (degrees).
+        Azimuth (ndarray): Azimuth (degrees, North-referenced, positive East).
+        Airmass (ndarray): Kasten and Young airmass, NaN below the horizon.
+        SideOfPier (ndarray): Predicted pointing state, 0 = pierEast, 1 = pierWest,
+            -1 = pierUnknown for mounts that are not German equatorial.
+
+    """
+
+    HourAngle: Any
+    Altitude: Any
+    Azimuth: Any
+    Airmass: Any
+    SideOfPier: Any
+
+
+class TargetPlanner:
+    """Vectorized local astrometry for lists of targets.
+
+    Converts arrays of equatorial coordinates to hour angle, altitude, azimuth,
+    airmass and predicted side of pier in one call, using the cached SiteLatitude,
+    SiteLongitude and AlignmentMode of the telescope and its SiderealTime. Only
+    spot_check talks to the mount for individual targets. Requires NumPy.
+
+    Attributes:
+        telescope (Telescope): Telescope whose site and clock are used.
+
+    """
+
+    def __init__(self, telescope: "Telescope"):
+        """Initialize TargetPlanner object."""
+        _require_numpy()
+        self.telescope = telescope
+        self._lst: Optional[float] = None
+        self._lst_read = 0.0
+
+    def refresh(self):
+        """Read the mount's sidereal time again on the next computation."""
+        self._lst = None
+
+    def sidereal_time(self, when: Optional[datetime] = None) -> float:
+        """Return the local sidereal time in hours.
+
+        Args:
+            when (datetime): UTC time to compute the sidereal time for from the site
+                longitude. By default the mount's SiderealTime is read once and
+                extrapolated with the local clock.
+
+        """
+        if when is not None:
+            return _sidereal_time(when, self.telescope._get_static("sitelongitude"))
+        if self._lst is None:
+            self._lst = self.telescope.SiderealTime
+            self._lst_read = time.perf_counter()
+        elapsed = time.perf_counter() - self._lst_read
+        return (self._lst + elapsed * SIDEREAL_RATE / 3600.0) % 24.0
+
+    def compute(
+        self, RightAscension, Declination, when: Optional[datetime] = None
+    ) -> TargetTable:
+        """Compute local coordinates for arrays of targets.
+
+        Args:
+            RightAscension (array_like): Right ascension coordinates (hours).
+            Declination (array_like): Declination coordinates (degrees).
+            when (datetime): UTC time of the prediction, now by default.
+
+        Returns:
+            Arrays of hour angle, altitude, azimuth, airmass and side of pier.
+
+        """
+        ra = np.asarray(RightAscension, dtype=float)
+        dec = np.radians(np.asarray(Declination, dtype=float))
+        lat = math.radians(self.telescope._get_static("sitelatitude"))
+        ha = (self.sidereal_time(when) - ra + 12.0) % 24.0 - 12.0
+        h = np.radians(ha * 15.0)
+        sin_alt = np.sin(dec) * math.sin(lat) + np.cos(dec) * math.cos(lat) * np.cos(h)
+        alt = np.degrees(np.arcsin(np.clip(sin_alt, -1.0, 1.0)))
+        az = np.degrees(
+            np.arctan2(
+                -np.cos(dec) * np.sin(h),
+                np.sin(dec) * math.cos(lat) - np.cos(dec) * math.sin(lat) * np.cos(h),
+            )
+        ) % 360.0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            airmass = 1.0 / (
+                np.sin(np.radians(alt)) + 0.50572 * (alt + 6.07995) ** -1.6364
+            )
+        airmass = np.where(alt > 0.0, airmass, np.nan)
+        if self.telescope._get_static("alignmentmode") == 2:
+            pier = np.where(ha >= 0.0, 0, 1)
+        else:
+            pier = np.full(ha.shape, -1)
+        return TargetTable(ha, alt, az, airmass, pier)
+
+    def spot_check(
+        self, RightAscension, Declination, samples: int = 3
+    ) -> Dict[int, int]:
+        """Compare predicted side of pier with DestinationSideOfPier for a few targets.
+
+        Args:
+            RightAscension (array_like): Right ascension coordinates (hours).
+            Declination (array_like): Declination coordinates (degrees).
+            samples (int): Number of evenly spaced targets to ask the mount about.
+
+        Returns:
+            Mapping of target index to the side of pier reported by the mount, for the
+            checked targets whose prediction disagrees with the mount.
+
+        """
+        ra = np.atleast_1d(np.asarray(RightAscension, dtype=float))
+        dec = np.atleast_1d(np.asarray(Declination, dtype=float))
+        predicted = self.compute(ra, dec).SideOfPier
+        mismatches = {}
+        for i in np.unique(np.linspace(0, len(ra) - 1, samples).astype(int)):
+            reported = self.telescope.DestinationSideOfPier(float(ra[i]), float(dec[i]))
+            if reported != predicted[i]:
+                mismatches[int(i)] = reported
+        return mismatches
+
+
+def dome_azimuth(
+    HourAngle,
+    Declination,
+    Latitude: float,
+    radius: float,
+    offset=(0.0, 0.0, 0.0),
+    gem_offset: float = 0.0,
+    SideOfPier=0,
+):
+    """Compute the dome azimuth that clears the telescope's optical axis.
+
+    The optical axis starts at the mount pivot, displaced from the dome centre by
+    offset, and for German equatorial mounts further displaced by gem_offset along
+    the declination axis on the side given by SideOfPier. The returned azimuth is
+    where that axis meets the dome sphere. All arguments except Latitude, radius
+    and offset may be NumPy arrays.
+
+    Args:
+        HourAngle (array_like): Hour angle of the telescope (hours).
+        Declination (array_like): Declination of the telescope (degrees).
+        Latitude (float): Site latitude (degrees).
+        radius (float): Dome radius.
+        offset (tuple): East, North and Up offset of the mount pivot from the dome
+            centre, in the same unit as radius.
+        gem_offset (float): Distance between the declination axis pivot and the
+            optical axis, in the same unit as radius.
+        SideOfPier (array_like): Pointing state, 0 = pierEast, 1 = pierWest.
+
+    Returns:
+        Dome azimuth in degrees, North-referenced and positive East.
+
+    """
+    _require_numpy()
+    h = np.radians(np.asarray(HourAngle, dtype=float) * 15.0)
+    dec = np.radians(np.asarray(Declination, dtype=float))
+    lat = math.radians(Latitude)
+    # Pointing direction in East, North, Up coordinates.
+    east = -np.cos(dec) * np.sin(h)
+    north = np.sin(dec) * math.cos(lat) - np.cos(dec) * math.sin(lat) * np.cos(h)
+    up = np.sin(dec) * math.sin(lat) + np.cos(dec) * math.cos(lat) * np.cos(h)
+    pointing = np.stack(np.broadcast_arrays(east, north, up), axis=-1)
+    pole = np.array([0.0, math.cos(lat), math.sin(lat)])
+    origin = np.asarray(offset, dtype=float) + np.zeros_like(pointing)
+    if gem_offset:
+        axis = np.cross(pole, pointing)
+        axis /= np.linalg.norm(axis, axis=-1, keepdims=True)
+        sign = np.where(np.asarray(SideOfPier) == 1, -1.0, 1.0)[..., None]
+        origin = origin + sign * gem_offset * axis
+    b = np.sum(origin * pointing, axis=-1)
+    c = np.sum(origin * origin, axis=-1) - radius**2
+    distance = -b + np.sqrt(b * b - c)
+    point = origin + distance[..., None] * pointing
+    return np.degrees(np.arctan2(point[..., 0], point[..., 1])) % 360.0
+
+
+class DomeSlaver:
+    """Client-side dome slaving with a hysteresis band.
+
+    The telescope position comes from a PositionModel, so slaving adds little
+    telescope traffic. The required dome azimuth is computed with dome_azimuth and
+    Dome.SlewToAzimuth is only sent when it differs from the last commanded azimuth by
+    more than the hysteresis band. slew_telescope starts the dome towards the target
+    azimuth together with SlewToCoordinatesAsync, and the dome keeps that azimuth
+    until the slew has ended. Updates while the mount is slewing never move the
+    dome.
+
+    Attributes:
+        dome (Dome): Dome to drive.
+        telescope (Telescope): Telescope to follow.
+        radius (float): Dome radius.
+        offset (tuple): East, North and Up offset of the mount pivot from the dome
+            centre, in the same unit as radius.
+        gem_offset (float): Distance between the declination axis pivot and the
+            optical axis, in the same unit as radius.
+        hysteresis (float): Slit error in degrees tolerated before the dome is moved.
+        interval (float): Seconds between updates of the background thread.
+        model (PositionModel): Model used to read the telescope position.
+        commands (int): Number of SlewToAzimuth commands sent.
+        error (Exception): Error of the last update of the background thread, None
+            if it succeeded.
+
+    """
+
+    def __init__(
+        self,
+        dome: "Dome",
+        telescope: "Telescope",
+        radius: float,
+        offset=(0.0, 0.0, 0.0),
+        gem_offset: float = 0.0,
+        hysteresis: float = 3.0,
+        interval: float = 1.0,
+        model: Optional[PositionModel] = None,
+    ):
+        """Initialize DomeSlaver object."""
+        _require_numpy()
+        self.dome = dome
+        self.telescope = telescope
+        self.radius = radius
+        self.offset = offset
+        self.gem_offset = gem_offset
+        self.hysteresis = hysteresis
+        self.interval = interval
+        self.model = model or PositionModel(telescope)
+        self.commands = 0
+        self.error: Optional[Exception] = None
+        self._target: Optional[float] = None
+        self._pier = 0
+        self._pier_synced: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def azimuths(self, RightAscension, Declination, SiderealTime, SideOfPier=0):
+        """Precompute dome azimuths for arrays of telescope positions.
+
+        Args:
+            RightAscension (array_like): Right ascension (hours).
+            Declination (array_like): Declination (degrees).
+            SiderealTime (array_like): Local sidereal time of each position (hours).
+            SideOfPier (array_like): Pointing state, 0 = pierEast, 1 = pierWest.
+
+        Returns:
+            Dome azimuths in degrees.
+
+        """
+        return dome_azimuth(
+            np.asarray(SiderealTime, dtype=float) - RightAscension,
+            Declination,
+            self.telescope._get_static("sitelatitude"),
+            self.radius,
+            self.offset,
+            self.gem_offset,
+            SideOfPier,
+        )
+
+    def update(self) -> float:
+        """Move the dome if the slit error exceeds the hysteresis band.
+
+        Returns:
+            Slit error in degrees before any correction.
+
+        """
+        with self._lock:
+            position = self.model.position()
+            if self.gem_offset and self.model.synced != self._pier_synced:
+                self._pier = self.telescope.SideOfPier
+                self._pier_synced = self.model.synced
+            required = float(
+                self.azimuths(
+                    position.RightAscension,
+                    position.Declination,
+                    position.SiderealTime,
+                    self._pier,
+                )
+            )
+            if self.model.slewing and self._target is not None:
+                return (required - self._target + 180.0) % 360.0 - 180.0
+            return self._follow(required)
+
+    def slew_telescope(self, RightAscension: float, Declination: float) -> float:
+        """Slew the telescope asynchronously and pre-position the dome for the target.
+
+        Args:
+            RightAscension (float): Right Ascension coordinate (hours).
+            Declination (float): Declination coordinate (degrees).
+
+        Returns:
+            Dome azimuth commanded for the target.
+
+        """
+        with self._lock:
+            pier = 0
+            if self.gem_offset:
+                pier = self.telescope.DestinationSideOfPier(RightAscension, Declination)
+            required = float(
+                self.azimuths(
+                    RightAscension,
+                    Declination,
+                    self.model.position().SiderealTime,
+                    pier,
+                )
+            )
+            self._slew_dome(required)
+            self.telescope.SlewToCoordinatesAsync(RightAscension, Declination)
+            # The next update reads Slewing after the slew has started.
+            self.model.invalidate()
+            return required
+
+    def start(self):
+        """Start updating the dome from a background thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="domeslaver", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """Update the dome every interval until stopped."""
+        while not self._stop.is_set():
+            try:
+                self.update()
+                self.error = None
+            except Exception as e:
+                if self.error is None:
+                    _log.warning("Dome slaving update failed: %s", e)
+                self.error = e
+            self._stop.wait(self.interval)
+
+    def _follow(self, required: float) -> float:
+        """Command the dome to the required azimuth if outside the hysteresis band."""
+        if self._target is None:
+            self._target = self.dome.Azimuth
+        error = (required - self._target + 180.0) % 360.0 - 180.0
+        if abs(error) > self.hysteresis:
+            self._slew_dome(required)
+        return error
+
+    def _slew_dome(self, Azimuth: float):
+        """Send SlewToAzimuth and remember the commanded azimuth."""
+        self.dome.SlewToAzimuth(Azimuth)
+        self._target = Azimuth
+        self.commands += 1
+
+
+class Subscription:
+    """Callback registered with a PropertyPoller.
+
+    Attributes:
+        property (str): Name of the watched property.
+        callback (callable): Called as callback(property, old, new).
+        deadband (float): Minimum numeric change that triggers the callback.
+        on_error (callable): Called as on_error(property, error) when reading the
+            property starts failing, or None.
+        value: Value passed to the callback most recently, or the first polled value.
+
+    """
+
+    _unset = object()
+
+    def __init__(self, poller, watch, callback, deadband, on_error=None):
+        """Initialize Subscription object."""
+        self.property = watch.property
+        self.callback = callback
+        self.deadband = deadband
+        self.on_error = on_error
+        self.value = self._unset
+        self._poller = poller
+        self._watch = watch
+
+    @property
+    def error(self) -> Optional[Exception]:
+        """Error of the last read of the property, None if it succeeded."""
+        return self._watch.error
+
+    def cancel(self):
+        """Stop calling the callback."""
+        self._poller.unsubscribe(self)
+
+    def _changed(self, value) -> bool:
+        """Return whether the value differs from the last notified one."""
+        if self.value is self._unset:
+            return False
+        if self.deadband is not None and isinstance(value, (int, float)):
+            return abs(value - self.value) > self.deadband
+        return value != self.value
+
+
+class _Watch:
+    """Poll state of a single property shared by its subscriptions."""
+
+    def __init__(self, device: Device, property: str):
+        self.device = device
+        self.property = property
+        self.subscriptions: List[Subscription] = []
+        self.interval = float("inf")
+        self.due = 0.0
+        self.busy = False
+        self.error: Optional[Exception] = None
+
+
+class PropertyPoller:
+    """Poll device properties once per property and dispatch changes.
+
+    Each (device, property) pair is polled by a single watch, however many callbacks
+    are registered for it, at the shortest interval requested. Polls run on a small
+    worker pool and callbacks on a separate dispatcher thread, so a slow callback
+    never delays polling. Read errors are passed to the on_error callbacks of the
+    subscriptions when a property that could be read starts failing. A stopped
+    poller has no subscriptions left and starts again on the next subscribe.
+
+    Attributes:
+        max_workers (int): Maximum number of concurrent polls.
+
+    """
+
+    _default: Optional["PropertyPoller"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_workers: int = 4):
+        """Initialize PropertyPoller object."""
+        self.max_workers = max_workers
+        self._watches: Dict[tuple, _Watch] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._events: queue.Queue = queue.Queue()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._threads: List[threading.Thread] = []
+
+    @classmethod
+    def default(cls) -> "PropertyPoller":
+        """Return the poller shared by Device.on_change."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def subscribe(
+        self,
+        device: Device,
+        property: str,
+        callback: Callable[[str, Any, Any], None],
+        interval: float = 1.0,
+        deadband: Optional[float] = None,
+        on_error: Optional[Callable[[str, Exception], None]] = None,
+    ) -> Subscription:
+        """Register a callback for changes of a device property.
+
+        Args:
+            device (Device): Device to poll.
+            property (str): Property name, e.g. Slewing.
+            callback (callable): Called as callback(property, old, new).
+            interval (float): Seconds between polls of the property.
+            deadband (float): Minimum numeric change that triggers the callback.
+            on_error (callable): Called as on_error(property, error) when reading
+                the property starts failing.
+
+        Returns:
+            Subscription that can be cancelled.
+
+        """
+        key = (device.base_url, property)
+        with self._lock:
+            watch = self._watches.get(key)
+            if watch is None:
+                watch = self._watches[key] = _Watch(device, property)
+            subscription = Subscription(self, watch, callback, deadband, on_error)
+            watch.subscriptions.append(subscription)
+            watch.interval = min(watch.interval, interval)
+            watch.due = 0.0
+            self._start()
+        self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Remove a subscription, dropping its watch when it was the last one."""
+        watch = subscription._watch
+        with self._lock:
+            if subscription in watch.subscriptions:
+                watch.subscriptions.remove(subscription)
+            if not watch.subscriptions:
+                self._watches.pop((watch.device.base_url, watch.property), None)
+
+    def stop(self):
+        """Stop polling and dispatching and drop all subscriptions."""
+        with self._lock:
+            self._watches.clear()
+            threads = self._threads
+        if not threads:
+            return
+        poller, dispatcher = threads
+        self._stopped.set()
+        self._wake.set()
+        poller.join()
+        self._executor.shutdown()
+        self._events.put(None)
+        dispatcher.join()
+        with self._lock:
+            self._threads = []
+            self._executor = None
+            self._stopped.clear()
+
+    def _start(self):
+        """Start the poll and dispatcher threads on first use."""
+        if self._threads:
+            return
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="poll")
+        for target, name in ((self._poll, "poller"), (self._dispatch, "dispatcher")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _poll(self):
+        """Submit due watches to the worker pool until stopped."""
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            with self._lock:
+                watches = list(self._watches.values())
+            wait = 1.0
+            for watch in watches:
+                if watch.busy:
+                    wait = min(wait, watch.interval)
+                    continue
+                if watch.due <= now:
+                    watch.busy = True
+                    watch.due = now + watch.interval
+                    self._executor.submit(self._read, watch)
+                wait = min(wait, watch.due - now)
+            self._wake.wait(max(wait, 0.0))
+            self._wake.clear()
+
+    def _read(self, watch: _Watch):
+        """Read a watched property and queue callbacks for changed subscriptions."""
+        failing = watch.error is not None
+        try:
+            value = getattr(watch.device, watch.property)
+            watch.error = None
+        except Exception as e:
+            watch.error = e
+        finally:
+            watch.busy = False
+        with self._lock:
+            subscriptions = list(watch.subscriptions)
+        if watch.error is not None:
+            if not failing:
+                for subscription in subscriptions:
+                    if subscription.on_error is not None:
+                        self._events.put(
+                            (subscription.on_error, watch.property, watch.error)
+                        )
+            return
+        for subscription in subscriptions:
+            if subscription._changed(value):
+                self._events.put(
+                    (subscription.callback, watch.property, subscription.value, value)
+                )
+                subscription.value = value
+            elif subscription.value is Subscription._unset:
+                subscription.value = value
+
+    def _dispatch(self):
+        """Run queued callbacks until stopped."""
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            callback, *args = event
+            try:
+                callback(*args)
+            except Exception:
+                _log.exception("Callback for %s failed", args[0])
+
+
+class ShutdownStep(NamedTuple):
+    """Action of a shutdown plan run by a SafetyWatchdog.
+
+    Attributes:
+        name (str): Name of the step used in reports.
+        action (callable): Function performing the step.
+        timeout (float): Seconds after detection the step must have finished by.
+
+    """
+
+    name: str
+    action: Callable[[], Any]
+    timeout: float = 60.0
+
+
+class StepResult(NamedTuple):
+    """Outcome of a shutdown step.
+
+    Attributes:
+        name (str): Name of the step.
+        started (float): Seconds from detection until the step started.
+        finished (float): Seconds from detection until the step finished or timed
+            out.
+        error (Exception): Exception raised by the step, TimeoutError if it did not
+            finish in time, None on success.
+
+    """
+
+    name: str
+    started: float
+    finished: float
+    error: Optional[BaseException]
+
+
+class SafetyEvent(NamedTuple):
+    """Audit record of a shutdown triggered by a SafetyWatchdog.
+
+    Attributes:
+        reason (str): Why the shutdown was triggered.
+        time (datetime): UTC time of detection.
+        steps (list): StepResult of every step of the plan.
+
+    """
+
+    reason: str
+    time: datetime
+    steps: List[StepResult]
+
+
+def shutdown_plan(
+    dome: Optional["Dome"] = None,
+    telescope: Optional["Telescope"] = None,
+    camera: Optional["Camera"] = None,
+    timeout: float = 120.0,
+    interval: float = 0.5,
+) -> List[ShutdownStep]:
+    """Build the usual shutdown plan: abort exposure, close shutter and park.
+
+    Each device is used through its own session so the plan does not wait for
+    connections busy with other traffic. The CloseShutter step only finishes once
+    ShutterStatus reports closed and the Park step once AtPark is True, so a step
+    that merely started moving still times out.
+
+    Args:
+        dome (Dome): Dome whose shutter is closed.
+        telescope (Telescope): Telescope to park.
+        camera (Camera): Camera whose exposure is aborted.
+        timeout (float): Timeout in seconds of each step.
+        interval (float): Seconds between polls for the end of a step.
+
+    Returns:
+        List of shutdown steps.
+
+    """
+
+    def until(start, condition):
+        def action():
+            start()
+            wait_until(condition, timeout, interval)
+
+        return action
+
+    steps = []
+    if camera is not None:
+        steps.append(
+            ShutdownStep("AbortExposure", camera.with_session().AbortExposure, timeout)
+        )
+    if dome is not None:
+        dome = dome.with_session()
+        steps.append(
+            ShutdownStep(
+                "CloseShutter",
+                until(dome.CloseShutter, lambda: dome.ShutterStatus == 1),
+                timeout,
+            )
+        )
+    if telescope is not None:
+        telescope = telescope.with_session()
+        steps.append(
+            ShutdownStep(
+                "Park", until(telescope.Park, lambda: telescope.AtPark), timeout
+            )
+        )
+    return steps
+
+
+class SafetyWatchdog:
+    """Poll safety monitors and run a shutdown plan when conditions become unsafe.
+
+    Every monitor is polled over its own session with a short request timeout. When
+    any monitor reports unsafe, or no monitor read has succeeded for contact_timeout
+    seconds, all steps of the plan are started in parallel. Each step must finish
+    within its own timeout counted from detection. A SafetyEvent with the latency of
+    every step is kept for audit. The plan runs once per unsafe episode and the
+    watchdog re-arms when all monitors report safe again.
+
+    Attributes:
+        monitors (list): SafetyMonitor copies used for polling.
+        plan (list): ShutdownStep objects run on an unsafe transition.
+        interval (float): Seconds between polls.
+        contact_timeout (float): Seconds without a successful read of a monitor
+            before contact is considered lost.
+        events (list): SafetyEvent records of triggered shutdowns.
+        on_event (callable): Optional function called with each SafetyEvent.
+
+    """
+
+    def __init__(
+        self,
+        monitors: List["SafetyMonitor"],
+        plan: List[ShutdownStep],
+        interval: float = 0.5,
+        contact_timeout: float = 5.0,
+        request_timeout: float = 2.0,
+        on_event: Optional[Callable[[SafetyEvent], None]] = None,
+    ):
+        """Initialize SafetyWatchdog object."""
+        self.monitors = [monitor.with_session() for monitor in monitors]
+        for monitor in self.monitors:
+            monitor.timeout = request_timeout
+            monitor.freshness = 0.0
+        self.plan = plan
+        self.interval = interval
+        self.contact_timeout = contact_timeout
+        self.on_event = on_event
+        self.events: List[SafetyEvent] = []
+        self._armed = True
+        self._contact = [time.perf_counter()] * len(self.monitors)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(
+            max(1, len(self.monitors)), thread_name_prefix="watchdog"
+        )
+
+    def start(self):
+        """Start polling from a background thread."""
+        self._stop.clear()
+        self._contact = [time.perf_counter()] * len(self.monitors)
+        self._thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def check(self) -> Optional[str]:
+        """Poll all monitors once and trigger the plan if needed.
+
+        Returns:
+            Reason of the triggered shutdown, None if nothing was triggered.
+
+        """
+        results = list(self._executor.map(self._read, range(len(self.monitors))))
+        detected = time.perf_counter()
+        reason = None
+        for i, safe in enumerate(results):
+            if safe is False:
+                reason = "%s reports unsafe" % self.monitors[i].base_url
+            elif safe is None and detected - self._contact[i] >= self.contact_timeout:
+                reason = "contact lost with %s" % self.monitors[i].base_url
+            if reason:
+                break
+        if reason is None:
+            self._armed = self._armed or all(results)
+            return None
+        if not self._armed:
+            return None
+        self._armed = False
+        threading.Thread(
+            target=self._shutdown, args=(reason, detected), name="shutdown", daemon=True
+        ).start()
+        return reason
+
+    def _read(self, i: int) -> Optional[bool]:
+        """Read IsSafe of a monitor, None if it could not be read."""
+        try:
+            safe = self.monitors[i].IsSafe
+        except Exception:
+            return None
+        self._contact[i] = time.perf_counter()
+        return bool(safe)
+
+    def _run(self):
+        """Poll every interval until stopped."""
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            self.check()
+            self._stop.wait(max(0.0, self.interval - (time.perf_counter() - start)))
+
+    def _shutdown(self, reason: str, detected: float):
+        """Run all steps of the plan in parallel and record the outcome."""
+        now = datetime.now(timezone.utc)
+        started = {}
+
+        def run(step):
+            started[step.name] = time.perf_counter() - detected
+            step.action()
+            return time.perf_counter() - detected
+
+        executor = ThreadPoolExecutor(
+            max(1, len(self.plan)), thread_name_prefix="shutdown"
+        )
+        futures = [executor.submit(run, step) for step in self.plan]
+        executor.shutdown(wait=False)
+        results = []
+        for step, future in zip(self.plan, futures):
+            remaining = detected + step.timeout - time.perf_counter()
+            try:
+                finished, error = future.result(max(0.0, remaining)), None
+            except Exception as e:
+                finished, error = time.perf_counter() - detected, e
+            results.append(
+                StepResult(step.name, started.get(step.name, finished), finished, error)
+            )
+        event = SafetyEvent(reason, now, results)
+        self.events.append(event)
+        _log.warning("Safety shutdown after %s", reason)
+        if self.on_event is not None:
+            self.on_event(event)
+
+
+class Operation(NamedTuple):
+    """Device operation of an OperationPlan.
+
+    Attributes:
+        name (str): Unique name of the operation.
+        start (callable): Function starting the operation, usually an asynchronous
+            slew or move.
+        done (callable): Function returning True once the operation has completed,
+            None if start already blocks until completion.
+        depends (tuple): Names of operations that must complete first.
+        timeout (float): Seconds to wait for completion, None to wait forever.
+
+    """
+
+    name: str
+    start: Callable[[], Any]
+    done: Optional[Callable[[], bool]] = None
+    depends: tuple = ()
+    timeout: Optional[float] = None
+
+
+class OperationResult(NamedTuple):
+    """Timing of an operation run by an OperationPlan.
+
+    Attributes:
+        name (str): Name of the operation.
+        started (float): Seconds from the start of the plan until the operation
+            started.
+        finished (float): Seconds from the start of the plan until it completed or
+            failed.
+        error (Exception): Exception raised by the operation or a failed dependency,
+            None on success.
+
+    """
+
+    name: str
+    started: float
+    finished: float
+    error: Optional[BaseException]
+
+
+class PlanReport(NamedTuple):
+    """Outcome of OperationPlan.run.
+
+    Attributes:
+        elapsed (float): Seconds until all operations finished.
+        results (dict): OperationResult of every operation by name.
+        critical_path (list): Names of the chain of operations that determined the
+            elapsed time, first to last.
+
+    """
+
+    elapsed: float
+    results: Dict[str, OperationResult]
+    critical_path: List[str]
+
+
+class OperationPlan:
+    """Run device operations concurrently as their dependencies allow.
+
+    Every operation starts as soon as the operations it depends on have completed,
+    so independent devices move at the same time and the plan takes as long as its
+    slowest chain instead of the sum of all operations.
+
+    Attributes:
+        operations (dict): Operations of the plan by name.
+        interval (float): Seconds between completion polls.
+
+    """
+
+    def __init__(self, interval: float = 0.2):
+        """Initialize OperationPlan object."""
+        self.operations: Dict[str, Operation] = {}
+        self.interval = interval
+
+    def add(
+        self,
+        name: str,
+        start: Callable[[], Any],
+        done: Optional[Callable[[], bool]] = None,
+        depends=(),
+        timeout: Optional[float] = None,
+    ) -> str:
+        """Add an operation to the plan.
+
+        Args:
+            name (str): Unique name of the operation.
+            start (callable): Function starting the operation.
+            done (callable): Function returning True once the operation completed.
+            depends (iterable): Names of operations that must complete first.
+            timeout (float): Seconds to wait for completion.
+
+        Returns:
+            Name of the operation.
+
+        """
+        if name in self.operations:
+            raise ValueError("Duplicate operation %r" % name)
+        self.operations[name] = Operation(name, start, done, tuple(depends), timeout)
+        return name
+
+    def slew(
+        self,
+        telescope: "Telescope",
+        RightAscension: float,
+        Declination: float,
+        name: str = "slew",
+        **kwargs,
+    ) -> str:
+        """Add an asynchronous telescope slew to equatorial coordinates."""
+        return self.add(
+            name,
+            lambda: telescope.SlewToCoordinatesAsync(RightAscension, Declination),
+            lambda: not telescope.Slewing,
+            **kwargs,
+        )
+
+    def dome(self, dome: "Dome", Azimuth: float, name: str = "dome", **kwargs) -> str:
+        """Add a dome rotation to the given azimuth."""
+        return self.add(
+            name,
+            lambda: dome.SlewToAzimuth(Azimuth),
+            lambda: not dome.Slewing,
+            **kwargs,
+        )
+
+    def filter(
+        self, filterwheel: "FilterWheel", Position: int, name: str = "filter", **kwargs
+    ) -> str:
+        """Add a filter wheel move to the given slot."""
+        return self.add(
+            name,
+            lambda: setattr(filterwheel, "Position", Position),
+            lambda: filterwheel.Position == Position,
+            **kwargs,
+        )
+
+    def focus(
+        self, focuser: "Focuser", Position: int, name: str = "focus", **kwargs
+    ) -> str:
+        """Add a focuser move to the given position."""
+        return self.add(
+            name,
+            lambda: focuser.Move(Position),
+            lambda: not focuser.IsMoving,
+            **kwargs,
+        )
+
+    def rotate(
+        self, rotator: "Rotator", Position: float, name: str = "rotate", **kwargs
+    ) -> str:
+        """Add a rotator move to the given mechanical angle."""
+        return self.add(
+            name,
+            lambda: rotator.MoveAbsolute(Position),
+            lambda: not rotator.IsMoving,
+            **kwargs,
+        )
+
+    def run(self) -> PlanReport:
+        """Run all operations and wait for them to finish.
+
+        Returns:
+            Timing of every operation and the critical path.
+
+        Raises:
+            ValueError: If an operation depends on an unknown operation or the
+                dependencies form a cycle.
+
+        """
+        self._check()
+        origin = time.perf_counter()
+        results: Dict[str, OperationResult] = {}
+        finished = {name: threading.Event() for name in self.operations}
+
+        def execute(operation: Operation):
+            for dependency in operation.depends:
+                finished[dependency].wait()
+            started = time.perf_counter() - origin
+            error = next(
+                (
+                    results[d].error
+                    for d in operation.depends
+                    if results[d].error is not None
+                ),
+                None,
+            )
+            try:
+                if error is None:
+                    operation.start()
+                    if operation.done is not None:
+                        wait_until(operation.done, operation.timeout, self.interval)
+            except Exception as e:
+                error = e
+            results[operation.name] = OperationResult(
+                operation.name, started, time.perf_counter() - origin, error
+            )
+            finished[operation.name].set()
+
+        with ThreadPoolExecutor(max(1, len(self.operations))) as executor:
+            list(executor.map(execute, self.operations.values()))
+        elapsed = time.perf_counter() - origin
+        return PlanReport(elapsed, results, self._critical_path(results))
+
+    def _check(self):
+        """Validate the dependencies of the plan."""
+        state: Dict[str, int] = {}
+
+        def visit(name: str):
+            if state.get(name) == 1:
+                raise ValueError("Dependency cycle through %r" % name)
+            if state.get(name) == 2:
+                return
+            state[name] = 1
+            for dependency in self.operations[name].depends:
+                if dependency not in self.operations:
+                    raise ValueError(
+                        "%r depends on unknown operation %r" % (name, dependency)
+                    )
+                visit(dependency)
+            state[name] = 2
+
+        for name in self.operations:
+            visit(name)
+
+    def _critical_path(self, results: Dict[str, OperationResult]) -> List[str]:
+        """Trace back the chain of operations that finished last."""
+        if not results:
+            return []
+        name = max(results, key=lambda n: results[n].finished)
+        path = [name]
+        while self.operations[name].depends:
+            name = max(self.operations[name].depends, key=lambda n: results[n].finished)
+            path.append(name)
+        return path[::-1]
+
+
+_PROFILE_SETTINGS = ("timeout", "coalesce", "freshness", "staleness")
+
+
+def _read_profile(path: str) -> Dict[str, Any]:
+    """Read a JSON or, for files ending in .toml, a TOML profile."""
+    if not path.lower().endswith(".toml"):
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ImportError(
+                "TOML profiles require Python 3.11 or later or: pip install tomli"
+            )
+    with open(path, "rb") as file:
+        return tomllib.load(file)
+
+
+class Profile:
+    """Devices of an observatory described by a profile.
+
+    A profile has three sections. client holds settings applied to every device:
+    timeout, coalesce, freshness, staleness and connections, the number of
+    connections kept alive to each host. hosts maps host names to their address
+    and optionally protocall, api_version and settings overriding the client ones.
+    devices maps device names to their host, type and number and optionally the
+    names of the devices they depend on and overrides of the settings other than
+    connections. In JSON::
+
+        {
+            "client": {"timeout": 5.0},
+            "hosts": {"pier": {"address": "192.168.1.20:11111"}},
+            "devices": {
+                "mount": {"host": "pier", "type": "telescope", "number": 0},
+                "camera": {"host": "pier", "type": "camera", "depends": ["mount"]}
+            }
+        }
+
+    Devices are constructed on first access, profile["mount"], and devices on the
+    same host share one HTTP session.
+
+    Attributes:
+        client (dict): Settings of all devices.
+        hosts (dict): Host descriptions by name.
+        devices (dict): Device descriptions by name.
+
+    """
+
+    def __init__(
+        self,
+        hosts: Dict[str, Dict[str, Any]],
+        devices: Dict[str, Dict[str, Any]],
+        client: Optional[Dict[str, Any]] = None,
+    ):
+        """Initialize Profile object.
+
+        Raises:
+            ValueError: If a device refers to an unknown host, device type or
+                device, or a section has unknown settings.
+
+        """
+        self.client = dict(client or {})
+        self.hosts = hosts
+        self.devices = devices
+        self._check("client", self.client, ("connections",) + _PROFILE_SETTINGS)
+        for name, host in hosts.items():
+            self._check(
+                "host %r" % name,
+                host,
+                ("address", "protocall", "api_version", "connections")
+                + _PROFILE_SETTINGS,
+            )
+            if "address" not in host:
+                raise ValueError("Host %r has no address" % name)
+        for name, device in devices.items():
+            self._check(
+                "device %r" % name,
+                device,
+                ("host", "type", "number", "depends") + _PROFILE_SETTINGS,
+            )
+            if device.get("host") not in hosts:
+                raise ValueError(
+                    "Device %r has unknown host %r" % (name, device.get("host"))
+                )
+            _device_class(device.get("type", ""))
+            for dependency in device.get("depends", ()):
+                if dependency not in devices:
+                    raise ValueError(
+                        "Device %r depends on unknown device %r" % (name, dependency)
+                    )
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Device] = {}
+        self._sessions: Dict[str, requests.Session] = {}
+
+    @classmethod
+    def load(cls, path: str) -> "Profile":
+        """Read a profile from a JSON or, if its name ends in .toml, TOML file."""
+        profile = _read_profile(path)
+        return cls(
+            profile.get("hosts", {}), profile.get("devices", {}), profile.get("client")
+        )
+
+    def __getitem__(self, name: str) -> Device:
+        """Return the named device, constructing it on first access."""
+        with self._lock:
+            try:
+                return self._devices[name]
+            except KeyError:
+                device = self._devices[name] = self._construct(name)
+                return device
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.devices
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def connect(
+        self, names: Optional[List[str]] = None, interval: float = 0.2
+    ) -> PlanReport:
+        """Connect devices in parallel, each once the devices it depends on are.
+
+        A device whose dependency failed to connect is not connected and reports
+        the error of the dependency.
+
+        Args:
+            names (list): Devices to connect together with their dependencies, all
+                devices by default.
+            interval (float): Seconds between checks of finished connections.
+
+        Returns:
+            Report whose results give the start and end of every connection in
+            seconds from the start of the first.
+
+        Raises:
+            ValueError: If the dependencies form a cycle.
+
+        """
+        plan = OperationPlan(interval)
+        for name in self._closure(self.devices if names is None else names):
+            plan.add(
+                name,
+                lambda name=name: setattr(self[name], "Connected", True),
+                depends=self.devices[name].get("depends", ()),
+            )
+        return plan.run()
+
+    def disconnect(self, names: Optional[List[str]] = None) -> PlanReport:
+        """Disconnect devices in parallel, each once the devices depending on it are.
+
+        Args:
+            names (list): Devices to disconnect, all constructed devices by default.
+
+        Returns:
+            Report of the disconnections.
+
+        """
+        with self._lock:
+            names = list(self._devices if names is None else names)
+        plan = OperationPlan()
+        for name in names:
+            plan.add(
+                name,
+                lambda name=name: setattr(self[name], "Connected", False),
+                depends=[
+                    other
+                    for other in names
+                    if name in self.devices[other].get("depends", ())
+                ],
+            )
+        return plan.run()
+
+    def _construct(self, name: str) -> Device:
+        """Build a device with the settings of its host and the client."""
+        try:
+            description = self.devices[name]
+        except KeyError:
+            raise KeyError("Unknown device %r" % name) from None
+        host = self.hosts[description["host"]]
+        settings = {
+            key: value
+            for section in (self.client, host, description)
+            for key, value in section.items()
+            if key in _PROFILE_SETTINGS
+        }
+        device = _device_class(description["type"])(
+            host["address"],
+            description.get("number", 0),
+            host.get("protocall", "http"),
+            host.get("api_version", DEFAULT_API_VERSION),
+        )
+        session = self._sessions.get(description["host"])
+        if session is None:
+            connections = host.get("connections", self.client.get("connections", 4))
+            session = self._sessions[description["host"]] = _session(connections)
+        device.session = session
+        device.timeout = settings.get("timeout", device.timeout)
+        device.coalesce = settings.get("coalesce", device.coalesce)
+        device.freshness = settings.get("freshness", device.freshness)
+        device.staleness = settings.get("staleness", device.staleness)
+        return device
+
+    def _closure(self, names) -> List[str]:
+        """Return the given devices and everything they depend on."""
+        found: Dict[str, None] = {}
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in self.devices:
+                raise KeyError("Unknown device %r" % name)
+            if name not in found:
+                found[name] = None
+                pending.extend(self.devices[name].get("depends", ()))
+        return list(found)
+
+    @staticmethod
+    def _check(section: str, values: Dict[str, Any], keys: tuple):
+        """Reject unknown keys of a profile section."""
+        unknown = set(values) - set(keys)
+        if unknown:
+            raise ValueError(
+                "Unknown settings of %s: %s" % (section, ", ".join(sorted(unknown)))
+            )
+
+
+class TrafficRecorder:
+    """Append every request and response of devices to a log file.
+
+    Each line of the log is a JSON object with the keys t (UTC timestamp), m (HTTP
+    method), p (URL path), d (request data), s (status code, None if the request
+    failed), e (seconds until the response arrived), c (content type), b (response
+    body, base64 encoded for binary content types when z is true), n (content
+    encoding of a body recorded as received, e.g. gzip for compressed image
+    downloads) and x (error of a failed request). Paths ending in .gz are written
+    gzip compressed. Enable it by setting Device.recorder.
+
+    Attributes:
+        path (str): Path of the log file.
+
+    """
+
+    def __init__(self, path: str):
+        """Initialize TrafficRecorder object and open the log for appending."""
+        self.path = path
+        opener = gzip.open if path.endswith(".gz") else open
+        self._file = opener(path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        device: Device,
+        method: str,
+        attribute: str,
+        data: Dict[str, Any],
+        response: Optional[requests.Response],
+        start: float,
+        error: Optional[BaseException] = None,
+        body: Optional[bytes] = None,
+    ):
+        """Append a request and its response or error to the log.
+
+        Args:
+            device (Device): Device the request was sent to.
+            method (str): HTTP method.
+            attribute (str): Attribute of the request.
+            data (dict): Data sent with the request.
+            response (Response): Response, None if the request failed.
+            start (float): perf_counter value when the request was sent.
+            error (Exception): Error of a failed request.
+            body (bytes): Body as received, still content encoded, for streamed
+                responses whose content was consumed by the caller.
+
+        """
+        elapsed = time.perf_counter() - start
+        entry = {
+            "t": time.time() - elapsed,
+            "m": method,
+            "p": "%s/%s" % (urllib.parse.urlsplit(device.base_url).path, attribute),
+            "d": data,
+            "s": None,
+            "e": round(elapsed, 6),
+        }
+        if response is not None:
+            content_type = response.headers.get("Content-Type", "")
+            entry["s"] = response.status_code
+            entry["c"] = content_type
+            if body is None:
+                body = response.content
+            elif response.headers.get("Content-Encoding", "identity") != "identity":
+                entry["n"] = response.headers["Content-Encoding"]
+            if "n" not in entry and content_type.startswith(
+                ("application/json", "text/")
+            ):
+                entry["b"] = body.decode(response.encoding or "utf-8", "replace")
+            else:
+                entry["b"] = base64.b64encode(body).decode("ascii")
+                entry["z"] = True
+        else:
+            entry["x"] = repr(error)
+        line = json.dumps(entry, separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        """Close the log file."""
+        with self._lock:
+            self._file.close()
+
+
+def _read_log(path: str) -> List[Dict[str, Any]]:
+    """Read the entries of a JSON lines log written by TrafficRecorder."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class TraceSink:
+    """Write sampled timings of device requests to a rotating JSON lines file.
+
+    Callers only queue a tuple, a background thread formats and writes the records.
+    Each line is a JSON object with the keys time (UTC timestamp of the request
+    start), method, host, endpoint (device type, number and attribute), duration
+    (seconds), bytes (response body size), error (None on success) and thread.
+    Enable it by setting Device.tracer.
+
+    Attributes:
+        path (str): Path of the current trace file, rotated files get .1, .2, ...
+            appended, .1 being the most recent.
+        sample (float): Fraction of successful requests traced.
+        slow (float): Requests taking at least this many seconds are always traced,
+            as are failed ones.
+        max_bytes (int): Size at which the file is rotated.
+        backups (int): Number of rotated files kept.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample: float = 1.0,
+        slow: Optional[float] = None,
+        max_bytes: int = 10000000,
+        backups: int = 5,
+    ):
+        """Initialize TraceSink object and start its writer thread."""
+        self.path = path
+        self.sample = sample
+        self.slow = slow
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._file = open(path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+        self._thread = threading.Thread(target=self._write, name="trace", daemon=True)
+        self._thread.start()
+
+    def trace(
+        self,
+        device: Device,
+        method: str,
+        attribute: str,
+        elapsed: float,
+        size: int,
+        error: Optional[BaseException] = None,
+    ):
+        """Queue the record of a request if it is sampled."""
+        if (
+            error is None
+            and (self.slow is None or elapsed < self.slow)
+            and (self.sample < 1.0 and random.random() >= self.sample)
+        ):
+            return
+        self._queue.put(
+            (
+                time.time() - elapsed,
+                method,
+                device.base_url,
+                attribute,
+                elapsed,
+                size,
+                None if error is None else "%s: %s" % (type(error).__name__, error),
+                threading.current_thread().name,
+            )
+        )
+
+    def close(self):
+        """Write the queued records and close the file."""
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _write(self):
+        """Format queued records and write them until closed."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._file.flush()
+                return
+            start, method, base_url, attribute, elapsed, size, error, thread = item
+            url = urllib.parse.urlsplit(base_url)
+            device = url.path.split("/", 3)[-1]
+            record = {
+                "time": round(start, 6),
+                "method": method,
+                "host": url.netloc,
+                "endpoint": "%s/%s" % (device, attribute),
+                "duration": round(elapsed, 6),
+                "bytes": size,
+                "error": error,
+                "thread": thread,
+            }
+            line = json.dumps(record) + "\n"
+            self._file.write(line)
+            self._size += len(line)
+            if self._size >= self.max_bytes:
+                self._rotate()
+            elif self._queue.empty():
+                self._file.flush()
+
+    def _rotate(self):
+        """Shift the rotated files and start a new trace file."""
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, n)):
+                os.replace("%s.%d" % (self.path, n), "%s.%d" % (self.path, n + 1))
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._size = 0
+
+
+class TraceAnalysis(NamedTuple):
+    """Latency statistics of a trace written by TraceSink.
+
+    Attributes:
+        endpoints (dict): For each endpoint the count, errors and p50, p95, p99 and
+            max duration in milliseconds.
+        hosts (dict): The same statistics for each host.
+        outliers (list): Records slower than factor times the median of their
+            endpoint, slowest relative to the median first.
+
+    """
+
+    endpoints: Dict[str, Dict[str, float]]
+    hosts: Dict[str, Dict[str, float]]
+    outliers: List[Dict[str, Any]]
+
+
+def read_trace(path: str) -> List[Dict[str, Any]]:
+    """Read a trace file and its rotated predecessors, oldest record first."""
+    paths = []
+    n = 1
+    while os.path.exists("%s.%d" % (path, n)):
+        paths.insert(0, "%s.%d" % (path, n))
+        n += 1
+    records = [record for p in paths + [path] for record in _read_log(p)]
+    records.sort(key=lambda record: record["time"])
+    return records
+
+
+def _latency_stats(records: List[Dict[str, Any]]) -> Dict[str, float]:
+    durations = [record["duration"] * 1000.0 for record in records]
+    return {
+        "count": len(records),
+        "errors": sum(record["error"] is not None for record in records),
+        "p50": _percentile(durations, 50),
+        "p95": _percentile(durations, 95),
+        "p99": _percentile(durations, 99),
+        "max": max(durations, default=float("nan")),
+    }
+
+
+def analyze_trace(
+    records: List[Dict[str, Any]], factor: float = 5.0, outliers: int = 20
+) -> TraceAnalysis:
+    """Compute latency percentiles per endpoint and per host and find outliers.
+
+    Args:
+        records (list): Trace records, e.g. from read_trace.
+        factor (float): Multiple of the endpoint median from which a request is
+            an outlier.
+        outliers (int): Maximum number of outliers returned.
+
+    Returns:
+        TraceAnalysis of the records.
+
+    """
+    by_endpoint: Dict[str, List[Dict[str, Any]]] = {}
+    by_host: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        by_endpoint.setdefault(record["endpoint"], []).append(record)
+        by_host.setdefault(record["host"], []).append(record)
+    endpoints = {name: _latency_stats(group) for name, group in by_endpoint.items()}
+    hosts = {name: _latency_stats(group) for name, group in by_host.items()}
+    slow = []
+    for record in records:
+        median = endpoints[record["endpoint"]]["p50"] / 1000.0
+        if median and record["duration"] > factor * median:
+            slow.append((record["duration"] / median, record))
+    slow.sort(key=lambda item: item[0], reverse=True)
+    return TraceAnalysis(endpoints, hosts, [record for _, record in slow[:outliers]])
+
+
+def plot_trace(records: List[Dict[str, Any]], path: Optional[str] = None):
+    """Plot the latency of traced requests over time, one series per endpoint.
+
+    Requires matplotlib.
+
+    Args:
+        records (list): Trace records, e.g. from read_trace.
+        path (str): Image file to save the plot to, None to show it.
+
+    """
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        raise ImportError("Plotting requires matplotlib: pip install matplotlib")
+
+    figure, axes = plt.subplots(figsize=(12, 6))
+    by_endpoint: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        by_endpoint.setdefault(record["endpoint"], []).append(record)
+    for endpoint, group in sorted(by_endpoint.items()):
+        axes.plot(
+            [datetime.fromtimestamp(record["time"]) for record in group],
+            [record["duration"] * 1000.0 for record in group],
+            ".",
+            markersize=3,
+            label=endpoint,
+        )
+    axes.set_yscale("log")
+    axes.set_xlabel("Time")
+    axes.set_ylabel("Latency (ms)")
+    axes.legend(fontsize="small", markerscale=3)
+    figure.autofmt_xdate()
+    if path is None:
+        plt.show()
+    else:
+        figure.savefig(path)
+    plt.close(figure)
+
+
+def _request_key(method: str, path: str, data: Mapping[str, Any]) -> tuple:
+    """Return a replay lookup key with case-insensitive parameter names."""
+    return (
+        method,
+        path.lower(),
+        tuple(sorted((k.lower(), str(v)) for k, v in data.items())),
+    )
+
+
+def _respond(
+    handler: BaseHTTPRequestHandler,
+    status: int,
+    content_type: str,
+    body: bytes,
+    encoding: Optional[str] = None,
+):
+    """Write a complete HTTP response with a Content-Length header."""
+    handler.send_response(status)
+    handler.send_header("Content-Type", content_type)
+    if encoding:
+        handler.send_header("Content-Encoding", encoding)
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class _ServerHandler(BaseHTTPRequestHandler):
+    """Pass requests to the serve method of a ReplayServer or MockServer."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        _log.debug(format, *args)
+
+    def do_GET(self):
+        self.server.owner.serve(self, "GET")
+
+    def do_PUT(self):
+        self.server.owner.serve(self, "PUT")
+
+
+def _request_data(handler: BaseHTTPRequestHandler) -> Dict[str, str]:
+    """Return the query and form parameters of a request."""
+    data = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(handler.path).query))
+    length = int(handler.headers.get("Content-Length") or 0)
+    if length:
+        data.update(urllib.parse.parse_qsl(handler.rfile.read(length).decode("utf-8")))
+    return data
+
+
+class ReplayServer:
+    """Serve a TrafficRecorder log as a local Alpaca server.
+
+    Requests are matched by method, path and parameters, falling back to method and
+    path. Matching responses are served in recorded order, repeating the last one
+    when exhausted, after the recorded latency multiplied by latency_scale. Point
+    devices at the address of the server to replay a session without hardware.
+
+    Attributes:
+        path (str): Path of the replayed log.
+        latency_scale (float): Factor applied to recorded latencies, 0 for none.
+        address (str): Host and port the server listens on.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        latency_scale: float = 1.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """Initialize ReplayServer object and bind its socket."""
+        self.path = path
+        self.latency_scale = latency_scale
+        self._exact: Dict[tuple, List[Dict[str, Any]]] = {}
+        self._loose: Dict[tuple, List[Dict[str, Any]]] = {}
+        for entry in _read_log(path):
+            key = _request_key(entry["m"], entry["p"], entry["d"])
+            self._exact.setdefault(key, []).append(entry)
+            self._loose.setdefault(key[:2], []).append(entry)
+        self._served: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _ServerHandler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread: Optional[threading.Thread] = None
+        self.address = "%s:%d" % self._server.server_address[:2]
+
+    def start(self) -> "ReplayServer":
+        """Start serving from a background thread."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="replay", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "ReplayServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve(self, handler: BaseHTTPRequestHandler, method: str):
+        """Answer a request with the next matching recorded response."""
+        path = urllib.parse.urlsplit(handler.path).path
+        key = _request_key(method, path, _request_data(handler))
+        entries, index = self._exact.get(key), key
+        if not entries:
+            entries, index = self._loose.get(key[:2]), key[:2]
+        if not entries:
+            message = "No recorded response for %s %s" % key[:2]
+            _respond(handler, 400, "text/plain", message.encode("utf-8"))
+            return
+        with self._lock:
+            n = self._served.get(index, 0)
+            self._served[index] = n + 1
+        entry = entries[min(n, len(entries) - 1)]
+        time.sleep(entry["e"] * self.latency_scale)
+        if entry["s"] is None:
+            handler.close_connection = True
+            return
+        if entry.get("z"):
+            body = base64.b64decode(entry["b"])
+        else:
+            body = entry["b"].encode("utf-8")
+        content_type = entry.get("c") or "application/json"
+        _respond(handler, entry["s"], content_type, body, entry.get("n"))
+
+
+class MockServer:
+    """Serve simulated Alpaca devices for tests and benchmarks.
+
+    Every device type and number answers. A GET returns the last value put to the
+    same attribute, the entry of values for it, or 0. ImageArray returns a
+    synthetic int32 frame as JSON or ImageBytes, which requires NumPy. The
+    management API lists devices.
+
+    Attributes:
+        latency (float): Seconds to wait before each response.
+        image_shape (tuple): Shape of the served image.
+        values (dict): Values returned by GET requests, by lower case attribute.
+        devices (list): Device type and number pairs listed as configured.
+        address (str): Host and port the server listens on.
+
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        image_shape: tuple = (1024, 768),
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """Initialize MockServer object and bind its socket."""
+        self.latency = latency
+        self.image_shape = image_shape
+        self.values: Dict[str, Any] = {
+            "connected": True,
+            "description": "Simulated Alpaca device",
+            "driverinfo": "AlpycaClient MockServer",
+            "driverversion": "1.0",
+            "imageready": True,
+            "interfaceversion": 1,
+            "name": "Mock",
+            "supportedactions": [],
+        }
+        self.devices = [
+            ("Camera", 0),
+            ("Dome", 0),
+            ("FilterWheel", 0),
+            ("Focuser", 0),
+            ("Telescope", 0),
+        ]
+        self._images: Dict[bool, bytes] = {}
+        self._transactions = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _ServerHandler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread: Optional[threading.Thread] = None
+        self.address = "%s:%d" % self._server.server_address[:2]
+
+    def start(self) -> "MockServer":
+        """Start serving from a background thread."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="mock", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve(self, handler: BaseHTTPRequestHandler, method: str):
+        """Answer a request from the simulated state."""
+        path = urllib.parse.urlsplit(handler.path).path.strip("/").split("/")
+        data = _request_data(handler)
+        time.sleep(self.latency)
+        if path[0] == "management":
+            self._reply(handler, self._management(path[-1]))
+        elif len(path) != 5 or path[0] != "api":
+            _respond(handler, 400, "text/plain", b"Unknown path")
+        elif method == "PUT":
+            arguments = [
+                value
+                for key, value in data.items()
+                if key.lower() not in ("clientid", "clienttransactionid")
+            ]
+            if arguments:
+                self.values[path[4]] = _form_value(arguments[0])
+            self._reply(handler, None)
+        elif path[4] in ("imagearray", "imagearrayvariant"):
+            binary = "application/imagebytes" in handler.headers.get("Accept", "")
+            content_type = "application/imagebytes" if binary else "application/json"
+            _respond(handler, 200, content_type, self._image(binary))
+        else:
+            self._reply(handler, self.values.get(path[4], 0))
+
+    def _reply(self, handler: BaseHTTPRequestHandler, value: Any):
+        body = {
+            "ClientTransactionID": 0,
+            "ServerTransactionID": next(self._transactions),
+            "ErrorNumber": 0,
+            "ErrorMessage": "",
+            "Value": value,
+        }
+        _respond(handler, 200, "application/json", json.dumps(body).encode("utf-8"))
+
+    def _management(self, attribute: str) -> Any:
+        if attribute == "apiversions":
+            return [1]
+        if attribute == "description":
+            return {
+                "ServerName": "MockServer",
+                "Manufacturer": "AlpycaClient",
+                "ManufacturerVersion": "1.0",
+                "Location": self.address,
+            }
+        return [
+            {
+                "DeviceName": "Mock %s" % device_type,
+                "DeviceType": device_type,
+                "DeviceNumber": device_number,
+                "UniqueID": "mock-%s-%d" % (device_type.lower(), device_number),
+            }
+            for device_type, device_number in self.devices
+        ]
+
+    def _image(self, binary: bool) -> bytes:
+        """Return the encoded image, generating it on first use."""
+        with self._lock:
+            if binary not in self._images:
+                _require_numpy()
+                image = np.random.default_rng(0).poisson(1000, self.image_shape)
+                image = image.astype(np.int32)
+                dims = list(image.shape) + [0] * (3 - image.ndim)
+                if binary:
+                    header = (1, 0, 0, 0, 44, 2, 8, image.ndim, *dims)
+                    self._images[binary] = struct.pack(
+                        "<iiIIiiiiiii", *header
+                    ) + image.astype("<u2").tobytes()
+                else:
+                    values = json.dumps(image.tolist(), separators=(",", ":"))
+                    self._images[binary] = (
+                        '{"Type":2,"Rank":%d,"Value":%s,"ClientTransactionID":0,'
+                        '"ServerTransactionID":0,"ErrorNumber":0,"ErrorMessage":""}'
+                        % (image.ndim, values)
+                    ).encode("utf-8")
+            return self._images[binary]
+
+
+def _form_value(value: str) -> Any:
+    """Convert a form parameter to the JSON value it represents."""
+    try:
+        return json.loads(value.lower() if value in ("True", "False") else value)
+    except ValueError:
+        return value
+
+
+class _FastResponse:
+    """Minimal response returned by FastTransport.
+
+    Attributes:
+        url (str): Requested URL.
+        status_code (int): HTTP status code.
+        headers (CaseInsensitiveDict): Response headers.
+        content (bytes): Response body.
+        encoding (str): Encoding of the body, always UTF-8 for Alpaca.
+
+    """
+
+    encoding = "utf-8"
+
+    def __init__(self, url: str, status_code: int, headers, content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        """Response body decoded as UTF-8."""
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        """Response body parsed as JSON."""
+        return json.loads(self.content)
+
+
+class _Unusual(Exception):
+    """Response FastTransport leaves to the full transport."""
+
+
+class FastTransport:
+    """Lightweight HTTP/1.1 transport for small Alpaca requests.
+
+    Set it as the session of a device to send small GET and PUT requests over
+    persistent TCP_NODELAY sockets with request templates prebuilt per endpoint,
+    parsing only the status line, the few headers that matter and the body. Large
+    endpoints, HTTPS, requests with extra options, and GET responses that are large,
+    encoded or redirected are handled by the full requests session instead. GET
+    parameters are sent in the query string.
+
+    Attributes:
+        fallback (Session): Full transport for everything the fast path skips.
+        large (set): Attributes always sent through the fallback.
+        max_body (int): Largest GET response body in bytes kept on the fast path.
+
+    """
+
+    def __init__(
+        self,
+        fallback: Optional[requests.Session] = None,
+        large=("imagearray", "imagearrayvariant"),
+        max_body: int = 65536,
+    ):
+        """Initialize FastTransport object."""
+        self.fallback = fallback or requests.Session()
+        self.large = set(large)
+        self.max_body = max_body
+        self._templates: Dict[tuple, tuple] = {}
+        self._idle: Dict[tuple, List[socket.socket]] = {}
+        self._lock = threading.Lock()
+
+    def request(
+        self, method: str, url: str, params=None, data=None, timeout=None, **kwargs
+    ):
+        """Send a request, on the fast path when possible.
+
+        Args:
+            method (str): HTTP method, GET or PUT.
+            url (str): Full URL of the request.
+            params (dict): Query parameters of a GET request.
+            data (dict): Form data of a PUT request.
+            timeout (float): Socket timeout in seconds.
+            **kwargs: Further requests options, which select the fallback.
+
+        Returns:
+            Response object.
+
+        """
+        attribute = url[url.rfind("/") + 1 :]
+        if kwargs or not url.startswith("http://") or attribute in self.large:
+            return self.fallback.request(
+                method, url, params=params, data=data, timeout=timeout, **kwargs
+            )
+        template = self._templates.get((method, url))
+        if template is None:
+            template = self._template(method, url)
+        address, head, tail = template
+        fields = data if method == "PUT" else params
+        form = urllib.parse.urlencode(fields).encode("ascii") if fields else b""
+        if method == "PUT":
+            message = b"%s%d\r\n\r\n%s" % (head, len(form), form)
+        elif form:
+            message = head + b"?" + form + tail
+        else:
+            message = head + tail
+        try:
+            status, headers, body = self._exchange(address, message, method, timeout)
+        except _Unusual:
+            return self.fallback.request(
+                method, url, params=params, data=data, timeout=timeout
+            )
+        except socket.timeout as e:
+            raise requests.Timeout(e)
+        except OSError as e:
+            raise requests.ConnectionError(e)
+        return _FastResponse(url, status, headers, body)
+
+    def close(self):
+        """Close all idle sockets and the fallback session."""
+        with self._lock:
+            for sockets in self._idle.values():
+                for sock in sockets:
+                    sock.close()
+            self._idle.clear()
+        self.fallback.close()
+
+    def _template(self, method: str, url: str) -> tuple:
+        """Prebuild the constant parts of requests to an endpoint."""
+        parts = urllib.parse.urlsplit(url)
+        address = (parts.hostname, parts.port or 80)
+        host = parts.netloc.encode("ascii")
+        path = (parts.path or "/").encode("ascii")
+        if method == "PUT":
+            head = (
+                b"PUT %s HTTP/1.1\r\nHost: %s\r\n"
+                b"Content-Type: application/x-www-form-urlencoded\r\n"
+                b"Content-Length: " % (path, host)
+            )
+            tail = b""
+        else:
+            head = b"%s %s" % (method.encode("ascii"), path)
+            tail = b" HTTP/1.1\r\nHost: %s\r\n\r\n" % host
+        template = self._templates[(method, url)] = (address, head, tail)
+        return template
+
+    def _exchange(self, address: tuple, message: bytes, method: str, timeout):
+        """Send a request and read its response, retrying once on a stale socket.
+
+        The request is only sent again if a reused socket failed before any byte
+        of the response arrived, not on timeouts, and a PUT only if sending it
+        failed, so commands are never executed twice.
+
+        """
+        for attempt in range(2):
+            sock, reused = self._checkout(address, timeout)
+            sent = received = False
+            try:
+                sock.sendall(message)
+                sent = True
+                buffer = sock.recv(65536)
+                if not buffer:
+                    raise ConnectionResetError("Connection closed by server")
+                received = True
+                status, headers, body, keep_alive = self._response(
+                    sock, buffer, method
+                )
+            except (_Unusual, socket.timeout):
+                sock.close()
+                raise
+            except OSError:
+                sock.close()
+                if (
+                    reused
+                    and attempt == 0
+                    and not received
+                    and not (sent and method == "PUT")
+                ):
+                    continue
+                raise
+            if keep_alive:
+                with self._lock:
+                    self._idle.setdefault(address, []).append(sock)
+            else:
+                sock.close()
+            return status, headers, body
+
+    def _checkout(self, address: tuple, timeout) -> tuple:
+        """Return an idle or new socket to the address and whether it is reused."""
+        while True:
+            with self._lock:
+                sockets = self._idle.get(address)
+                sock = sockets.pop() if sockets else None
+            if sock is None or not self._closed(sock):
+                break
+            sock.close()
+        reused = sock is not None
+        if sock is None:
+            sock = socket.create_connection(address, timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        return sock, reused
+
+    @staticmethod
+    def _closed(sock: socket.socket) -> bool:
+        """Check whether the server closed an idle socket or sent unexpected data."""
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        return True
+
+    def _response(self, sock: socket.socket, buffer: bytes, method: str) -> tuple:
+        """Parse a response whose first bytes are in buffer."""
+        while True:
+            end = buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise ConnectionResetError("Connection closed in response header")
+            buffer += chunk
+        lines = buffer[:end].decode("latin-1").split("\r\n")
+        version, status = lines[0].split(None, 2)[:2]
+        headers = requests.structures.CaseInsensitiveDict(
+            line.split(":", 1) for line in lines[1:] if ":" in line
+        )
+        for key, value in headers.items():
+            headers[key] = value.strip()
+        status = int(status)
+        body = buffer[end + 4 :]
+        length = headers.get("Content-Length")
+        fallback_ok = method == "GET"
+        if fallback_ok and (
+            "Content-Encoding" in headers
+            or not 200 <= status < 300 and status not in (400, 500)
+            or length is not None and int(length) > self.max_body
+        ):
+            raise _Unusual()
+        keep_alive = headers.get("Connection", "").lower() != "close" and (
+            version != "HTTP/1.0"
+        )
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = self._chunked(sock, body)
+        elif length is not None:
+            length = int(length)
+            while len(body) < length:
+                chunk = sock.recv(max(65536, length - len(body)))
+                if not chunk:
+                    raise ConnectionResetError("Connection closed in response body")
+                body += chunk
+        else:
+            keep_alive = False
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                body += chunk
+        return status, headers, body, keep_alive
+
+    @staticmethod
+    def _chunked(sock: socket.socket, buffer: bytes) -> bytes:
+        """Read and decode a chunked response body."""
+        body = b""
+        while True:
+            while b"\r\n" not in buffer:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise ConnectionResetError("Connection closed in chunked body")
+                buffer += chunk
+            size_line, buffer = buffer.split(b"\r\n", 1)
+            size = int(size_line.split(b";")[0], 16)
+            while len(buffer) < size + 2:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise ConnectionResetError("Connection closed in chunked body")
+                buffer += chunk
+            if size == 0:
+                return body
+            body += buffer[:size]
+            buffer = buffer[size + 2 :]
+
+
+def compare_transports(
+    device: Device, attribute: str = "connected", calls: int = 1000
+) -> Dict[str, Dict[str, float]]:
+    """Benchmark GET requests over requests and over FastTransport.
+
+    Args:
+        device (Device): Device to send the requests to.
+        attribute (str): Attribute to get.
+        calls (int): Number of requests per transport.
+
+    Returns:
+        For each transport, mean CPU and wall time per call in microseconds.
+
+    """
+    results = {}
+    for name, session in (
+        ("requests", requests.Session()),
+        ("fast", FastTransport()),
+    ):
+        probe = copy.copy(device)
+        probe.session = session
+        probe.coalesce = False
+        probe._get(attribute)
+        cpu, wall = time.process_time(), time.perf_counter()
+        for _ in range(calls):
+            probe._get(attribute)
+        results[name] = {
+            "cpu_us": (time.process_time() - cpu) / calls * 1e6,
+            "wall_us": (time.perf_counter() - wall) / calls * 1e6,
+        }
+        session.close()
+    return results
+
+
+_BENCH_ATTRIBUTES = {
+    "camera": ["camerastate", "imageready", "ccdtemperature"],
+    "covercalibrator": ["coverstate", "calibratorstate"],
+    "dome": ["azimuth", "shutterstatus", "slewing"],
+    "filterwheel": ["position"],
+    "focuser": ["position", "ismoving"],
+    "observingconditions": ["temperature", "humidity"],
+    "rotator": ["position", "ismoving"],
+    "safetymonitor": ["issafe"],
+    "switch": ["maxswitch"],
+    "telescope": ["rightascension", "declination", "slewing"],
+}
+
+
+def benchmark(
+    device: Device,
+    attributes: Optional[List[str]] = None,
+    calls: int = 100,
+    images: int = 0,
+) -> Dict[str, Dict[str, float]]:
+    """Measure request latencies and image download throughput of a device.
+
+    Args:
+        device (Device): Device to benchmark.
+        attributes (list): Attributes to get, by default a few common and device
+            specific ones.
+        calls (int): Number of requests per attribute.
+        images (int): Number of downloads per image transfer format, cameras only.
+
+    Returns:
+        For each attribute the p50, p95, p99 and max latency in milliseconds and the
+        error count. For each image format, keyed imagearray and imagebytes, the
+        mean seconds, bytes and megabytes per second of the downloads.
+
+    """
+    if attributes is None:
+        attributes = ["connected", "name"] + _BENCH_ATTRIBUTES.get(
+            device.device_type, []
+        )
+    probe = copy.copy(device)
+    probe.coalesce = False
+    results = {}
+    for attribute in attributes:
+        latencies, errors = [], 0
+        for _ in range(calls):
+            start = time.perf_counter()
+            try:
+                probe._get(attribute)
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000.0)
+        results[attribute] = {
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "max": max(latencies, default=float("nan")),
+            "errors": errors,
+        }
+    if images and isinstance(device, Camera):
+        for name, binary in (("imagearray", False), ("imagebytes", True)):
+            reports = []
+            for _ in range(images):
+                device.download_image(binary=binary)
+                reports.append(device.last_download)
+            elapsed = sum(report.elapsed for report in reports)
+            wire = sum(report.wire_bytes for report in reports)
+            results[name] = {
+                "seconds": elapsed / images,
+                "bytes": wire / images,
+                "mb_per_s": wire / elapsed / 1e6 if elapsed else float("nan"),
+            }
+    return results
+
+
+class DownloadReport(NamedTuple):
+    """Transfer statistics of an image download.
+
+    Attributes:
+        encoding (str): Content encoding used by the server.
+        wire_bytes (int): Bytes received over the network.
+        bytes (int): Bytes after decompression.
+        elapsed (float): Seconds from request until the image was decoded.
+        decompress_cpu (float): CPU seconds spent decompressing.
+        decode_cpu (float): CPU seconds spent decoding pixel values.
+        shape (tuple): Shape of the image.
+
+    """
+
+    encoding: str
+    wire_bytes: int
+    bytes: int
+    elapsed: float
+    decompress_cpu: float
+    decode_cpu: float
+    shape: tuple
+
+    @property
+    def throughput(self) -> float:
+        """Network throughput in bytes per second."""
+        return self.wire_bytes / self.elapsed if self.elapsed else float("nan")
+
+    @property
+    def ratio(self) -> float:
+        """Compression ratio, decompressed bytes per byte received."""
+        return self.bytes / self.wire_bytes if self.wire_bytes else float("nan")
+
+
+def _accept_encoding() -> str:
+    """Return the Accept-Encoding header for the available decompressors."""
+    encodings = ["gzip", "deflate"]
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return ", ".join(encodings)
+
+
+class _Identity:
+    """Decompressor for uncompressed content."""
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class _Deflate:
+    """Decompressor for deflate content with or without the zlib wrapper."""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+        self._started = False
+
+    def decompress(self, data: bytes) -> bytes:
+        if not self._started and data:
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self) -> bytes:
+        return self._decompressor.flush()
+
+
+class _Brotli:
+    """Decompressor for brotli content."""
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.process(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def _decompressor(encoding: str):
+    """Return a streaming decompressor for a Content-Encoding."""
+    if encoding in ("identity", ""):
+        return _Identity()
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return _Deflate()
+    if encoding == "br" and brotli is not None:
+        return _Brotli()
+    if encoding == "zstd" and zstandard is not None:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        decompressor.flush = lambda: b""
+        return decompressor
+    raise ErrorMessage("Unsupported content encoding %r" % encoding)
+
+
+class ImageSink:
+    """Receiver of pixel values from a streaming image decoder.
+
+    Values arrive in transmission order, the first axis of the image varying
+    slowest, as for the flattened ImageArray.
+    """
+
+    def begin(self, shape: tuple, dtype):
+        """Called once before the first values.
+
+        Args:
+            shape (tuple): Shape of the image, the first axis None if not yet known.
+            dtype: NumPy data type of the pixel values.
+
+        """
+
+    def write(self, values):
+        """Called with each one dimensional array of consecutive pixel values."""
+
+    def end(self, shape: tuple):
+        """Called with the final shape after the last values.
+
+        Returns:
+            Result of the download.
+
+        """
+
+
+class ArraySink(ImageSink):
+    """Collect the pixel values into an array shaped like ImageArray."""
+
+    def begin(self, shape: tuple, dtype):
+        self._dtype = dtype
+        self._chunks = []
+        self._array = None
+        self._filled = 0
+        if shape[0] is not None:
+            self._array = np.empty(int(np.prod(shape)), dtype)
+
+    def write(self, values):
+        if self._array is None:
+            self._chunks.append(values)
+        else:
+            self._array[self._filled : self._filled + len(values)] = values
+            self._filled += len(values)
+
+    def end(self, shape: tuple):
+        if self._array is None:
+            self._array = np.concatenate(self._chunks or [np.empty(0, self._dtype)])
+            self._chunks = []
+        return self._array.reshape(shape)
+
+
+class Histogram:
+    """Counts of pixel values in equal width bins.
+
+    Histograms with the same bins can be merged, so statistics of chunks or of
+    whole frames combine without revisiting the pixels. Values outside the range
+    count in the first or last bin.
+
+    Attributes:
+        low (float): Lower edge of the first bin.
+        width (float): Width of each bin.
+        counts (ndarray): Number of values in each bin.
+
+    """
+
+    def __init__(self, low: float = 0, high: float = 65536, bins: int = 65536):
+        _require_numpy()
+        self.low = low
+        self.width = (high - low) / bins
+        self.counts = np.zeros(bins, np.int64)
+
+    @property
+    def count(self) -> int:
+        """Number of values counted."""
+        return int(self.counts.sum())
+
+    def add(self, values):
+        """Count an array of values."""
+        values = np.asarray(values).ravel()
+        if not len(values):
+            return
+        bins = len(self.counts)
+        if self.width == 1 and values.dtype.kind in "iu":
+            index = values.astype(np.int64) - int(self.low)
+        else:
+            index = ((values - self.low) / self.width).astype(np.int64)
+        np.clip(index, 0, bins - 1, out=index)
+        self.counts += np.bincount(index, minlength=bins)
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        """Add the counts of a histogram with the same bins to this one."""
+        same = (other.low, other.width, len(other.counts)) == (
+            self.low,
+            self.width,
+            len(self.counts),
+        )
+        if not same:
+            raise ValueError("Histograms with different bins cannot be merged")
+        self.counts += other.counts
+        return self
+
+    def quantile(self, q: float) -> float:
+        """Return the value below which the fraction q of the values lie.
+
+        Exact for integer values and bins of width one, otherwise the centre of
+        the bin holding the quantile.
+        """
+        cumulative = np.cumsum(self.counts)
+        if not cumulative[-1]:
+            return math.nan
+        index = int(np.searchsorted(cumulative, q * cumulative[-1]))
+        index = min(index, len(self.counts) - 1)
+        if self.width == 1:
+            return self.low + index
+        return self.low + (index + 0.5) * self.width
+
+
+class ImageStatistics(NamedTuple):
+    """Statistics of a downloaded image."""
+
+    count: int
+    mean: float
+    median: float
+    minimum: float
+    maximum: float
+    saturated: int
+    histogram: Histogram
+    image: Any = None
+
+
+class StatisticsSink(ImageSink):
+    """Compute image statistics in a single pass while the image streams in.
+
+    Each chunk is reduced with vectorized NumPy operations and then dropped, unless
+    keep is set.
+
+    Args:
+        saturation (float): Values at or above it count as saturated, usually
+            MaxADU. The histogram covers 0 to saturation when given.
+        histogram (Histogram): Histogram to add the values to, for instance to
+            accumulate several frames.
+        keep (bool): Also return the image shaped like ImageArray.
+
+    """
+
+    def __init__(
+        self,
+        saturation: Optional[float] = None,
+        histogram: Optional[Histogram] = None,
+        keep: bool = False,
+    ):
+        _require_numpy()
+        self.saturation = saturation
+        self.histogram = histogram
+        self._array = ArraySink() if keep else None
+
+    def begin(self, shape: tuple, dtype):
+        if self.histogram is None:
+            high = 65536 if self.saturation is None else self.saturation + 1
+            self.histogram = Histogram(0, high, int(min(math.ceil(high), 65536)))
+        self._count = 0
+        self._sum = 0.0
+        self._minimum = math.inf
+        self._maximum = -math.inf
+        self._saturated = 0
+        if self._array is not None:
+            self._array.begin(shape, dtype)
+
+    def write(self, values):
+        if not len(values):
+            return
+        self._count += len(values)
+        self._sum += float(values.sum(dtype=np.float64))
+        self._minimum = min(self._minimum, values.min())
+        self._maximum = max(self._maximum, values.max())
+        if self.saturation is not None:
+            self._saturated += int(np.count_nonzero(values >= self.saturation))
+        self.histogram.add(values)
+        if self._array is not None:
+            self._array.write(values)
+
+    def end(self, shape: tuple) -> ImageStatistics:
+        return ImageStatistics(
+            self._count,
+            self._sum / self._count if self._count else math.nan,
+            self.histogram.quantile(0.5),
+            self._minimum if self._count else math.nan,
+            self._maximum if self._count else math.nan,
+            self._saturated,
+            self.histogram,
+            None if self._array is None else self._array.end(shape),
+        )
+
+
+def bin_image(image, factor: int = 2, mode: str = "sum"):
+    """Software bin an image shaped like ImageArray.
+
+    The first two axes are binned by reshaping, dropping the pixels past the last
+    whole bin as hardware binning does. Colour planes are kept. Requires NumPy.
+
+    Args:
+        image (array_like): Image shaped like ImageArray.
+        factor (int): Number of pixels binned along each axis.
+        mode (str): sum, mean, or stride to keep the first pixel of each bin.
+
+    Returns:
+        Binned image shaped like ImageArray, with int64 or float64 values for sum.
+
+    """
+    _require_numpy()
+    image = np.asarray(image)
+    if mode not in ("sum", "mean", "stride"):
+        raise ValueError("Unknown binning mode %r" % mode)
+    binned = [size // factor for size in image.shape[:2]]
+    if mode == "stride":
+        return image[tuple(slice(0, n * factor, factor) for n in binned)]
+    image = image[tuple(slice(0, n * factor) for n in binned)]
+    shape = [size for n in binned for size in (n, factor)] + list(image.shape[2:])
+    axes = tuple(range(1, 2 * len(binned), 2))
+    total = image.reshape(shape).sum(axis=axes, dtype=_accumulator(image.dtype))
+    if mode == "mean":
+        return total / factor ** len(binned)
+    return total
+
+
+def _accumulator(dtype):
+    """Return the type for summing values of a data type without overflow."""
+    return np.float64 if np.dtype(dtype).kind == "f" else np.int64
+
+
+def autostretch(image, low: float = 0.5, high: float = 99.5):
+    """Stretch an image linearly to 8 bits between two percentiles.
+
+    Args:
+        image (array_like): Image to stretch.
+        low (float): Percentile shown black.
+        high (float): Percentile shown white.
+
+    Returns:
+        uint8 array of the same shape.
+
+    """
+    _require_numpy()
+    image = np.asarray(image, np.float32)
+    if not image.size:
+        return image.astype(np.uint8)
+    black, white = np.percentile(image, (low, high))
+    scale = 255.0 / (white - black) if white > black else 0.0
+    scaled = (image - black) * scale
+    return np.clip(scaled, 0, 255, out=scaled).astype(np.uint8)
+
+
+class PreviewSink(ImageSink):
+    """Bin an image as it streams in, never holding the full frame.
+
+    Values are binned as soon as factor whole lines of the first axis have arrived,
+    so memory use is that of the preview plus one band of lines.
+
+    Args:
+        factor (int): Number of pixels binned along each axis.
+        mode (str): sum, mean, or stride, as for bin_image.
+        stretch (bool): Return the preview stretched to 8 bits with autostretch.
+
+    """
+
+    def __init__(self, factor: int = 4, mode: str = "sum", stretch: bool = False):
+        _require_numpy()
+        self.factor = factor
+        self.mode = mode
+        self.stretch = stretch
+
+    def begin(self, shape: tuple, dtype):
+        self._dtype = dtype
+        self._line = int(np.prod(shape[1:]))
+        self._inner = tuple(shape[1:])
+        self._carry = np.empty(0, dtype)
+        self._bands = []
+
+    def write(self, values):
+        if len(self._carry):
+            values = np.concatenate((self._carry, values))
+        band = self.factor * self._line
+        whole = len(values) // band * band
+        if whole:
+            lines = values[:whole].reshape((whole // self._line,) + self._inner)
+            self._bands.append(self._bin(lines))
+        self._carry = values[whole:].copy()
+
+    def end(self, shape: tuple):
+        if not self._bands:
+            lines = np.empty((0,) + self._inner, self._dtype)
+            self._bands.append(self._bin(lines))
+        preview = np.concatenate(self._bands)
+        self._bands = []
+        return autostretch(preview) if self.stretch else preview
+
+    def _bin(self, lines):
+        return bin_image(lines, self.factor, self.mode)
+
+
+_JSON_TYPES = {1: "int16", 2: "int32", 3: "float64"}
+_SEPARATORS = bytes.maketrans(b"[],", b"   ")
+
+
+class _JsonImageDecoder:
+    """Incrementally decode a JSON ImageArray response into an ImageSink."""
+
+    def __init__(self, sink: ImageSink):
+        self.sink = sink
+        self.shape: tuple = ()
+        self._prefix = b""
+        self._suffix = b""
+        self._raw = b""
+        self._carry = b""
+        self._rank = 0
+        self._depth = 0
+        self._count = 0
+        self._dtype: Any = None
+        self._pending: List[Any] = []
+        self._state = "prefix"
+
+    def feed(self, data: bytes):
+        """Decode the next bytes of the response body."""
+        if not data:
+            return
+        if self._state == "prefix":
+            self._prefix += data
+            match = re.search(rb'"Value"\s*:\s*((?:\[\s*)+)(?=[^\[\s])', self._prefix)
+            if match is None:
+                return
+            self._rank = match.group(1).count(b"[")
+            self._depth = self._rank
+            data = self._prefix[match.end() :]
+            self._prefix = self._prefix[: match.start()]
+            self._state = "shape"
+        if self._state == "shape":
+            self._raw += data
+            data = self._shape()
+            if data is None:
+                return
+        if self._state == "values":
+            data = self._values(data)
+        if self._state == "suffix":
+            self._suffix += data
+
+    def close(self):
+        """Finish decoding and return the result of the sink."""
+        if self._state != "suffix":
+            if self._state != "prefix":
+                raise ErrorMessage("Truncated ImageArray response")
+            reply = json.loads(self._prefix)
+            if reply.get("ErrorNumber", 0) != 0:
+                raise NumericError(reply["ErrorNumber"], reply.get("ErrorMessage", ""))
+            raise ErrorMessage("Response contains no image array")
+        fields = json.loads(self._prefix + b'"Value":null' + self._suffix)
+        if fields.get("ErrorNumber", 0) != 0:
+            raise NumericError(fields["ErrorNumber"], fields.get("ErrorMessage", ""))
+        if self._dtype is None:
+            self._begin(fields.get("Type", 3))
+            for values in self._pending:
+                self.sink.write(values.astype(self._dtype, copy=False))
+            self._pending = []
+        inner = int(np.prod(self.shape[1:])) if self.shape[1:] else 1
+        self.shape = (self._count // inner,) + self.shape[1:]
+        return self.sink.end(self.shape)
+
+    def _shape(self) -> Optional[bytes]:
+        """Find the lengths of all but the first axis from the first element."""
+        trailing = ()
+        if self._rank > 1:
+            depth = self._rank
+            commas = [0] * (self._rank + 1)
+            closed = [False] * (self._rank + 1)
+            for match in re.finditer(rb"[\[\],]", self._raw):
+                char = match.group()
+                if char == b"[":
+                    depth += 1
+                elif char == b"]":
+                    closed[depth] = True
+                    depth -= 1
+                    if depth == 1:
+                        break
+                elif not closed[depth]:
+                    commas[depth] += 1
+            else:
+                return None
+            trailing = tuple(commas[d] + 1 for d in range(2, self._rank + 1))
+        self.shape = (None,) + trailing
+        match = re.search(rb'"Type"\s*:\s*(\d+)', self._prefix)
+        if match:
+            self._begin(int(match.group(1)))
+        else:
+            # Type follows the array, keep the exact float64 values until it is read.
+            self._dtype = None
+            self._parse = np.float64
+        self._state = "values"
+        data, self._raw = self._raw, b""
+        return data
+
+    def _begin(self, type_: int):
+        """Start the sink with the element type given by the Type field."""
+        self._dtype = np.dtype(_JSON_TYPES.get(type_, "float64"))
+        self._parse = np.float64 if self._dtype.kind == "f" else np.int64
+        self.sink.begin(self.shape, self._dtype)
+
+    def _values(self, data: bytes) -> bytes:
+        """Parse the numbers in data and return anything after the array."""
+        brackets = np.frombuffer(data, np.uint8)
+        delta = (brackets == 91).astype(np.int8) - (brackets == 93)
+        depth = self._depth + np.cumsum(delta, dtype=np.int64)
+        closed = np.flatnonzero(depth == 0)
+        if closed.size:
+            end = int(closed[0]) + 1
+            text, rest = self._carry + data[:end], data[end:]
+            self._carry = b""
+            self._state = "suffix"
+        else:
+            text, rest = self._carry + data, b""
+            self._depth = int(depth[-1]) if depth.size else self._depth
+        text = text.translate(_SEPARATORS)
+        if self._state == "values":
+            cut = text.rfind(b" ") + 1
+            text, self._carry = text[:cut], text[cut:]
+        if text.strip():
+            values = np.fromstring(text, dtype=self._parse, sep=" ")
+            self._count += len(values)
+            if self._dtype is None:
+                self._pending.append(values)
+            else:
+                self.sink.write(values.astype(self._dtype, copy=False))
+        return rest
+
+
+_IMAGE_ELEMENT_TYPES = {
+    1: "<i2",
+    2: "<i4",
+    3: "<f8",
+    4: "<f4",
+    5: "<u8",
+    6: "u1",
+    7: "<i8",
+    8: "<u2",
+    9: "<u4",
+}
+
+
+class _ImageBytesDecoder:
+    """Incrementally decode an Alpaca ImageBytes response into an ImageSink."""
+
+    _header = struct.Struct("<iiIIiiiiiii")
+
+    def __init__(self, sink: ImageSink):
+        self.sink = sink
+        self.shape: tuple = ()
+        self._buffer = b""
+        self._header_done = False
+        self._error: Optional[tuple] = None
+
+    def feed(self, data: bytes):
+        """Decode the next bytes of the response body."""
+        self._buffer += data
+        if not self._header_done:
+            if len(self._buffer) < self._header.size:
+                return
+            fields = self._header.unpack_from(self._buffer)
+            error, data_start, element, transmission, rank = (
+                fields[1],
+                fields[4],
+                fields[5],
+                fields[6],
+                fields[7],
+            )
+            if error != 0:
+                self._error = (error, data_start)
+                return
+            if len(self._buffer) < data_start:
+                return
+            self.shape = tuple(fields[8 : 8 + rank])
+            self._dtype = np.dtype(_IMAGE_ELEMENT_TYPES[element])
+            self._transmission = np.dtype(_IMAGE_ELEMENT_TYPES[transmission])
+            self._buffer = self._buffer[data_start:]
+            self._header_done = True
+            self.sink.begin(self.shape, self._dtype)
+        usable = len(self._buffer) - len(self._buffer) % self._transmission.itemsize
+        if usable:
+            values = np.frombuffer(self._buffer[:usable], self._transmission)
+            self.sink.write(values.astype(self._dtype))
+            self._buffer = self._buffer[usable:]
+
+    def close(self):
+        """Finish decoding and return the result of the sink."""
+        if self._error is not None:
+            error, data_start = self._error
+            message = self._buffer[data_start:].decode("utf-8", "replace")
+            raise NumericError(error, message)
+        if not self._header_done or self._buffer:
+            raise ErrorMessage("Truncated ImageBytes response")
+        return self.sink.end(self.shape)
+
+
+class _CountedChunks:
+    """Iterate over chunks of a response body counting and optionally keeping them."""
+
+    def __init__(
+        self,
+        chunks,
+        throttle: Optional[Callable[[int], Any]] = None,
+        keep: bool = False,
+    ):
+        self._chunks = chunks
+        self._throttle = throttle
+        self.kept: Optional[List[bytes]] = [] if keep else None
+        self.bytes = 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.bytes += len(chunk)
+            if self._throttle is not None:
+                self._throttle(len(chunk))
+            if self.kept is not None:
+                self.kept.append(chunk)
+            yield chunk
+
+
+def _decode_chunks(chunks, encoding: str, imagebytes: bool, sink: ImageSink) -> tuple:
+    """Decompress and decode the chunks of an ImageArray response into a sink.
+
+    Returns:
+        Result of the sink, image shape, decompressed bytes and the CPU seconds
+        spent decompressing and decoding.
+
+    """
+    decompressor = _decompressor(encoding)
+    decoder = (_ImageBytesDecoder if imagebytes else _JsonImageDecoder)(sink)
+    decoded = 0
+    decompress_cpu = decode_cpu = 0.0
+    for chunk in itertools.chain(chunks, [None]):
+        cpu = time.thread_time()
+        if chunk is None:
+            chunk = decompressor.flush()
+        else:
+            chunk = decompressor.decompress(chunk)
+        decompress_cpu += time.thread_time() - cpu
+        decoded += len(chunk)
+        cpu = time.thread_time()
+        decoder.feed(chunk)
+        decode_cpu += time.thread_time() - cpu
+    cpu = time.thread_time()
+    result = decoder.close()
+    decode_cpu += time.thread_time() - cpu
+    return result, decoder.shape, decoded, decompress_cpu, decode_cpu
+
+
+_worker_blocks: List[shared_memory.SharedMemory] = []
+
+
+def _decode_shared(body: bytes, encoding: str, imagebytes: bool) -> tuple:
+    """Decode an ImageArray response body into a new shared memory block.
+
+    Runs in a worker process. The block is left to the process that attaches it,
+    which unlinks it with _discard_shared if attaching fails. The worker only
+    keeps its handle until the next task so the block outlives the return on
+    platforms that free it with the last handle.
+
+    Returns:
+        Name of the block, image shape, dtype name, decompressed bytes and the CPU
+        seconds spent decompressing and decoding.
+
+    """
+    while _worker_blocks:
+        _worker_blocks.pop().close()
+    image, shape, decoded, decompress_cpu, decode_cpu = _decode_chunks(
+        [body], encoding, imagebytes, ArraySink()
+    )
+    block = _untracked_block(max(image.nbytes, 1))
+    np.ndarray(image.shape, image.dtype, buffer=block.buf)[...] = image
+    _worker_blocks.append(block)
+    return block.name, shape, image.dtype.str, decoded, decompress_cpu, decode_cpu
+
+
+def _discard_shared(future: Future):
+    """Unlink the block of a _decode_shared call whose result was not attached.
+
+    The block is not tracked, so nothing else would free it before reboot.
+    """
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        block = shared_memory.SharedMemory(future.result()[0])
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+def _untracked_block(size: int) -> shared_memory.SharedMemory:
+    """Create a shared memory block that is not unlinked when this process exits."""
+    try:
+        return shared_memory.SharedMemory(create=True, size=size, track=False)
+    except TypeError:  # Python before 3.13 always tracks
+        block = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(block._name, "shared_memory")
+        return block
+
+
+class _Reclaimer:
+    """Thread closing and unlinking shared memory blocks once nobody uses them.
+
+    Finalizers of shared arrays run while the dying array still references the
+    mapping, so they only wake this thread, which collects shortly afterwards.
+    While released SharedFrameBuffer blocks wait for consumers in other processes,
+    which cannot wake it, it collects every poll_interval seconds.
+    """
+
+    def __init__(self, delay: float = 0.05, poll_interval: float = 0.5):
+        self.delay = delay
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        """Collect soon, starting the thread on first use and after a fork."""
+        self._wake.set()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="shm-reclaim", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        pending = False
+        while True:
+            self._wake.wait(self.poll_interval if pending else None)
+            self._wake.clear()
+            time.sleep(self.delay)
+            _shared_arrays.reclaim()
+            pending = _frame_blocks.collect()
+
+
+_reclaimer = _Reclaimer()
+
+
+class _SharedArrays:
+    """Arrays viewing shared memory blocks created by other processes.
+
+    A block is unlinked as soon as it is attached, so the memory is freed once
+    the last process unmaps it. NumPy arrays keep a reference to the mapping of
+    the block but not to the block, so a block is only closed once the reference
+    count of its mapping shows that no array uses it any more. Closing is retried
+    by the reclaimer whenever an attached array is garbage collected and before
+    each new attach.
+    """
+
+    def __init__(self):
+        self._blocks: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def attach(
+        self,
+        name: str,
+        shape: tuple,
+        dtype: str,
+        offset: int = 0,
+        slot: Optional[int] = None,
+    ):
+        """Return an array viewing a shared memory block.
+
+        Without a slot the block is unlinked. With a slot the block belongs to a
+        SharedFrameBuffer, which is told through the slot byte when the array is
+        gone.
+        """
+        self.reclaim()
+        if slot is None:
+            block = shared_memory.SharedMemory(name)
+            block.unlink()
+        else:
+            block = _open_block(name)
+        references = sys.getrefcount(block.buf.obj)
+        array = np.ndarray(shape, dtype, buffer=block.buf, offset=offset)
+        with self._lock:
+            self._blocks.append((block, references))
+        weakref.finalize(array, self._released, block, slot).atexit = False
+        return array
+
+    def reclaim(self):
+        """Close the blocks no longer used by any array."""
+        with self._lock:
+            blocks, self._blocks = self._blocks, []
+            for block, references in blocks:
+                try:
+                    if sys.getrefcount(block.buf.obj) > references:
+                        raise BufferError
+                    block.close()
+                except BufferError:
+                    self._blocks.append((block, references))
+
+    def _released(self, block: shared_memory.SharedMemory, slot: Optional[int]):
+        if slot is not None:
+            block.buf[slot] = 0
+        _reclaimer.wake()
+
+
+_shared_arrays = _SharedArrays()
+
+
+def _open_block(name: str) -> shared_memory.SharedMemory:
+    """Attach a shared memory block owned by another process.
+
+    Before Python 3.13 attaching registers the block with the resource tracker,
+    which unlinks it when the tracker exits. That tracker is the owner's for
+    processes started by multiprocessing, so the registration is left alone:
+    removing it would also remove the owner's.
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:  # Python before 3.13 always tracks
+        return shared_memory.SharedMemory(name)
+
+
+_FRAME_SLOTS = 64
+
+
+class SharedFrame(NamedTuple):
+    """Descriptor of a frame in a SharedFrameBuffer, cheap to pass to processes.
+
+    Every descriptor holds one reference to the buffer, given up when the array
+    returned by attach and all its views are garbage collected. A descriptor that
+    is never attached keeps the buffer until the owning process exits.
+
+    Attributes:
+        name (str): Name of the shared memory block.
+        shape (tuple): Shape of the frame, like ImageArray.
+        dtype (str): NumPy data type of the pixel values.
+        metadata (dict): Exposure metadata, see Camera.download_shared.
+        slot (int): Reference slot of this descriptor in the block header.
+
+    """
+
+    name: str
+    shape: tuple
+    dtype: str
+    metadata: Dict[str, Any]
+    slot: int
+
+    def attach(self):
+        """Map the frame into this process without copying it.
+
+        Attach each descriptor once, SharedFrameBuffer.share makes a descriptor
+        per consumer.
+
+        Returns:
+            Array viewing the frame.
+
+        """
+        _require_numpy()
+        return _shared_arrays.attach(
+            self.name, self.shape, self.dtype, _FRAME_SLOTS, self.slot
+        )
+
+
+class _FrameBlocks:
+    """Shared memory blocks of the SharedFrameBuffers of this process.
+
+    A block is unlinked and closed once its buffer was released or garbage
+    collected, every descriptor slot in its header is clear again and no array of
+    this process uses it. Released blocks are collected before each new buffer,
+    by the reclaimer until none is left, and at exit.
+    """
+
+    def __init__(self):
+        self._blocks: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        atexit.register(self._unlink_all)
+
+    def add(self, block: shared_memory.SharedMemory, references: int):
+        self.collect()
+        with self._lock:
+            self._blocks[block.name] = [block, references, False]
+
+    def release(self, name: str):
+        with self._lock:
+            if name in self._blocks:
+                self._blocks[name][2] = True
+        _reclaimer.wake()
+
+    def collect(self) -> bool:
+        """Unlink and close the released blocks nobody uses any more.
+
+        Returns:
+            Whether released blocks are left.
+
+        """
+        with self._lock:
+            for name, (block, references, released) in list(self._blocks.items()):
+                if not released or any(block.buf[:_FRAME_SLOTS]):
+                    continue
+                if sys.getrefcount(block.buf.obj) > references:
+                    continue
+                try:
+                    block.close()
+                except BufferError:
+                    continue
+                _unlink(block)
+                del self._blocks[name]
+            return any(released for _, _, released in self._blocks.values())
+
+    def _unlink_all(self):
+        with self._lock:
+            for block, _, _ in self._blocks.values():
+                _unlink(block)
+            self._blocks.clear()
+
+
+def _unlink(block: shared_memory.SharedMemory):
+    """Unlink a shared memory block unless a resource tracker already did."""
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+_frame_blocks = _FrameBlocks()
+
+
+class SharedFrameBuffer:
+    """Frame in shared memory that other processes attach to without copying.
+
+    The block starts with one reference byte per descriptor handed out by share,
+    followed by the pixel values. It is reclaimed once the buffer is released or
+    garbage collected and all descriptors have been released by their consumers.
+
+    Attributes:
+        name (str): Name of the shared memory block.
+        shape (tuple): Shape of the frame, like ImageArray.
+        dtype (dtype): NumPy data type of the pixel values.
+        metadata (dict): Exposure metadata.
+        array (ndarray): The frame, writable by the owner.
+
+    """
+
+    def __init__(self, shape: tuple, dtype, metadata: Optional[Dict[str, Any]] = None):
+        """Initialize SharedFrameBuffer object and create its shared memory block."""
+        _require_numpy()
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.metadata = metadata or {}
+        size = _FRAME_SLOTS + max(int(np.prod(shape)) * self.dtype.itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        block.buf[:_FRAME_SLOTS] = bytes(_FRAME_SLOTS)
+        self.name = block.name
+        _frame_blocks.add(block, sys.getrefcount(block.buf.obj))
+        self.array = np.ndarray(
+            shape, self.dtype, buffer=block.buf, offset=_FRAME_SLOTS
+        )
+        self._block = block
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, _frame_blocks.release, self.name)
+        self._finalizer.atexit = False
+
+    def share(self) -> SharedFrame:
+        """Return a descriptor holding a new reference to the frame.
+
+        Raises:
+            RuntimeError: If all descriptor slots are in use.
+
+        """
+        with self._lock:
+            slot = bytes(self._block.buf[:_FRAME_SLOTS]).find(0)
+            if slot < 0:
+                raise RuntimeError("All %d frame references in use" % _FRAME_SLOTS)
+            self._block.buf[slot] = 1
+        return SharedFrame(self.name, self.shape, self.dtype.str, self.metadata, slot)
+
+    @property
+    def references(self) -> int:
+        """Number of descriptors not yet released by their consumers."""
+        return sum(self._block.buf[:_FRAME_SLOTS])
+
+    def release(self):
+        """Give up the reference of the owner, the array must no longer be used."""
+        self.array = None
+        self._finalizer()
+
+    def __enter__(self) -> "SharedFrameBuffer":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SharedFrameSink(ImageSink):
+    """Decode an image straight into a SharedFrameBuffer.
+
+    When the transfer format announces the shape up front, as ImageBytes does, the
+    values are written into shared memory as they arrive. Otherwise they are
+    collected and copied once at the end.
+
+    Args:
+        metadata (dict): Exposure metadata stored with the frame.
+
+    """
+
+    def __init__(self, metadata: Optional[Dict[str, Any]] = None):
+        self.metadata = metadata
+
+    def begin(self, shape: tuple, dtype):
+        self._dtype = dtype
+        self._buffer: Optional[SharedFrameBuffer] = None
+        self._chunks = ArraySink()
+        if shape[0] is None:
+            self._chunks.begin(shape, dtype)
+        else:
+            self._buffer = SharedFrameBuffer(shape, dtype, self.metadata)
+            self._flat = self._buffer.array.reshape(-1)
+            self._filled = 0
+
+    def write(self, values):
+        if self._buffer is None:
+            self._chunks.write(values)
+        else:
+            self._flat[self._filled : self._filled + len(values)] = values
+            self._filled += len(values)
+
+    def end(self, shape: tuple) -> SharedFrameBuffer:
+        if self._buffer is None:
+            self._buffer = SharedFrameBuffer(shape, self._dtype, self.metadata)
+            self._buffer.array[...] = self._chunks.end(shape)
+        self._flat = None
+        return self._buffer
+
+
+class _TokenBucket:
+    """Limit the rate of bytes shared by several threads."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size: int):
+        """Take size bytes worth of tokens, sleeping while the bucket is in debt."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._time) * self.rate
+            )
+            self._time = now
+            self._tokens -= size
+            debt = -self._tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+
+class _Download(NamedTuple):
+    camera: "Camera"
+    kwargs: Dict[str, Any]
+    future: Future
+    queued: float
+
+
+class DownloadScheduler:
+    """Run image downloads of several cameras with limited concurrency and rate.
+
+    Completed frames are queued and downloaded by max_concurrent threads, frames
+    that block the next exposure of their camera first. Within the same urgency
+    the frame expected to finish soonest goes first, estimated from the frame
+    size and throughput measured on earlier downloads of its camera, so quick
+    frames are not stuck behind large ones. A bandwidth cap is shared by all
+    downloads.
+
+    Attributes:
+        max_concurrent (int): Number of simultaneous downloads.
+        bandwidth (float): Cap on the combined rate in bytes per second, None for
+            no cap.
+        smoothing (float): Weight of the newest download in the throughput and
+            size averages.
+
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 2,
+        bandwidth: Optional[float] = None,
+        smoothing: float = 0.3,
+    ):
+        """Initialize DownloadScheduler object and start its download threads."""
+        self.max_concurrent = max_concurrent
+        self.bandwidth = bandwidth
+        self.smoothing = smoothing
+        self._bucket = None
+        if bandwidth is not None:
+            self._bucket = _TokenBucket(bandwidth, max(bandwidth / 4, 262144))
+        self._queue: List[tuple] = []
+        self._sequence = itertools.count()
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._run, name="download-%d" % n, daemon=True)
+            for n in range(max_concurrent)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, camera: "Camera", blocking: bool = False, **kwargs) -> Future:
+        """Queue the download of the last image of a camera.
+
+        Args:
+            camera (Camera): Camera whose image is ready.
+            blocking (bool): Whether the next exposure of the camera waits for this
+                download.
+            **kwargs: Options passed to Camera.download_image.
+
+        Returns:
+            Future resolving to the result of download_image.
+
+        """
+        future: Future = Future()
+        priority = PRIORITY_HIGH if blocking else PRIORITY_NORMAL
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("DownloadScheduler is closed")
+            key = (priority, self._expected(camera), next(self._sequence))
+            download = _Download(camera, kwargs, future, time.monotonic())
+            heapq.heappush(self._queue, key + (download,))
+            self._condition.notify()
+        return future
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Return download statistics of each camera.
+
+        Returns:
+            For each camera base URL the number of frames and bytes downloaded and
+            the averages of frame size, throughput in bytes per second and seconds
+            waited in the queue.
+
+        """
+        with self._condition:
+            return {url: dict(stats) for url, stats in self._stats.items()}
+
+    def close(self, wait: bool = True):
+        """Stop accepting downloads, finishing the queued ones if wait is set."""
+        with self._condition:
+            self._closed = True
+            if not wait:
+                for *_, download in self._queue:
+                    download.future.cancel()
+                self._queue.clear()
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self) -> "DownloadScheduler":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _expected(self, camera: "Camera") -> float:
+        """Estimate the seconds a download of the camera takes, 0 if unknown."""
+        stats = self._stats.get(camera.base_url)
+        if not stats or not stats["throughput"]:
+            return 0.0
+        return stats["size"] / stats["throughput"]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                *_, download = heapq.heappop(self._queue)
+            if not download.future.set_running_or_notify_cancel():
+                continue
+            waited = time.monotonic() - download.queued
+            throttle = None if self._bucket is None else self._bucket.consume
+            try:
+                result = download.camera.download_image(
+                    throttle=throttle, **download.kwargs
+                )
+            except BaseException as e:
+                download.future.set_exception(e)
+                continue
+            self._measured(download.camera, download.camera.last_download, waited)
+            download.future.set_result(result)
+
+    def _measured(self, camera: "Camera", report: "DownloadReport", waited: float):
+        """Fold a finished download into the averages of its camera."""
+        with self._condition:
+            stats = self._stats.get(camera.base_url)
+            if stats is None:
+                stats = self._stats[camera.base_url] = {
+                    "frames": 0,
+                    "bytes": 0,
+                    "size": report.wire_bytes,
+                    "throughput": report.throughput,
+                    "wait": waited,
+                }
+            weight = self.smoothing
+            stats["frames"] += 1
+            stats["bytes"] += report.wire_bytes
+            for name, value in (
+                ("size", report.wire_bytes),
+                ("throughput", report.throughput),
+                ("wait", waited),
+            ):
+                if math.isnan(stats[name]):
+                    stats[name] = value
+                elif not math.isnan(value):
+                    stats[name] += weight * (value - stats[name])
+
+
+def _kernel(rows: List[List[float]], scale: float) -> Dict[tuple, float]:
+    """Return the non-zero weights of a square kernel keyed by (dy, dx)."""
+    half = len(rows) // 2
+    return {
+        (y - half, x - half): weight / scale
+        for y, row in enumerate(rows)
+        for x, weight in enumerate(row)
+        if weight
+    }
+
+
+_DEMOSAIC_KERNELS = {
+    "bilinear": {
+        "green": _kernel([[0, 1, 0], [1, 0, 1], [0, 1, 0]], 4),
+        "row": _kernel([[0, 0, 0], [1, 0, 1], [0, 0, 0]], 2),
+        "column": _kernel([[0, 1, 0], [0, 0, 0], [0, 1, 0]], 2),
+        "diagonal": _kernel([[1, 0, 1], [0, 0, 0], [1, 0, 1]], 4),
+    },
+    "mhc": {
+        "green": _kernel(
+            [
+                [0, 0, -1, 0, 0],
+                [0, 0, 2, 0, 0],
+                [-1, 2, 4, 2, -1],
+                [0, 0, 2, 0, 0],
+                [0, 0, -1, 0, 0],
+            ],
+            8,
+        ),
+        "row": _kernel(
+            [
+                [0, 0, 0.5, 0, 0],
+                [0, -1, 0, -1, 0],
+                [-1, 4, 5, 4, -1],
+                [0, -1, 0, -1, 0],
+                [0, 0, 0.5, 0, 0],
+            ],
+            8,
+        ),
+        "column": _kernel(
+            [
+                [0, 0, -1, 0, 0],
+                [0, -1, 4, -1, 0],
+                [0.5, 0, 5, 0, 0.5],
+                [0, -1, 4, -1, 0],
+                [0, 0, -1, 0, 0],
+            ],
+            8,
+        ),
+        "diagonal": _kernel(
+            [
+                [0, 0, -1.5, 0, 0],
+                [0, 2, 0, 2, 0],
+                [-1.5, 0, 6, 0, -1.5],
+                [0, 2, 0, 2, 0],
+                [0, 0, -1.5, 0, 0],
+            ],
+            8,
+        ),
+    },
+}
+
+
+def demosaic(
+    image,
+    SensorType: int = 2,
+    BayerOffsetX: int = 0,
+    BayerOffsetY: int = 0,
+    method: str = "bilinear",
+):
+    """Convert a raw colour image to RGB with vectorized interpolation.
+
+    Each missing colour is interpolated only at the quarter of the pixels that needs
+    it, working on strided views of the mosaic. Requires NumPy.
+
+    Args:
+        image (array_like): Image shaped like ImageArray, (NumX, NumY) for raw
+            mosaics or (NumX, NumY, 3) for SensorType 1.
+        SensorType (int): 0 = Monochrome, 1 = Colour, 2 = RGGB. Other sensor types
+            are not supported.
+        BayerOffsetX (int): X position of the red pixel of the Bayer matrix relative
+            to the first column of the image.
+        BayerOffsetY (int): Y position of the red pixel of the Bayer matrix relative
+            to the first row of the image.
+        method (str): bilinear, or mhc for the gradient corrected Malvar-He-Cutler
+            interpolation.
+
+    Returns:
+        Float32 array of shape (NumY, NumX, 3).
+
+    """
+    _require_numpy()
+    image = np.asarray(image)
+    if SensorType == 0:
+        return np.repeat(image.T[:, :, None], 3, axis=2).astype(np.float32)
+    if SensorType == 1:
+        return np.transpose(image, (1, 0, 2)).astype(np.float32)
+    if SensorType != 2:
+        raise ValueError("Demosaicing SensorType %d is not supported" % SensorType)
+    if method not in _DEMOSAIC_KERNELS:
+        raise ValueError("Unknown demosaic method %r" % method)
+    kernels = _DEMOSAIC_KERNELS[method]
+    raw = image.T.astype(np.float32)
+    padded = np.pad(raw, 2, mode="reflect")
+    planes = {
+        (y, x): np.ascontiguousarray(padded[y::2, x::2]) for y in (0, 1) for x in (0, 1)
+    }
+    rgb = np.empty(raw.shape + (3,), np.float32)
+    for row in (0, 1):
+        for column in (0, 1):
+            sites = rgb[row::2, column::2]
+            height, width = sites.shape[:2]
+            scratch = np.empty((height, width), np.float32)
+
+            def evaluate(weights: Dict[tuple, float]):
+                total = np.zeros((height, width), np.float32)
+                for (dy, dx), weight in weights.items():
+                    y, x = row + 2 + dy, column + 2 + dx
+                    plane = planes[y % 2, x % 2]
+                    window = plane[y // 2 : y // 2 + height, x // 2 : x // 2 + width]
+                    total += np.multiply(window, weight, out=scratch)
+                return total
+
+            value = raw[row::2, column::2]
+            red_row = (row - BayerOffsetY) % 2 == 0
+            red_column = (column - BayerOffsetX) % 2 == 0
+            if red_row == red_column:
+                green, other = evaluate(kernels["green"]), evaluate(kernels["diagonal"])
+                channels = (value, green, other) if red_row else (other, green, value)
+            else:
+                across, along = evaluate(kernels["row"]), evaluate(kernels["column"])
+                if not red_row:
+                    across, along = along, across
+                channels = (across, value, along)
+            for channel, plane in enumerate(channels):
+                sites[:, :, channel] = plane
+    if method != "bilinear":
+        np.clip(rgb, 0.0, raw.max(initial=0.0), out=rgb)
+    return rgb
+
+
+class NumericError(Exception):
+    """Exception for when Alpaca throws an error with a numeric value.
+
+    Args:
+        ErrorNumber (int): Non-zero integer.
+        ErrorMessage (str): Message describing the issue that was encountered.
+
+    """
+
+    def __init__(self, ErrorNumber: int, ErrorMessage: str):
+        """Initialize NumericError object."""
+        super().__init__(ErrorNumber, ErrorMessage)
+        self.ErrorNumber = ErrorNumber
+        self.message = "Error %d: %s" % (ErrorNumber, ErrorMessage)
+
+    def __str__(self):
+        """Message to display with error."""
+        return self.message
+
+
+class ErrorMessage(Exception):
+    """Exception for when Alpaca throws an error without a numeric value.
+
+    Args:
+        Value (str): Message describing the issue that was encountered.
+
+    """
+
+    def __init__(self, Value: str):
+        """Initialize ErrorMessage object."""
+        super().__init__(Value)
+        self.message = Value
+
+    def __str__(self):
+        """Message to display with error."""
+        return self.message
+
+
+def CreateClient(name):
+    devname = list(typ(val)
+                   for typ, val in zip((str, str, int), name.split('/')))
+    return globals()[devname[0]](*devname[1:])
+
+
+def discover(
+    timeout: float = 2.0, port: int = 32227, address: str = "255.255.255.255"
+) -> List[str]:
+    """Find Alpaca servers with the UDP discovery protocol.
+
+    Args:
+        timeout (float): Seconds to wait for responses.
+        port (int): Discovery port.
+        address (str): Broadcast or server address the query is sent to.
+
+    Returns:
+        Sorted host:port addresses of the servers that answered.
+
+    """
+    found = set()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.sendto(b"alpacadiscovery1", (address, port))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (host, _) = sock.recvfrom(1024)
+            except socket.timeout:
+                break
+            try:
+                found.add("%s:%d" % (host, json.loads(data)["AlpacaPort"]))
+            except (ValueError, KeyError, TypeError):
+                _log.debug("Ignoring discovery response %r from %s", data, host)
+    return sorted(found)
+
+
+def configured_devices(
+    address: str, protocall: str = "http", timeout: Optional[float] = 5.0
+) -> List[Dict[str, Any]]:
+    """List the devices of an Alpaca server with the management API.
+
+    Args:
+        address (str): Domain name or IP address of the server, with its port.
+        protocall (str): Protocall used to communicate with the server.
+        timeout (float): Seconds to wait for the response.
+
+    Returns:
+        DeviceName, DeviceType, DeviceNumber and UniqueID of every device.
+
+    """
+    url = "%s://%s/management/v1/configureddevices" % (protocall, address)
+    return requests.get(url, timeout=timeout).json()["Value"]
+
+
+def _device_class(device_type: str) -> type:
+    """Return the Device subclass for a device type, ignoring case."""
+    for value in globals().values():
+        if (
+            isinstance(value, type)
+            and issubclass(value, Device)
+            and value.__name__.lower() == device_type.lower()
+        ):
+            return value
+    raise ValueError("Unknown device type %r" % device_type)
+
+
+def _format(value: Any) -> str:
+    if isinstance(value, Exception):
+        return "error: %s" % value
+    if isinstance(value, float):
+        return "%.6g" % value
+    return str(value)
+
+
+def _command_discover(args, device: None):
+    for address in discover(args.timeout):
+        print(address)
+        try:
+            devices = configured_devices(address, timeout=args.timeout)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print("  error: %s" % e)
+            continue
+        for device in devices:
+            print(
+                "  %-20s %d  %s"
+                % (device["DeviceType"], device["DeviceNumber"], device["DeviceName"])
+            )
+
+
+def _command_status(args, device: Device):
+    values = device.read_all(args.properties)
+    width = max(map(len, values), default=0)
+    for name, value in values.items():
+        print("%-*s  %s" % (width, name, _format(value)))
+
+
+def _command_top(args, device: Device):
+    values = device.read_all(args.properties)
+    changed = {name: time.monotonic() for name in values}
+    subscriptions = []
+
+    def update(name: str, old: Any, new: Any):
+        values[name] = new
+        changed[name] = time.monotonic()
+
+    for name, value in values.items():
+        if not isinstance(value, Exception):
+            subscriptions.append(device.on_change(name, update, args.interval))
+    width = max(map(len, values), default=0)
+    try:
+        while True:
+            now = time.monotonic()
+            lines = ["%s  %s" % (device.base_url, time.strftime("%H:%M:%S")), ""]
+            for name, value in values.items():
+                lines.append(
+                    "%-*s  %8.1fs  %s"
+                    % (width, name, now - changed[name], _format(value))
+                )
+            print("\x1b[H\x1b[J" + "\n".join(lines), flush=True)
+            time.sleep(args.refresh)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for subscription in subscriptions:
+            subscription.cancel()
+
+
+def _command_bench(args, device: Device):
+    results = benchmark(device, args.attributes, args.calls, args.images)
+    print("%-20s %9s %9s %9s %9s %6s" % ("ms", "p50", "p95", "p99", "max", "errors"))
+    for name, stats in results.items():
+        if "p50" in stats:
+            latencies = [stats[key] for key in ("p50", "p95", "p99", "max")]
+            print(
+                "%-20s %9.3f %9.3f %9.3f %9.3f %6d"
+                % (name, *latencies, stats["errors"])
+            )
+        else:
+            print(
+                "%-20s %9.3f s  %12d bytes  %9.1f MB/s"
+                % (name, stats["seconds"], stats["bytes"], stats["mb_per_s"])
+            )
+
+
+def _print_stats(title: str, stats: Dict[str, Dict[str, float]]):
+    columns = ("count", "errors", "p50", "p95", "p99", "max")
+    print("%-40s %7s %6s %9s %9s %9s %9s" % (title, *columns))
+    for name, row in sorted(stats.items()):
+        latencies = [row[key] for key in ("p50", "p95", "p99", "max")]
+        print(
+            "%-40s %7d %6d %9.3f %9.3f %9.3f %9.3f"
+            % (name, row["count"], row["errors"], *latencies)
+        )
+
+
+def _command_trace(args, device: None):
+    records = read_trace(args.path)
+    analysis = analyze_trace(records, args.factor, args.outliers)
+    _print_stats("endpoint (ms)", analysis.endpoints)
+    print()
+    _print_stats("host (ms)", analysis.hosts)
+    print()
+    print("outliers")
+    for record in analysis.outliers:
+        print(
+            "  %s  %-40s %9.3f ms  %s"
+            % (
+                datetime.fromtimestamp(record["time"]).isoformat(" "),
+                record["endpoint"],
+                record["duration"] * 1000.0,
+                record["error"] or "",
+            )
+        )
+    if args.plot:
+        plot_trace(records, args.plot)
+
+
+def _command_connect(args, device: None):
+    report = Profile.load(args.profile).connect(args.devices or None)
+    for name, result in sorted(report.results.items(), key=lambda i: i[1].started):
+        print(
+            "%-20s %8.3f s %8.3f s  %s"
+            % (
+                name,
+                result.started,
+                result.finished - result.started,
+                "error: %s" % result.error if result.error else "connected",
+            )
+        )
+    path = " > ".join(report.critical_path)
+    print("%-20s %8.3f s  via %s" % ("total", report.elapsed, path))
+
+
+def main(argv: Optional[List[str]] = None):
+    """Run the alpyca command line tool."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="alpyca", description="Inspect and benchmark ASCOM Alpaca devices."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("discover", help="find Alpaca servers")
+    command.add_argument("--timeout", type=float, default=2.0)
+    command.set_defaults(run=_command_discover, device=False)
+    command = commands.add_parser("trace", help="analyze a TraceSink file")
+    command.add_argument("path")
+    command.add_argument("--factor", type=float, default=5.0)
+    command.add_argument("--outliers", type=int, default=20)
+    command.add_argument("--plot", help="save a latency plot to this image file")
+    command.set_defaults(run=_command_trace, device=False)
+    command = commands.add_parser("connect", help="connect the devices of a profile")
+    command.add_argument("profile", help="JSON or TOML profile")
+    command.add_argument("devices", nargs="*", help="devices to connect, default all")
+    command.set_defaults(run=_command_connect, device=False)
+    for name, run, summary in (
+        ("status", _command_status, "read all properties of a device once"),
+        ("top", _command_top, "show properties of a device as they change"),
+        ("bench", _command_bench, "measure request latency and image throughput"),
+    ):
+        command = commands.add_parser(name, help=summary)
+        command.add_argument("device_type", help="device type, e.g. telescope")
+        command.add_argument("device_number", type=int, nargs="?", default=0)
+        target = command.add_mutually_exclusive_group(required=True)
+        target.add_argument("--address", help="host:port of the Alpaca server")
+        target.add_argument(
+            "--mock", action="store_true", help="use a built-in simulated server"
+        )
+        command.set_defaults(run=run, device=True)
+    commands.choices["status"].add_argument("--properties", nargs="+")
+    commands.choices["top"].add_argument("--properties", nargs="+")
+    commands.choices["top"].add_argument("--interval", type=float, default=1.0)
+    commands.choices["top"].add_argument("--refresh", type=float, default=0.5)
+    commands.choices["bench"].add_argument("--attributes", nargs="+")
+    commands.choices["bench"].add_argument("--calls", type=int, default=200)
+    commands.choices["bench"].add_argument("--images", type=int, default=3)
+    args = parser.parse_args(argv)
+    if not args.device:
+        args.run(args, None)
+        return
+    server = MockServer().start() if args.mock else None
+    try:
+        address = server.address if server else args.address
+        device = _device_class(args.device_type)(address, args.device_number)
+        args.run(args, device)
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ setuptools.setup(
     license="LICENSE.txt",
     py_modules=["alpycaclient"],
     install_requires=["requests", "python-dateutil"],
+    extras_require={"numpy": ["numpy"], "plot": ["matplotlib"]},
+    entry_points={"console_scripts": ["alpyca=alpycaclient:main"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "Development Status :: 4 - Beta",
@@ -1,2 +1,760 @@
 """This module contains test cases for Alpyca."""
+import gzip
+import json
+import glob
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+import requests
 from pytest import fixture
+
+import alpycaclient
+from alpycaclient import (
+    PRIORITY_HIGH,
+    ArraySink,
+    Camera,
+    Dome,
+    DownloadScheduler,
+    DomeSlaver,
+    FastTransport,
+    FilterWheel,
+    Focuser,
+    MockServer,
+    ObservingConditions,
+    OperationPlan,
+    PositionModel,
+    Profile,
+    PreviewSink,
+    PropertyPoller,
+    PulseGuider,
+    ReplayServer,
+    SafetyMonitor,
+    SafetyWatchdog,
+    SharedFrameBuffer,
+    ShutdownStep,
+    StatisticsSink,
+    TargetPlanner,
+    Telescope,
+    TraceSink,
+    TrafficRecorder,
+    shutdown_plan,
+    wait_until,
+)
+
+
+@fixture
+def server():
+    """Start a MockServer that records the attribute of every request it gets."""
+    mock = MockServer(image_shape=(9, 7)).start()
+    mock.requests = []
+    serve = mock.serve
+
+    def record(handler, method):
+        attribute = handler.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        mock.requests.append((method, attribute, time.perf_counter()))
+        serve(handler, method)
+
+    mock.serve = record
+    yield mock
+    mock.stop()
+
+
+def start(function, *args):
+    thread = threading.Thread(target=function, args=args)
+    thread.start()
+    return thread
+
+
+def test_puts_are_serialized_by_priority(server):
+    telescope = Telescope(server.address, 0)
+    telescope.priorities = dict(Telescope.priorities, findhome=PRIORITY_HIGH)
+    server.latency = 0.2
+    threads = [start(setattr, telescope, "Tracking", True)]
+    time.sleep(0.05)
+    threads.append(start(setattr, telescope, "SlewSettleTime", 1))
+    time.sleep(0.02)
+    threads.append(start(telescope.FindHome))
+    time.sleep(0.02)
+    threads.append(start(telescope.AbortSlew))
+    for thread in threads:
+        thread.join()
+    puts = [(attribute, at) for method, attribute, at in server.requests]
+    order = [attribute for attribute, _ in puts]
+    assert order == ["tracking", "abortslew", "findhome", "slewsettletime"]
+    # The safety command is sent while the first command is still executing.
+    assert puts[1][1] - puts[0][1] < server.latency
+    assert puts[2][1] - puts[1][1] >= server.latency * 0.9
+
+
+def test_guide_pulses_are_not_queued(server):
+    telescope = Telescope(server.address, 0)
+    server.latency = 0.2
+    threads = [start(setattr, telescope, "Tracking", True)]
+    time.sleep(0.05)
+    threads += [start(telescope.PulseGuide, direction, 10) for direction in (0, 2)]
+    for thread in threads:
+        thread.join()
+    arrivals = [at for _, _, at in server.requests]
+    assert max(arrivals) - min(arrivals) < server.latency
+
+
+def test_guide_completion_is_measured_for_the_longest_pulse(server):
+    guider = PulseGuider(Telescope(server.address, 0))
+    assert guider.guide() == []
+    short, long = guider.guide((0, 20), (2, 150))
+    assert short.completion != short.completion
+    assert 0.15 <= long.completion < 1.0 and long.overrun >= 0
+    stats = guider.stats()
+    assert stats["count"] == 2 and stats["overrun_mean"] == long.overrun
+    guider.close()
+
+
+def test_target_planner_coordinates_and_pier_side(server):
+    np = pytest.importorskip("numpy")
+    server.values.update(sitelatitude=50.0, siderealtime=3.0, alignmentmode=2)
+    planner = TargetPlanner(Telescope(server.address, 0))
+    table = planner.compute([3.0, 3.0, 5.0, 15.0], [50.0, 20.0, 20.0, -60.0])
+    assert np.allclose(table.HourAngle, [0.0, 0.0, -2.0, -12.0], atol=1e-3)
+    assert np.allclose(table.Altitude[:2], [90.0, 60.0], atol=0.02)
+    assert table.Azimuth[1] == pytest.approx(180.0, abs=0.1)
+    assert table.Airmass[0] == pytest.approx(1.0, abs=1e-3)
+    assert np.isnan(table.Airmass[3])
+    assert list(table.SideOfPier) == [0, 0, 1, 1]
+    server.values["destinationsideofpier"] = 1
+    assert planner.spot_check([3.0, 5.0], [20.0, 20.0], samples=2) == {0: 1}
+
+
+def test_position_model_extrapolation(server):
+    server.values.update(sitelatitude=50.0, siderealtime=3.0, rightascension=1.0)
+    server.values.update(declination=20.0, altitude=40.0, azimuth=100.0)
+    telescope = Telescope(server.address, 0)
+    model = PositionModel(telescope)
+    synced = model.sync()
+    assert synced.error == 0.0
+    hour = 3600.0 / alpycaclient.SIDEREAL_RATE
+    # Without tracking the hour angle stays fixed while the sky turns.
+    stopped = model._extrapolate(model.synced + hour)
+    assert stopped.SiderealTime == pytest.approx(4.0)
+    assert stopped.RightAscension == pytest.approx(2.0)
+    assert stopped.Altitude == 40.0 and stopped.error == float("inf")
+    server.values.update(tracking=True, declinationrate=36.0)
+    model.sync()
+    tracking = model._extrapolate(model.synced + hour)
+    assert tracking.RightAscension == pytest.approx(1.0, abs=1e-3)
+    assert tracking.Declination == pytest.approx(20.0 + 36.0 / 3600.0 * hour)
+    assert 0.0 <= model.drift_rate < float("inf")
+    assert tracking.error == pytest.approx(model.drift_rate * hour)
+
+
+def test_position_model_resyncs_after_slews(server):
+    server.values["tracking"] = True
+    telescope = Telescope(server.address, 0)
+    model = PositionModel(telescope)
+    model.position()
+    server.values["rightascension"] = 5.0
+    assert model.position().RightAscension == 0.0
+    telescope.with_session().SlewToCoordinatesAsync(5.0, 10.0)
+    assert model.position().RightAscension == 5.0
+
+
+def test_dome_holds_its_target_while_the_telescope_slews(server):
+    pytest.importorskip("numpy")
+    server.values.update(
+        sitelatitude=50.0, siderealtime=3.0, rightascension=1.0, declination=20.0
+    )
+    server.values.update(altitude=40.0, azimuth=0.0, tracking=True, slewing=True)
+    slaver = DomeSlaver(Dome(server.address, 0), Telescope(server.address, 0), 2.0)
+    slaver.slew_telescope(20.0, 30.0)
+    for _ in range(3):
+        slaver.update()
+        slaver.model.invalidate()
+    slews = [a for m, a, _ in server.requests if a == "slewtoazimuth"]
+    assert slews == ["slewtoazimuth"] and slaver.commands == 1
+    server.values["slewing"] = False
+    slaver.update()
+    assert slaver.commands == 2
+
+
+def test_recorder_and_tracer_with_fast_transport(server, tmp_path):
+    server.values["position"] = 4
+    wheel = FilterWheel(server.address, 0)
+    wheel.session = FastTransport()
+    wheel.recorder = TrafficRecorder(str(tmp_path / "traffic.log"))
+    wheel.tracer = TraceSink(str(tmp_path / "trace.log"))
+    assert wheel.Position == 4
+    wheel.Position = 2
+    wheel.recorder.close()
+    wheel.tracer.close()
+    entries = alpycaclient._read_log(str(tmp_path / "traffic.log"))
+    assert [(e["m"], e["s"]) for e in entries] == [("GET", 200), ("PUT", 200)]
+    assert json.loads(entries[0]["b"])["Value"] == 4
+    traces = (tmp_path / "trace.log").read_text().splitlines()
+    assert [json.loads(t)["error"] for t in traces] == [None, None]
+
+
+def test_poller_reports_errors_and_restarts_after_stop(server):
+    poller = PropertyPoller()
+    wheel = FilterWheel(server.address, 0)
+    wheel.timeout = 0.1
+    changes, errors = [], []
+    subscription = wheel.on_change(
+        "Position",
+        lambda *change: changes.append(change),
+        0.05,
+        poller=poller,
+        on_error=lambda *error: errors.append(error),
+    )
+    wait_until(lambda: subscription.value == 0, 1.0, 0.01)
+    server.values["position"] = 2
+    wait_until(lambda: changes == [("Position", 0, 2)], 1.0, 0.01)
+    server.latency = 0.2
+    wait_until(lambda: len(errors) == 1, 1.0, 0.01)
+    assert errors[0][0] == "Position" and subscription.error is errors[0][1]
+    time.sleep(0.3)
+    assert len(errors) == 1
+    server.latency = 0.0
+    poller.stop()
+    server.values["position"] = 3
+    restarted = wheel.on_change("Position", print, 0.05, poller=poller)
+    wait_until(lambda: restarted.value == 3, 1.0, 0.01)
+    poller.stop()
+    assert changes == [("Position", 0, 2)]
+
+
+def test_operation_plan_runs_by_dependency():
+    plan = OperationPlan(interval=0.01)
+    plan.add("slew", lambda: time.sleep(0.2))
+    plan.add("filter", lambda: time.sleep(0.1))
+    plan.add("focus", lambda: time.sleep(0.1), depends=["slew", "filter"])
+    report = plan.run()
+    assert 0.3 <= report.elapsed < 0.4
+    assert report.critical_path == ["slew", "focus"]
+    results = report.results
+    assert results["focus"].started >= results["slew"].finished
+    assert results["filter"].started < 0.05
+    assert all(result.error is None for result in results.values())
+
+
+def test_operation_plan_errors():
+    plan = OperationPlan()
+    plan.add("dome", lambda: 1 / 0)
+    plan.add("slew", lambda: None, depends=["dome"])
+    results = plan.run().results
+    assert isinstance(results["dome"].error, ZeroDivisionError)
+    assert results["slew"].error is results["dome"].error
+    with pytest.raises(ValueError):
+        plan.add("dome", lambda: None)
+    plan.add("a", lambda: None, depends=["b"])
+    plan.add("b", lambda: None, depends=["a"])
+    with pytest.raises(ValueError):
+        plan.run()
+
+
+def test_change_filter_compensates_focus(server):
+    server.values.update(names=["L", "R", "G"], focusoffsets=[0, 30, -20])
+    server.values.update(absolute=True, position=0)
+    wheel, focuser = FilterWheel(server.address, 0), Focuser(server.address, 0)
+    report = wheel.change_filter("g", focuser, interval=0.01)
+    assert server.values["position"] == 2 and server.values["move"] == -20
+    assert set(report.results) == {"filter", "focus"}
+    report = wheel.change_filter(1, focuser, concurrent=False, interval=0.01)
+    # MockServer answers Position of the focuser with that of the wheel.
+    assert server.values["move"] == 2 + 50
+    assert report.results["focus"].started >= report.results["filter"].finished
+    assert [a for _, a, _ in server.requests].count("names") == 1
+    with pytest.raises(ValueError):
+        wheel.change_filter("Ha")
+
+
+def test_conditions_snapshot_reads_only_updated_sensors(server):
+    server.values.update(temperature=12.5, humidity=80, timesincelastupdate=100.0)
+    conditions = ObservingConditions(server.address, 0)
+    snapshot = conditions.snapshot()
+    assert set(snapshot) == set(ObservingConditions.SENSORS)
+    assert snapshot["Temperature"] == 12.5 and snapshot["Humidity"] == 80
+    del server.requests[:]
+    server.values["temperature"] = 13.0
+    assert conditions.snapshot()["Temperature"] == 12.5
+    assert [a for _, a, _ in server.requests] == ["timesincelastupdate"]
+    server.values["timesincelastupdate"] = 0.0
+    assert conditions.snapshot()["Temperature"] == 13.0
+
+
+def test_shutdown_steps_wait_for_shutter_and_park(server):
+    server.values.update(shutterstatus=3, atpark=False)
+    dome, telescope = Dome(server.address, 0), Telescope(server.address, 0)
+    close, park = shutdown_plan(dome, telescope, timeout=0.3, interval=0.02)
+    with pytest.raises(TimeoutError):
+        close.action()
+    timer = threading.Timer(0.2, server.values.update, [dict(shutterstatus=1)])
+    timer.start()
+    started = time.perf_counter()
+    close.action()
+    assert time.perf_counter() - started >= 0.2
+    with pytest.raises(TimeoutError):
+        park.action()
+    server.values["atpark"] = True
+    park.action()
+    puts = [a for m, a, _ in server.requests if m == "PUT"]
+    assert puts == ["closeshutter", "closeshutter", "park", "park"]
+
+
+def watchdog(server, **kwargs):
+    events = []
+    plan = [ShutdownStep("Step", lambda: None, 1.0)]
+    monitor = SafetyMonitor(server.address, 0)
+    return SafetyWatchdog([monitor], plan, on_event=events.append, **kwargs), events
+
+
+def test_watchdog_runs_the_plan_once_per_unsafe_episode(server):
+    server.values["issafe"] = True
+    dog, events = watchdog(server)
+    assert dog.check() is None
+    server.values["issafe"] = False
+    assert dog.check().endswith("reports unsafe")
+    assert dog.check() is None
+    wait_until(lambda: len(events) == 1, 1.0, 0.01)
+    assert [s.name for s in events[0].steps] == ["Step"]
+    assert events[0].steps[0].error is None
+    server.values["issafe"] = True
+    assert dog.check() is None
+    server.values["issafe"] = False
+    assert dog.check() is not None
+    wait_until(lambda: len(events) == 2, 1.0, 0.01)
+
+
+def test_watchdog_detects_contact_loss(server):
+    server.values["issafe"] = True
+    dog, events = watchdog(server, contact_timeout=0.25, request_timeout=0.1)
+    server.latency = 0.3
+    assert dog.check() is None
+    time.sleep(0.15)
+    assert dog.check().startswith("contact lost")
+    wait_until(lambda: len(events) == 1, 1.0, 0.01)
+    server.latency = 0.0
+    assert dog.check() is None
+
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_get_parameters_are_sent_in_the_query_string(server, fast):
+    sent = []
+    serve = server.serve
+
+    def record(handler, method):
+        sent.append((handler.path, handler.headers.get("Content-Length")))
+        serve(handler, method)
+
+    server.serve = record
+    telescope = Telescope(server.address, 0)
+    if fast:
+        telescope.session = FastTransport()
+    telescope.CanMoveAxis(1)
+    path, length = sent[0]
+    assert path.endswith("?Axis=1") and length in (None, "0")
+
+
+def test_replay_of_a_recorded_session(server, tmp_path):
+    np = pytest.importorskip("numpy")
+    log = str(tmp_path / "session.log.gz")
+    wheel, camera = FilterWheel(server.address, 0), Camera(server.address, 0)
+    wheel.recorder = camera.recorder = TrafficRecorder(log)
+    for position in (1, 2):
+        server.values["position"] = position
+        assert wheel.Position == position
+    image = camera.download_image(compression=True)
+    wheel.recorder.close()
+    with ReplayServer(log, latency_scale=0.0) as replay:
+        wheel, camera = FilterWheel(replay.address, 0), Camera(replay.address, 0)
+        assert [wheel.Position for _ in range(3)] == [1, 2, 2]
+        assert np.array_equal(camera.download_image(), image)
+        with pytest.raises(alpycaclient.ErrorMessage):
+            wheel.Names
+
+
+def test_concurrent_identical_gets_are_coalesced(server):
+    server.latency = 0.2
+    server.values["position"] = 3
+    wheels = [FilterWheel(server.address, 0) for _ in range(8)]
+    results = []
+    threads = [start(lambda w: results.append(w.Position), w) for w in wheels]
+    for thread in threads:
+        thread.join()
+    assert results == [3] * 8
+    assert [a for _, a, _ in server.requests] == ["position"]
+
+
+def test_read_after_write_is_not_coalesced(server):
+    server.values["position"] = 1
+    wheel = FilterWheel(server.address, 0)
+    wheel.freshness = 10.0
+    assert wheel.Position == 1
+    wheel.Position = 5
+    assert wheel.Position == 5
+
+
+def test_coalesced_get_respects_caller_timeout(server):
+    server.latency = 0.5
+    slow = FilterWheel(server.address, 0)
+    thread = start(lambda: slow.Position)
+    time.sleep(0.05)
+    fast = FilterWheel(server.address, 0)
+    fast.timeout = 0.1
+    started = time.perf_counter()
+    with pytest.raises(requests.Timeout):
+        fast.Position
+    assert time.perf_counter() - started < 0.4
+    thread.join()
+
+
+def test_last_known_value_while_unreachable(server):
+    server.values["position"] = 7
+    wheel = FilterWheel(server.address, 0)
+    wheel.coalesce = False
+    wheel.staleness = 1.5
+    assert wheel.Position == 7
+    assert not wheel.known("Position").stale
+    dedicated = wheel.with_session()
+    server.stop()
+    assert wheel.Position == 7
+    known = wheel.known("Position")
+    assert known.stale and known.value == 7 and known.age < 1.5
+    with pytest.raises(requests.ConnectionError):
+        wheel.Position = 2
+    with pytest.raises(requests.ConnectionError):
+        dedicated.Position
+    time.sleep(1.5)
+    with pytest.raises(requests.ConnectionError):
+        wheel.Position
+
+
+def test_images_are_not_kept_as_last_known_values(server):
+    camera = Camera(server.address, 0)
+    camera.staleness = 10.0
+    assert len(camera.ImageArray) == 9
+    assert camera.known("ImageArray") is None and camera._known == {}
+
+
+def test_no_last_known_value_by_default(server):
+    wheel = FilterWheel(server.address, 0)
+    wheel.coalesce = False
+    assert wheel.Position == 0
+    server.stop()
+    with pytest.raises(requests.ConnectionError):
+        wheel.Position
+
+
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1000, 1000000]
+
+
+def json_image(image, type_after_value=False):
+    values = json.dumps(image.tolist())
+    type_ = {"int16": 1, "int32": 2, "float64": 3}[image.dtype.name]
+    if type_after_value:
+        body = '{"Value": %s, "Type": %d, "ErrorNumber": 0, "ErrorMessage": ""}' % (
+            values,
+            type_,
+        )
+    else:
+        body = (
+            '{"Type": %d, "Rank": %d, "Value": %s, "ErrorNumber": 0, '
+            '"ErrorMessage": ""}' % (type_, image.ndim, values)
+        )
+    return body.encode()
+
+
+def decode(body, size, encoding="identity", imagebytes=False):
+    chunks = [body[i : i + size] for i in range(0, len(body), size)]
+    return alpycaclient._decode_chunks(chunks, encoding, imagebytes, ArraySink())[0]
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("shape", [(9, 7), (5, 4, 3)])
+@pytest.mark.parametrize("encoding", ["identity", "gzip"])
+def test_json_image_decoding(size, shape, encoding):
+    np = pytest.importorskip("numpy")
+    image = np.random.default_rng(0).integers(-500, 60000, shape).astype(np.int32)
+    body = json_image(image)
+    if encoding == "gzip":
+        body = gzip.compress(body)
+    decoded = decode(body, size, encoding)
+    assert decoded.shape == image.shape and decoded.dtype == image.dtype
+    assert (decoded == image).all()
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_json_image_type_after_value(size):
+    np = pytest.importorskip("numpy")
+    image = np.arange(-30, 33, dtype=np.int16).reshape(9, 7)
+    decoded = decode(json_image(image, type_after_value=True), size)
+    assert decoded.dtype == np.int16 and (decoded == image).all()
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_imagebytes_decoding(size):
+    np = pytest.importorskip("numpy")
+    image = np.random.default_rng(0).integers(0, 65535, (9, 7)).astype(np.int32)
+    header = struct.pack("<iiIIiiiiiii", 1, 0, 0, 0, 44, 2, 8, 2, 9, 7, 0)
+    decoded = decode(header + image.astype("<u2").tobytes(), size, imagebytes=True)
+    assert decoded.shape == image.shape and decoded.dtype == np.int32
+    assert (decoded == image).all()
+
+
+@pytest.mark.parametrize("size", [7, 1000, 1000000])
+def test_statistics_while_decoding(size):
+    np = pytest.importorskip("numpy")
+    image = np.random.default_rng(0).integers(0, 5000, (40, 30)).astype(np.int32)
+    body = json_image(image)
+    chunks = [body[i : i + size] for i in range(0, len(body), size)]
+    sink = StatisticsSink(saturation=4000, keep=True)
+    stats = alpycaclient._decode_chunks(chunks, "identity", False, sink)[0]
+    assert stats.count == image.size and (stats.image == image).all()
+    assert stats.mean == pytest.approx(image.mean())
+    assert (stats.minimum, stats.maximum) == (image.min(), image.max())
+    assert stats.saturated == np.count_nonzero(image >= 4000)
+    middle = np.sort(image, axis=None)[image.size // 2 - 1 : image.size // 2 + 1]
+    assert middle[0] <= stats.median <= middle[1]
+    assert stats.histogram.count == image.size
+
+
+def test_bin_image_modes():
+    np = pytest.importorskip("numpy")
+    image = np.arange(7 * 5, dtype=np.uint16).reshape(7, 5)
+    total = alpycaclient.bin_image(image, 2)
+    assert total.shape == (3, 2) and total.dtype == np.int64
+    assert total[1, 1] == image[2:4, 2:4].sum()
+    assert (alpycaclient.bin_image(image, 2, "mean") == total / 4).all()
+    assert (alpycaclient.bin_image(image, 2, "stride") == image[:6:2, :4:2]).all()
+    colour = np.stack([image, image * 2], axis=2)
+    assert (alpycaclient.bin_image(colour, 2)[:, :, 1] == total * 2).all()
+    with pytest.raises(ValueError):
+        alpycaclient.bin_image(image, 2, "median")
+
+
+@pytest.mark.parametrize("size", [7, 1000, 1000000])
+@pytest.mark.parametrize("mode", ["sum", "mean", "stride"])
+def test_preview_while_decoding(size, mode):
+    np = pytest.importorskip("numpy")
+    image = np.random.default_rng(0).integers(0, 5000, (37, 23)).astype(np.int32)
+    body = json_image(image)
+    chunks = [body[i : i + size] for i in range(0, len(body), size)]
+    sink = PreviewSink(4, mode)
+    preview = alpycaclient._decode_chunks(chunks, "identity", False, sink)[0]
+    assert (preview == alpycaclient.bin_image(image, 4, mode)).all()
+
+
+def test_camera_preview(server):
+    np = pytest.importorskip("numpy")
+    camera = Camera(server.address, 0)
+    preview = camera.preview(3)
+    assert preview.shape == (3, 2) and preview.dtype == np.uint8
+    image = camera.download_image()
+    assert (camera.preview(3, stretch=False) == alpycaclient.bin_image(image, 3)).all()
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_download_image_in_small_chunks(server, binary):
+    pytest.importorskip("numpy")
+    camera = Camera(server.address, 0)
+    expected = camera.download_image(binary=binary)
+    assert expected.shape == (9, 7)
+    assert (camera.download_image(binary=binary, chunk_size=5) == expected).all()
+
+
+def sum_frame(frame, results):
+    array = frame.attach()
+    results.put(int(array.sum()))
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_shared_frame_is_unlinked_after_its_consumer_released_it():
+    np = pytest.importorskip("numpy")
+    buffer = SharedFrameBuffer((4, 3), np.int32)
+    buffer.array[...] = 2
+    frame = buffer.share()
+    path = "/dev/shm/" + buffer.name
+    buffer.release()
+    time.sleep(0.2)
+    # The owner let go long before the consumer does.
+    assert os.path.exists(path)
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=sum_frame, args=(frame, results))
+    process.start()
+    assert results.get(timeout=5) == 24
+    process.join()
+    wait_until(lambda: not os.path.exists(path), 2.0, 0.02)
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_worker_block_is_unlinked_when_attaching_fails(server, monkeypatch):
+    pytest.importorskip("numpy")
+    camera = Camera(server.address, 0)
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        expected = camera.download_image(pool=pool)
+        assert expected.shape == (9, 7)
+        blocks = set(glob.glob("/dev/shm/psm_*"))
+
+        def fail(*args):
+            raise MemoryError
+
+        monkeypatch.setattr(alpycaclient._shared_arrays, "attach", fail)
+        with pytest.raises(MemoryError):
+            camera.download_image(pool=pool)
+        assert set(glob.glob("/dev/shm/psm_*")) <= blocks
+
+
+def bayer(height, width, colour, BayerOffsetX, BayerOffsetY):
+    np = pytest.importorskip("numpy")
+    y, x = np.mgrid[:height, :width]
+    red = (y % 2 == BayerOffsetY % 2) & (x % 2 == BayerOffsetX % 2)
+    blue = (y % 2 != BayerOffsetY % 2) & (x % 2 != BayerOffsetX % 2)
+    raw = np.where(red, colour[0], np.where(blue, colour[2], colour[1]))
+    return raw.T.astype(np.uint16)
+
+
+@pytest.mark.parametrize("method", ["bilinear", "mhc"])
+@pytest.mark.parametrize("offsets", [(0, 0), (1, 0), (0, 1), (1, 1)])
+def test_demosaic_of_a_flat_colour_field(method, offsets):
+    np = pytest.importorskip("numpy")
+    image = bayer(8, 12, (100, 50, 20), *offsets)
+    rgb = alpycaclient.demosaic(image, 2, *offsets, method=method)
+    assert rgb.shape == (8, 12, 3) and rgb.dtype == np.float32
+    assert np.allclose(rgb, [100, 50, 20])
+
+
+def test_demosaic_other_sensor_types():
+    np = pytest.importorskip("numpy")
+    mono = np.arange(12).reshape(4, 3)
+    rgb = alpycaclient.demosaic(mono, 0)
+    assert rgb.shape == (3, 4, 3) and (rgb[:, :, 1] == mono.T).all()
+    with pytest.raises(ValueError):
+        alpycaclient.demosaic(mono, 3)
+
+
+def test_benchmark(server):
+    pytest.importorskip("numpy")
+    results = alpycaclient.benchmark(Camera(server.address, 0), ["name"], 20, 1)
+    latency = results["name"]
+    assert latency["errors"] == 0
+    assert latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]
+    # The mock frame fits 16 bit values after the 44 byte header.
+    assert results["imagebytes"]["bytes"] == 44 + 9 * 7 * 2
+    assert results["imagearray"]["mb_per_s"] > 0
+
+
+def test_command_line_status_and_bench(capsys):
+    alpycaclient.main(["status", "filterwheel", "--mock", "--properties", "Position"])
+    assert capsys.readouterr().out.split() == ["Position", "0"]
+    alpycaclient.main(["bench", "focuser", "--mock", "--calls", "3"])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["ms", "p50", "p95", "p99", "max", "errors"]
+    assert [line.split()[0] for line in lines[1:]] == [
+        "connected",
+        "name",
+        "position",
+        "ismoving",
+    ]
+
+
+def test_trace_sampling_rotation_and_analysis(tmp_path):
+    path = str(tmp_path / "trace.log")
+    sink = TraceSink(path, sample=0.0, slow=0.5, max_bytes=1000, backups=10)
+    wheel = FilterWheel("localhost:1", 0)
+    for _ in range(20):
+        sink.trace(wheel, "GET", "position", 0.01, 60)
+    sink.trace(wheel, "GET", "position", 0.2, 0, requests.Timeout("slow"))
+    for _ in range(20):
+        sink.trace(wheel, "GET", "names", 1.0, 60)
+    sink.trace(wheel, "GET", "names", 6.0, 60)
+    sink.close()
+    assert os.path.exists(path + ".1")
+    records = alpycaclient.read_trace(path)
+    assert len(records) == 22
+    assert [r["time"] for r in records] == sorted(r["time"] for r in records)
+    analysis = alpycaclient.analyze_trace(records, factor=5.0)
+    names = analysis.endpoints["filterwheel/0/names"]
+    assert names["count"] == 21 and names["p50"] == 1000.0
+    assert analysis.endpoints["filterwheel/0/position"]["errors"] == 1
+    assert analysis.hosts["localhost:1"]["count"] == 22
+    assert [r["duration"] for r in analysis.outliers] == [6.0]
+
+
+def test_download_scheduler_order_and_stats(server):
+    pytest.importorskip("numpy")
+    cameras = [Camera(server.address, n) for n in range(3)]
+    server.latency = 0.1
+    order = []
+
+    def submit(n, blocking=False):
+        future = scheduler.submit(cameras[n], blocking)
+        future.add_done_callback(lambda _: order.append(n))
+        return future
+
+    with DownloadScheduler(max_concurrent=1) as scheduler:
+        submit(0)
+        time.sleep(0.05)
+        later, urgent = submit(1), submit(2, blocking=True)
+        assert later.result().shape == (9, 7) and urgent.done()
+    assert order == [0, 2, 1]
+    stats = scheduler.stats()
+    assert [stats[c.base_url]["frames"] for c in cameras] == [1, 1, 1]
+    assert stats[cameras[1].base_url]["wait"] > stats[cameras[2].base_url]["wait"]
+    with pytest.raises(RuntimeError):
+        scheduler.submit(cameras[0])
+
+
+def test_download_scheduler_close_without_waiting(server):
+    pytest.importorskip("numpy")
+    camera = Camera(server.address, 0)
+    server.latency = 0.1
+    scheduler = DownloadScheduler(max_concurrent=1)
+    running, queued = scheduler.submit(camera), scheduler.submit(camera)
+    time.sleep(0.05)
+    scheduler.close(wait=False)
+    assert queued.cancelled() and running.result().shape == (9, 7)
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = alpycaclient._TokenBucket(1000000.0, 100000.0)
+    started = time.perf_counter()
+    bucket.consume(100000)
+    assert time.perf_counter() - started < 0.05
+    bucket.consume(200000)
+    assert 0.15 < time.perf_counter() - started < 0.4
+
+
+def test_profile_devices_and_parallel_connect(server, tmp_path):
+    path = tmp_path / "observatory.json"
+    devices = {
+        "mount": {"host": "pier", "type": "telescope"},
+        "camera": {"host": "pier", "type": "camera", "depends": ["mount"]},
+        "dome": {"host": "pier", "type": "dome", "number": 1, "timeout": 2.0},
+    }
+    hosts = {"pier": {"address": server.address}}
+    profile = {"client": {"timeout": 5.0}, "hosts": hosts, "devices": devices}
+    path.write_text(json.dumps(profile))
+    profile = Profile.load(str(path))
+    assert len(profile) == 3 and not profile._devices
+    dome = profile["dome"]
+    assert isinstance(dome, Dome) and dome.device_number == 1 and dome.timeout == 2.0
+    assert profile["mount"].timeout == 5.0
+    assert profile["mount"].session is profile["camera"].session
+    server.latency = 0.1
+    report = profile.connect()
+    assert report.critical_path == ["mount", "camera"]
+    results = report.results
+    assert results["camera"].started >= results["mount"].finished
+    assert results["dome"].started < results["mount"].finished
+    assert sorted(profile.connect(["camera"]).results) == ["camera", "mount"]
+    with pytest.raises(ValueError):
+        Profile(hosts, {"x": {"host": "pier", "type": "camera", "depends": ["y"]}})
+    with pytest.raises(ValueError):
+        Profile({"pier": {"address": "x", "tmeout": 1}}, {})
+    with pytest.raises(KeyError):
+        profile["guider"]